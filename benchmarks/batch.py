@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""Cost of writing long lists of instances of one type.
+
+Lists of rows with string, integer, double, long and object fields are
+returned by a remote method, and each call is processed in full by the
+servlet (rpc._ServiceServlet.processRequestNow).  The time per row is
+reported for lists written an element at a time, in one pass (see
+rpc.Response.writeObjectList), and in one pass by a method that is
+declared to return deferred values, whose result is searched for them
+first.
+"""
+
+import sys
+import time
+
+from zope.interface import implements
+from twisted.internet import defer
+
+from xtwisted.gwt import annotation, gwttypes, rpc, client
+from xtwisted.gwt.interface import RemoteInterface, deferredValues
+
+
+class RowType(gwttypes.ObjectType):
+    __remote_name__ = 'bench.Row'
+
+    name = annotation.RemoteAttribute(gwttypes.strType(), "name")
+    count = annotation.RemoteAttribute(gwttypes.intType(), "count")
+    ratio = annotation.RemoteAttribute(gwttypes.doubleType(), "ratio")
+    stamp = annotation.RemoteAttribute(gwttypes.longType(), "stamp")
+    parent = annotation.RemoteAttribute(gwttypes.ObjectType(), "parent")
+
+
+class Row(object):
+    gwttypes.instanceClassOf(RowType)
+
+    def __init__(self, name=None, count=0, ratio=0.0, stamp=0, parent=None):
+        self.name = name
+        self.count = count
+        self.ratio = ratio
+        self.stamp = stamp
+        self.parent = parent
+
+
+class IBenchService(RemoteInterface):
+    __remote_name__ = 'bench.BatchService'
+
+    def getRows():
+        return gwttypes.ArrayListType(RowType())
+
+    @deferredValues()
+    def getResolvedRows():
+        return gwttypes.ArrayListType(RowType())
+
+
+class BenchServlet(rpc._ServiceServlet):
+    implements(IBenchService)
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def getRows(self):
+        return self.rows
+
+    def getResolvedRows(self):
+        return self.rows
+
+
+def buildRows(count):
+    return [Row(u'row%d' % (i % 100), i, i / 8.0, i << 20)
+            for i in xrange(count)]
+
+
+def measure(servlet, methodName, version, repeat):
+    body = client.encodeCall(IBenchService, methodName, [], version=version)
+    started = time.time()
+    for i in xrange(repeat):
+        chunks = []
+        result = servlet.processRequestNow(body)
+        if isinstance(result, defer.Deferred):
+            # calls of methods with deferred values are answered with a
+            # deferred, which has fired already.
+            result.addCallback(chunks.extend)
+        else:
+            chunks.extend(result)
+        assert ''.join(chunks).startswith('//OK')
+    return (time.time() - started) * 1e6 / (len(servlet.rows) * repeat)
+
+
+def main(argv):
+    repeat = int(argv[0]) if argv else 3
+    print '%8s %7s %14s %14s %14s' % (
+        'rows', 'version', 'each us', 'batch us', 'resolved us')
+    for count in (1000, 10000, 100000):
+        servlet = BenchServlet(buildRows(count))
+        for version in (5, 7):
+            rpc.Response.minBatchSize = count + 1
+            each = measure(servlet, 'getRows', version, repeat)
+            rpc.Response.minBatchSize = 8
+            batch = measure(servlet, 'getRows', version, repeat)
+            resolved = measure(servlet, 'getResolvedRows', version, repeat)
+            print '%8d %7d %14.2f %14.2f %14.2f' % (
+                count, version, each, batch, resolved)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
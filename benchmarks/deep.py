@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""Cost of encoding and decoding deeply nested object graphs.
+
+Chains of nodes, each the only child of the one before it, and balanced
+trees of the same number of nodes are encoded and decoded as the result
+of a call.  The time per node is reported for each shape; the chains
+are deeper than the recursion limit allows, and should cost about as
+much per node as the trees.
+
+For comparison, the time per node is also reported for recursive
+writing and reading, as objects were handled before the explicit stack
+(where the graph is shallow enough for it).
+"""
+
+import sys
+import time
+
+from xtwisted.gwt import annotation, gwttypes, rpc, client
+
+
+class NodeType(gwttypes.ObjectType):
+    __remote_name__ = 'bench.Node'
+
+    label = annotation.RemoteAttribute(gwttypes.strType(), "label")
+    children = annotation.RemoteAttribute(gwttypes.ArrayListType(), "children")
+
+
+class Node(object):
+    gwttypes.instanceClassOf(NodeType)
+
+    def __init__(self, label=None, children=None):
+        self.label = label
+        self.children = children
+
+
+def buildChain(count):
+    node = Node(u'leaf', [])
+    for level in xrange(count - 1):
+        node = Node(u'node', [node])
+    return node
+
+
+def buildTree(count, fanout=4):
+    nodes = [Node(u'leaf', []) for i in xrange(count)]
+    for index in reversed(xrange(1, count)):
+        nodes[(index - 1) // fanout].children.append(nodes[index])
+    return nodes[0]
+
+
+class RecursiveResponse(rpc.Response):
+    """A response that writes the objects an object refers to as they are
+    serialized.
+    """
+
+    def writeObject(self, instance, typeInstance=None):
+        if instance is None:
+            self.writeString(None)
+            return
+        self._writeObject1(instance, typeInstance)
+
+
+class RecursiveReader(client.ResponseReader):
+    """A reader that reads the objects an object refers to as its
+    serializer asks for them.
+    """
+
+    def deserializeObject(self, typeSignature):
+        id = self.reserveObject()
+        typeInstance = annotation.buildAnnotation(typeSignature)
+        customSerializer = annotation.getCustomFieldSerializer(typeInstance)
+        self.depth += 1
+        instance = customSerializer.deserialize(self)
+        self.depth -= 1
+        self.rememberObject(instance, id)
+        return instance
+
+
+def measure(node, count, repeat, responseClass, readerClass):
+    """Return the best times per node, in microseconds, to encode and to
+    decode node.
+    """
+    encoded = decoded = float('inf')
+    for i in xrange(repeat):
+        started = time.time()
+        response = responseClass(None)
+        response.flags, response.version = 0, 5
+        response.writeObject(node, NodeType())
+        content = ''.join(response.toChunks('//OK'))
+        encoded = min(encoded, time.time() - started)
+        started = time.time()
+        reader = readerClass()
+        reader.prepareToRead(content)
+        reader.readResult(NodeType())
+        decoded = min(decoded, time.time() - started)
+    perNode = 1e6 / count
+    return encoded * perNode, decoded * perNode
+
+
+def measureRecursive(node, count, repeat):
+    try:
+        return measure(node, count, repeat, RecursiveResponse,
+                       RecursiveReader)
+    except RuntimeError:
+        # too deep to recurse.
+        return None, None
+
+
+def formatTime(value):
+    if value is None:
+        return '%12s' % '-'
+    return '%12.2f' % value
+
+
+def main(argv):
+    repeat = int(argv[0]) if argv else 5
+    print '%-6s %8s %12s %12s %12s %12s' % (
+        'shape', 'nodes', 'encode us', 'before', 'decode us', 'before')
+    for count in (100, 1000, 10000, 50000):
+        for shape, build in (('chain', buildChain), ('tree', buildTree)):
+            node = build(count)
+            encode, decode = measure(node, count, repeat, rpc.Response,
+                                     client.ResponseReader)
+            encodeBefore, decodeBefore = measureRecursive(node, count, repeat)
+            print '%-6s %8d %s %s %s %s' % (
+                shape, count, formatTime(encode), formatTime(encodeBefore),
+                formatTime(decode), formatTime(decodeBefore))
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
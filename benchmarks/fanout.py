@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""Cost of sending one result to many waiting clients.
+
+A number of calls wait on an event bus, and one event is published to
+all of them.  The time from publishing until every response has been
+written is reported when each call serializes the event itself (as
+before the bus shared events), and when the bus publishes it through
+rpc.shareResult, so that all of them share one serialization.
+"""
+
+import sys
+import time
+
+from zope.interface import implements
+
+from xtwisted.gwt import annotation, gwttypes, push, rpc, client
+from xtwisted.gwt.interface import RemoteInterface
+
+
+class ItemType(gwttypes.ObjectType):
+    __remote_name__ = 'bench.Item'
+
+    name = annotation.RemoteAttribute(gwttypes.strType(), "name")
+    count = annotation.RemoteAttribute(gwttypes.intType(), "count")
+
+
+class Item(object):
+    gwttypes.instanceClassOf(ItemType)
+
+    def __init__(self, name=None, count=0):
+        self.name = name
+        self.count = count
+
+
+class IBenchService(RemoteInterface):
+    __remote_name__ = 'bench.FanoutService'
+
+    def getItems():
+        return gwttypes.ArrayListType(ItemType())
+
+
+class UnsharedBus(push.EventBus):
+    """A bus that hands the event to every call, without sharing its
+    serialization.
+    """
+
+    def publish(self, topic, event):
+        waiting = self.waiting.pop(topic, ())
+        for d in waiting:
+            d.callback(event)
+        return len(waiting)
+
+
+class BenchServlet(rpc._ServiceServlet):
+    implements(IBenchService)
+
+    def __init__(self, bus):
+        self.bus = bus
+
+    def getItems(self):
+        return self.bus.wait('items')
+
+
+def fanout(clients, bus, event):
+    servlet = BenchServlet(bus)
+    body = client.encodeCall(IBenchService, u'getItems', [])
+    responses = []
+    for i in xrange(clients):
+        servlet.processRequest(body).addCallback(responses.append)
+    started = time.time()
+    servlet.bus.publish('items', event)
+    elapsed = time.time() - started
+    assert len(responses) == clients
+    return elapsed
+
+
+def main(argv):
+    items = [Item(u'item %d' % i, i) for i in xrange(200)]
+    print '%8s %14s %14s' % ('clients', 'each ms', 'shared ms')
+    for clients in (1, 10, 100, 1000):
+        each = fanout(clients, UnsharedBus(), items)
+        shared = fanout(clients, push.EventBus(), items)
+        print '%8d %14.1f %14.1f' % (clients, each * 1000, shared * 1000)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
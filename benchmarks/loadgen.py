@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""Drive a service servlet over HTTP at a fixed concurrency.
+
+Calls are encoded and decoded by xtwisted.gwt.client, so no GWT
+frontend is needed.  By default a servlet is served on loopback by this
+process; pass --url to drive one that runs elsewhere, for example:
+
+    python -m xtwisted.gwt.multiproc --port 8080 --workers 4 \\
+        loadgen.BenchServlet
+    python benchmarks/loadgen.py --url http://127.0.0.1:8080/
+
+Throughput and latency percentiles are reported when done.
+"""
+
+import sys
+import time
+
+from zope.interface import implements
+from twisted.internet import defer, task
+from twisted.python import usage
+from twisted.web import server, client as webclient
+
+from xtwisted.gwt import gwttypes
+from xtwisted.gwt.interface import RemoteInterface
+from xtwisted.gwt.web import ServiceServlet
+from xtwisted.gwt.client import HTTPServiceProxy
+
+
+class IBenchService(RemoteInterface):
+    __remote_name__ = 'bench.LoadService'
+
+    def getWords(count):
+        return gwttypes.ArrayListType()
+
+
+class BenchServlet(ServiceServlet):
+    implements(IBenchService)
+
+    def getWords(self, count):
+        return [u'word%d' % i for i in xrange(count)]
+
+
+class Options(usage.Options):
+    optParameters = [
+        ['url', 'u', None, "URL of the servlet (default: serve one here)."],
+        ['concurrency', 'c', 10, "Number of calls in flight.", int],
+        ['duration', 'd', 10.0, "Number of seconds to run.", float],
+        ['words', 'w', 100, "Number of words returned by a call.", int],
+        ]
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class LoadGenerator:
+    """Keep a fixed number of calls in flight for a while.
+    """
+
+    def __init__(self, proxy, concurrency, duration, args):
+        self.proxy = proxy
+        self.concurrency = concurrency
+        self.duration = duration
+        self.args = args
+        self.latencies = []
+        self.errors = 0
+
+    def run(self):
+        self.deadline = time.time() + self.duration
+        return defer.DeferredList(
+            [self.loop() for i in range(self.concurrency)])
+
+    @defer.inlineCallbacks
+    def loop(self):
+        while time.time() < self.deadline:
+            started = time.time()
+            try:
+                yield self.proxy.callRemote('getWords', *self.args)
+            except Exception:
+                self.errors += 1
+            else:
+                self.latencies.append(time.time() - started)
+
+    def report(self):
+        print 'calls %d  errors %d  %.1f calls/s' % (
+            len(self.latencies), self.errors,
+            len(self.latencies) / self.duration)
+        if self.latencies:
+            print 'latency p50 %.1fms  p90 %.1fms  p99 %.1fms' % tuple(
+                [percentile(self.latencies, p) * 1000 for p in (50, 90, 99)])
+
+
+def main(reactor, argv):
+    options = Options()
+    options.parseOptions(argv)
+    webclient.HTTPClientFactory.noisy = False
+    url = options['url']
+    if url is None:
+        site = server.Site(BenchServlet())
+        port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        url = 'http://127.0.0.1:%d/' % port.getHost().port
+    proxy = HTTPServiceProxy(IBenchService, url)
+    generator = LoadGenerator(proxy, options['concurrency'],
+                              options['duration'], [options['words']])
+    d = generator.run()
+    d.addCallback(lambda ignored: generator.report())
+    return d
+
+
+if __name__ == '__main__':
+    task.react(main, [sys.argv[1:]])
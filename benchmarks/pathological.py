@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""Cost of rejecting pathological request bodies.
+
+A number of hostile bodies are processed by a servlet without limits and
+by one with limits, and the time each takes to be answered or rejected
+is reported along with the outcome.
+"""
+
+import sys
+import time
+import random
+
+from zope.interface import implements
+
+from xtwisted.gwt import annotation, gwttypes, rpc
+from xtwisted.gwt.interface import RemoteInterface
+
+
+class IBenchService(RemoteInterface):
+    __remote_name__ = 'bench.PathologicalService'
+
+    def count(values):
+        return gwttypes.intType()
+
+
+class BenchServlet(rpc._ServiceServlet):
+    implements(IBenchService)
+
+    def count(self, values):
+        return len(values)
+
+
+class LimitedServlet(BenchServlet):
+    maxRequestSize = 1000000
+    maxTokens = 100000
+    maxStrings = 10000
+    maxCollectionLength = 10000
+    maxDepth = 50
+    maxObjects = 10000
+
+
+LIST_SIGNATURE = annotation.getTypeSignature(gwttypes.ArrayListType())
+
+
+def buildRequest(tokens, strings=()):
+    strings = [u'http://localhost/', u'STRONGNAME',
+               IBenchService.__remote_name__, u'count',
+               LIST_SIGNATURE] + list(strings)
+    tokens = ([5, 0, len(strings)] + strings + [1, 2, 3, 4, 1, 5]
+              + list(tokens))
+    return (u'|'.join([unicode(t) for t in tokens]) + u'|').encode('utf-8')
+
+
+def payloads():
+    yield 'huge length', buildRequest([5, 100000000])
+    yield 'deep nesting', buildRequest([5, 1] * 5000 + [5, 0])
+    yield 'wide list', buildRequest([5, 200000] + [0] * 200000)
+    yield 'many tokens', buildRequest([5, 0] + [0] * 1000000)
+    yield 'many strings', buildRequest(
+        [5, 0], [u's%d' % i for i in xrange(200000)])
+    yield 'garbage', ''.join([chr(random.randint(32, 126))
+                              for i in xrange(100000)])
+
+
+def process(servlet, body):
+    results = []
+    try:
+        d = servlet.processRequest(body)
+    except Exception, e:
+        return 'raised %s' % e.__class__.__name__
+    d.addBoth(results.append)
+    result = results[0]
+    if isinstance(result, list):
+        return ''.join(result)[:4]
+    return 'failed %s' % result.type.__name__
+
+
+def main():
+    # rejected bodies are logged by the servlet; keep the output clean.
+    rpc.log.err = lambda *args, **kw: None
+    random.seed(0)
+    sys.setrecursionlimit(20000)
+    print '%-14s %-10s %10s  %s' % ('payload', 'servlet', 'ms', 'outcome')
+    for name, body in payloads():
+        for servlet in (BenchServlet(), LimitedServlet()):
+            started = time.time()
+            outcome = process(servlet, body)
+            elapsed = time.time() - started
+            print '%-14s %-10s %10.1f  %s' % (
+                name, servlet.__class__.__name__[:-7] or 'Bench',
+                elapsed * 1000, outcome)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
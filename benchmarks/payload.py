@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""Bytes saved by compact payloads.
+
+Each method of a benchmark service is called with protocol versions 5
+and 7, and the size of its response is reported as doubles were written
+before (with a fraction, and rounded to 12 digits), as they are written
+now, and with the string table ordered by references (compactPayloads).
+"""
+
+import sys
+
+from zope.interface import implements
+
+from xtwisted.gwt import annotation, gwttypes, rpc, client
+from xtwisted.gwt.interface import RemoteInterface
+
+
+class QuoteType(gwttypes.ObjectType):
+    __remote_name__ = 'bench.Quote'
+
+    symbol = annotation.RemoteAttribute(gwttypes.strType(), "symbol")
+    price = annotation.RemoteAttribute(gwttypes.doubleType(), "price")
+    volume = annotation.RemoteAttribute(gwttypes.longType(), "volume")
+
+
+class Quote(object):
+    gwttypes.instanceClassOf(QuoteType)
+
+    def __init__(self, symbol=None, price=0.0, volume=0):
+        self.symbol = symbol
+        self.price = price
+        self.volume = volume
+
+
+class IBenchService(RemoteInterface):
+    __remote_name__ = 'bench.PayloadService'
+
+    def getQuotes():
+        return gwttypes.ArrayListType(QuoteType())
+
+    def getSeries():
+        return gwttypes.ArrayListType(gwttypes.doubleType())
+
+    def getTags():
+        return gwttypes.ArrayListType(gwttypes.strType())
+
+
+SYMBOLS = [u'SYM%d' % i for i in range(20)]
+
+
+class BenchServlet(rpc._ServiceServlet):
+    implements(IBenchService)
+
+    def getQuotes(self):
+        return [Quote(SYMBOLS[i % len(SYMBOLS)], 100.0 + (i % 8) * 0.25,
+                      1000000 * (i + 1)) for i in range(500)]
+
+    def getSeries(self):
+        return [float(i * 1000) for i in range(250)] + [
+            i / 3.0 for i in range(250)]
+
+    def getTags(self):
+        # a few tags dominate, after many that are used once.
+        return ([u'rare%d' % i for i in range(100)]
+                + [u'common%d' % (i % 5) for i in range(400)])
+
+
+class CompactServlet(BenchServlet):
+    compactPayloads = True
+
+
+def measure(servlet, methodName, version):
+    body = client.encodeCall(IBenchService, methodName, [],
+                             version=version)
+    result = servlet.processRequestNow(body)
+    return len(''.join(result))
+
+
+def legacyMeasure(servlet, methodName, version):
+    formatDouble = rpc.formatDouble
+    rpc.formatDouble = lambda value: str(float(value))
+    try:
+        return measure(servlet, methodName, version)
+    finally:
+        rpc.formatDouble = formatDouble
+
+
+def main(argv):
+    plain, compact = BenchServlet(), CompactServlet()
+    print '%-10s %7s %9s %9s %9s %7s' % (
+        'method', 'version', 'before', 'now', 'compact', 'saved')
+    for methodName in ('getQuotes', 'getSeries', 'getTags'):
+        for version in (5, 7):
+            before = legacyMeasure(plain, methodName, version)
+            now = measure(plain, methodName, version)
+            smallest = measure(compact, methodName, version)
+            print '%-10s %7d %9d %9d %9d %6.1f%%' % (
+                methodName, version, before, now, smallest,
+                100.0 * (before - smallest) / before)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
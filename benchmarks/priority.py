@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""Interactive latency under a mix of interactive and bulk calls.
+
+The backend is simulated with a virtual clock: interactive calls take
+5ms and bulk calls 200ms.  Bulk calls arrive fast enough to occupy every
+worker.  The same load is run through a plain FIFO limiter and through
+the priority scheduler of the servlet, and latency percentiles of the
+interactive calls are reported for both.
+"""
+
+import sys
+
+from zope.interface import implements
+from twisted.internet import task
+
+from xtwisted.gwt import gwttypes, rpc, limit, client
+from xtwisted.gwt.interface import RemoteInterface, priority, INTERACTIVE, BULK
+
+
+class IBenchService(RemoteInterface):
+    __remote_name__ = 'bench.PriorityService'
+
+    @priority(INTERACTIVE)
+    def autocomplete():
+        return gwttypes.strType()
+
+    @priority(BULK)
+    def export():
+        return gwttypes.strType()
+
+
+class BenchServlet(rpc._ServiceServlet):
+    implements(IBenchService)
+
+    def autocomplete(self):
+        return task.deferLater(self.clock, 0.005, lambda: u'a')
+
+    def export(self):
+        return task.deferLater(self.clock, 0.2, lambda: u'b')
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def simulate(scheduled, workers=10, duration=30.0):
+    clock = task.Clock()
+    servlet = BenchServlet()
+    servlet.clock = clock
+    if scheduled:
+        servlet.maxConcurrentCalls = workers
+        servlet.priorityBudgets = {BULK: workers - 2}
+        servlet.maxQueuedCalls = 1000
+        process = servlet.processRequest
+    else:
+        fifo = limit.ConcurrencyLimiter(workers, 100000, clock)
+        process = lambda body: fifo.run(servlet.processRequest, body)
+    latencies = {'autocomplete': [], 'export': []}
+    bodies = dict([(name, client.encodeCall(IBenchService, name, []))
+                   for name in latencies])
+
+    def call(name):
+        started = clock.seconds()
+        def done(result):
+            latencies[name].append(clock.seconds() - started)
+        process(bodies[name]).addBoth(done)
+
+    step = 0.001
+    for i in xrange(int(duration / step)):
+        if i % 10 == 0:
+            call('autocomplete')
+        if i % 20 == 0:
+            call('export')
+        clock.advance(step)
+    return latencies
+
+
+def main():
+    for scheduled, label in [(False, 'fifo'), (True, 'priority')]:
+        latencies = simulate(scheduled)
+        interactive = latencies['autocomplete']
+        print '%-9s interactive p50 %7.1fms p99 %7.1fms  bulk completed %d' % (
+            label, percentile(interactive, 50) * 1000,
+            percentile(interactive, 99) * 1000, len(latencies['export']))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
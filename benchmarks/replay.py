@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+"""Replay captured traffic through a servlet and report per-method
+throughput.
+
+Capture a sample of production traffic with
+
+    servlet.capture = capture.TrafficCapture('/var/tmp/service.capture', 0.01)
+
+and replay it offline, before and after a change:
+
+    python benchmarks/replay.py thing.service.ThingServlet \\
+        /var/tmp/service.capture /var/tmp/service.capture.1
+
+Requests are processed one at a time by processRequest, without HTTP.
+"""
+
+import sys
+
+from twisted.internet import task
+from twisted.python import usage, reflect
+
+from xtwisted.gwt import capture
+
+
+class Options(usage.Options):
+    synopsis = "[options] servlet capture..."
+
+    optParameters = [
+        ['repeat', 'r', 1, "Number of times to replay the capture.", int],
+        ]
+
+    def parseArgs(self, servlet, *paths):
+        if not paths:
+            raise usage.UsageError("no capture files given")
+        self['servlet'] = servlet
+        self['paths'] = paths
+
+
+def report(statistics):
+    print '%-50s %8s %8s %10s %8s' % ('method', 'calls', 'errors',
+                                      'calls/s', 'ms/call')
+    for key in sorted(statistics):
+        stats = statistics[key]
+        seconds = stats['seconds'] or 1e-9
+        print '%-50s %8d %8d %10.1f %8.3f' % (
+            '.'.join(key)[-50:], stats['calls'], stats['errors'],
+            stats['calls'] / seconds, seconds * 1000 / stats['calls'])
+
+
+def main(reactor, argv):
+    options = Options()
+    options.parseOptions(argv)
+    servlet = reflect.namedAny(options['servlet'])()
+    bodies = [record['body'] for path in options['paths']
+              for record in capture.readCapture(path)]
+    replayer = capture.Replayer(servlet)
+    d = replayer.replay(bodies * options['repeat'])
+    d.addCallback(report)
+    return d
+
+
+if __name__ == '__main__':
+    task.react(main, [sys.argv[1:]])
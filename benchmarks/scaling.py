@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+"""Throughput of the multi-process server for a growing number of workers.
+
+For each worker count a server is started with xtwisted.gwt.multiproc,
+and a number of client processes call a method whose response takes
+some CPU to serialize, over keep-alive connections, for a fixed time.
+Requests per second are reported for each worker count.  On a machine
+with several cores, throughput should grow with the number of workers
+until they run out.
+"""
+
+import os
+import sys
+import time
+import socket
+import httplib
+import subprocess
+import multiprocessing
+
+from zope.interface import implements
+
+from xtwisted.gwt import gwttypes
+from xtwisted.gwt.client import encodeCall
+from xtwisted.gwt.interface import RemoteInterface
+from xtwisted.gwt.web import ServiceServlet
+
+
+class IBenchService(RemoteInterface):
+    __remote_name__ = 'bench.ScalingService'
+
+    def getWords():
+        return gwttypes.ArrayListType()
+
+
+class BenchServlet(ServiceServlet):
+    implements(IBenchService)
+
+    words = [u'word%d' % i for i in range(500)]
+
+    def getWords(self):
+        return self.words
+
+
+def client(port, duration):
+    body = encodeCall(IBenchService, u'getWords', [])
+    headers = {'Content-Type': 'text/x-gwt-rpc; charset=utf-8'}
+    connection = httplib.HTTPConnection('127.0.0.1', port)
+    count = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        connection.request('POST', '/', body, headers)
+        response = connection.getresponse()
+        response.read()
+        assert response.status == 200, response.status
+        count += 1
+    return count
+
+
+def waitForPort(port, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start")
+
+
+def measure(workers, clients, duration, port):
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([here] + sys.path)
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'xtwisted.gwt.multiproc',
+         '--port', str(port), '--interface', '127.0.0.1',
+         '--workers', str(workers), 'scaling.BenchServlet'],
+        env=env, stderr=open(os.devnull, 'w'))
+    try:
+        waitForPort(port)
+        # let every worker get to accept connections.
+        time.sleep(1.0)
+        pool = multiprocessing.Pool(clients)
+        try:
+            counts = pool.map(_client, [(port, duration)] * clients)
+        finally:
+            pool.close()
+        return sum(counts) / duration
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def _client(args):
+    return client(*args)
+
+
+def main():
+    port = 18090
+    duration = 5.0
+    cpus = multiprocessing.cpu_count()
+    workerCounts = [n for n in (1, 2, 4, 8) if n <= max(cpus, 1)] or [1]
+    print 'cpus %d' % cpus
+    for workers in workerCounts:
+        rate = measure(workers, workers * 4, duration, port)
+        print 'workers %d  %8.1f requests/s' % (workers, rate)
+        port += 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
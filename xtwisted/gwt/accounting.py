@@ -0,0 +1,100 @@
+# accounting of payload sizes and memory use, by remote method
+
+import sys
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+# quantities that are accounted for each request.
+FIELDS = (
+    'requestTokens', 'requestStringBytes', 'requestObjects',
+    'responseTokens', 'responseStringBytes', 'responseObjects',
+    'responseBytes', 'peakMemory',
+    )
+
+
+# key of the requests that did not resolve to a remote method; the names
+# they carry come from clients, so they are not used as keys.
+UNKNOWN = (None, None)
+
+
+def isTracing():
+    """Return true if memory allocations are traced by tracemalloc.
+    """
+    return tracemalloc is not None and tracemalloc.is_tracing()
+
+
+def tracedMemory():
+    """Return the number of bytes currently allocated, as traced by
+    tracemalloc.
+    """
+    return tracemalloc.get_traced_memory()[0]
+
+
+def estimateSize(values):
+    """Return an estimate of the number of bytes held by values.
+    """
+    return sum(map(sys.getsizeof, values))
+
+
+class PayloadAccounting:
+    """Aggregate the sizes of requests and responses by method.
+
+    For each method the number of calls is counted, and the total and
+    the maximum of each quantity in L{FIELDS} are kept.
+    """
+
+    def __init__(self):
+        self.methods = dict()
+
+    def add(self, key, sample):
+        """Account for a request to the method identified by key.
+
+        @param sample: Dictionary that maps each name in L{FIELDS} to
+            its value for the request.
+        """
+        stats = self.methods.get(key)
+        if stats is None:
+            stats = self.methods[key] = {
+                'calls': 0,
+                'total': dict.fromkeys(FIELDS, 0),
+                'max': dict.fromkeys(FIELDS, 0),
+                }
+        stats['calls'] += 1
+        total, maximum = stats['total'], stats['max']
+        for field in FIELDS:
+            value = sample[field]
+            total[field] += value
+            if value > maximum[field]:
+                maximum[field] = value
+
+    def getStatistics(self):
+        """Return a dictionary that maps each method to its number of
+        C{calls}, and the C{total}, C{max} and C{mean} of each quantity.
+        """
+        statistics = dict()
+        for key, stats in self.methods.iteritems():
+            calls = stats['calls']
+            statistics[key] = {
+                'calls': calls,
+                'total': dict(stats['total']),
+                'max': dict(stats['max']),
+                'mean': dict([(field, stats['total'][field] / float(calls))
+                              for field in FIELDS]),
+                }
+        return statistics
+
+    def getLargest(self, field='responseBytes', count=10):
+        """Return the methods with the largest maximum of the given
+        quantity, as a list of (maximum, key) tuples in descending order.
+        """
+        largest = [(stats['max'][field], key)
+                   for (key, stats) in self.methods.iteritems()]
+        largest.sort(reverse=True)
+        return largest[:count]
+
+    def clear(self):
+        self.methods.clear()
@@ -21,6 +21,10 @@ TYPES_EXCLUDED_FROM_SIGNATURES = (
 
 JRE_SERIALIZER_PACKAGE = "com.google.gwt.user.client.rpc.core."
 
+# yielded by the deserializeSteps of a custom field serializer to have an
+# object of any type read.
+READ_OBJECT = object()
+
 
 class Type(object):
     """Base class for all types.
@@ -29,9 +33,26 @@ class Type(object):
 
     superType = None
 
+    # instances of cacheable types never change, so their serialized
+    # form can be reused by later responses.
+    cacheable = False
+
     def isPrimitive(self):
         return False
 
+    def getCacheKey(self, instance):
+        """Return the key that the serialized form of a cacheable instance
+        is stored under, or C{None} to key it by the identity of the
+        instance.
+        """
+        return None
+
+    def getSerializerKey(self):
+        """Return the key that the custom field serializer of the type is
+        cached under; types with the same key share one.
+        """
+        return self.__class__
+
     def getSignature(self, crc):
         """Return signature.
         """
@@ -49,6 +70,9 @@ class Type(object):
         return crc
 
 
+# maps instance classes to the type classes they were registered with.
+instanceTypes = {}
+
 def registerTypeAdapter(typeClass, instanceClass):
     """Associate a value class with an type.
 
@@ -58,6 +82,24 @@ def registerTypeAdapter(typeClass, instanceClass):
     def adapter(original):
         return typeClass()
     registerAdapter(adapter, instanceClass, igwt.IType)
+    instanceTypes[instanceClass] = typeClass
+
+
+def getValueType(value, declaredType=None):
+    """Return the type of value.
+
+    If value is a direct instance of the class registered for the
+    declared type, the declared type is returned as is.  Otherwise
+    (subclasses, other types) the type is looked up by adaptation.
+    Values that cannot be adapted, such as C{None} and instances of
+    classes that were never registered, are written as the declared
+    type, as they were before types of values were looked up.
+    """
+    if declaredType is None:
+        return igwt.IType(value)
+    if instanceTypes.get(type(value)) is declaredType.__class__:
+        return declaredType
+    return igwt.IType(value, declaredType)
 
 
 class Object(Type):
@@ -180,18 +222,18 @@ def getTypeSignature(typeInstance):
     return typeSignatureCache[typeClass]
 
 
+primitiveTypeCache = {}
+
 def isPrimitiveType(typeInstance):
     """Return true if the specified type is considered to be a primitive
     type.
     """
-    return (
-        isinstance(typeInstance, String) or
-        isinstance(typeInstance, Integer) or
-        isinstance(typeInstance, Long) or
-        isinstance(typeInstance, Short) or
-        isinstance(typeInstance, Boolean) or
-        isinstance(typeInstance, Double)
-        )
+    typeClass = typeInstance.__class__
+    if typeClass in primitiveTypeCache:
+        return primitiveTypeCache[typeClass]
+    primitiveTypeCache[typeClass] = isinstance(
+        typeInstance, (String, Integer, Long, Short, Boolean, Double))
+    return primitiveTypeCache[typeClass]
 
 
 class Array(Type):
@@ -201,6 +243,9 @@ class Array(Type):
     def __init__(self, compoundType):
         self.compoundType = compoundType
 
+    def getSerializerKey(self):
+        return (self.__class__, _getSerializerKey(self.compoundType))
+
     def getTypeName(self):
         """Return type name.
         """
@@ -299,6 +344,8 @@ def registerTypeProtocol(typeClass, protocol):
     registerTypeClass(typeClass)
 
 
+fieldPlanCache = {}
+
 class GenericFieldSerializer(CustomFieldSerializer):
     """The generic field serialzier is responsible for serializing objects
     using their type protocol.
@@ -325,6 +372,28 @@ class GenericFieldSerializer(CustomFieldSerializer):
             instanceType.__generic_fields__ = fields
         return instanceType.__generic_fields__
 
+    def getFieldPlan(self):
+        """Return a list of (fieldName, typeInstance) tuples for the
+        fields of the instance type and its super types, in the order
+        they are serialized.  Plans are kept by type class, as the types
+        of values are often built anew for each of them.
+        """
+        typeClass = self.instanceType.__class__
+        if typeClass in fieldPlanCache:
+            return fieldPlanCache[typeClass]
+        protocol = typeProtocolRegistry[self.instanceType.__class__]
+        if protocol is None:
+            raise error.MissingProtocol(self.instanceType.__class__)
+        plan = list()
+        instanceType = self.instanceType
+        while instanceType is not None:
+            fields = self.gatherSerializableFields(instanceType)
+            for fieldName in sorted(fields.keys()):
+                plan.append((fieldName, fields[fieldName]))
+            instanceType = instanceType.superType
+        fieldPlanCache[typeClass] = plan
+        return plan
+
     def getSignature(self, crc):
         protocol = typeProtocolRegistry[self.instanceType.__class__]
         if protocol is None:
@@ -337,21 +406,11 @@ class GenericFieldSerializer(CustomFieldSerializer):
         return crc
 
     def serialize(self, instance, writer):
-        protocol = typeProtocolRegistry[self.instanceType.__class__]
-        if protocol is None:
-            raise error.MissingProtocol(self.instanceType.__class__)
-        instanceType = self.instanceType
-        while instanceType is not None:
-            fields = self.gatherSerializableFields(instanceType)
-            #print "fields for ", instanceType,"is", fields
-            for fieldName in sorted(fields.keys()):
-                value = getattr(instance, fieldName)
-                # FIXME: check against fields typeInstance
-                #print "try to get type for", fieldName, value
-                typeInstance = igwt.IType(value, fields[fieldName])
-                #print "  got", typeInstance, "suggested was", fields[fieldName]
-                writer.serializeValue(value, typeInstance)
-            instanceType = instanceType.superType
+        for fieldName, fieldType in self.getFieldPlan():
+            value = getattr(instance, fieldName)
+            # FIXME: check against fields typeInstance
+            typeInstance = getValueType(value, fieldType)
+            writer.serializeValue(value, typeInstance)
         # done
 #         fields = self.gatherSerializableFields(self.instanceType, True)
 #         for fieldName in sorted(fields.keys()):
@@ -379,13 +438,39 @@ class GenericFieldSerializer(CustomFieldSerializer):
             instanceType = instanceType.superType
         return instance
 
+    def deserializeSteps(self, reader):
+        plan = self.getFieldPlan()
+        factory = igwt.IInstanceFactory(self.instanceType)
+        instance = factory.buildInstance()
+        yield instance
+        for fieldName, fieldType in plan:
+            value = yield fieldType
+            setattr(instance, fieldName, value)
+
+
+# maps the serializer key of each type to its custom field serializer.
+fieldSerializerCache = {}
+
+def _getSerializerKey(typeInstance):
+    if typeInstance is None:
+        return None
+    return typeInstance.getSerializerKey()
+
 
 def getCustomFieldSerializer(typeInstance):
     """Return a custom field serializer for the given type.
+
+    Serializers are cached by L{Type.getSerializerKey}, so each type is
+    only looked up once.
     """
+    key = typeInstance.getSerializerKey()
+    customSerializer = fieldSerializerCache.get(key)
+    if customSerializer is not None:
+        return customSerializer
     customSerializer = igwt.ICustomFieldSerializer(typeInstance, None)
     if customSerializer is None:
         customSerializer = GenericFieldSerializer(typeInstance)
+    fieldSerializerCache[key] = customSerializer
     return customSerializer
 
 
@@ -421,12 +506,19 @@ class ArrayCustomFieldSerializer(CustomFieldSerializer):
     def deserialize(self, reader):
         """Deserialize into an list of elements.
         """
-        count = reader.readInt()
+        count = reader.readLength()
         value = list()
         for c in range(count):
             value.append(reader.deserializeValue(self.compoundType))
         return value
 
+    def deserializeSteps(self, reader):
+        count = reader.readLength()
+        value = list()
+        yield value
+        for c in xrange(count):
+            value.append((yield self.compoundType))
+
     def serialize(self, value, writer):
         """Serialize into tokens.
         """
@@ -442,6 +534,16 @@ registerAdapter(
 
 
 class HashMap(Object):
+    """A map, optionally with declared types of its keys and values.
+    """
+
+    def __init__(self, keyType=None, valueType=None):
+        self.keyType = keyType
+        self.valueType = valueType
+
+    def getSerializerKey(self):
+        return (self.__class__, _getSerializerKey(self.keyType),
+                _getSerializerKey(self.valueType))
 
     def getTypeName(self):
         return 'java.util.HashMap'
@@ -454,10 +556,15 @@ class HashMapCustomFieldSerializer(CustomFieldSerializer):
         JRE_SERIALIZER_PACKAGE + 'java.util.HashMap_CustomFieldSerializer'
         )
 
+    def __init__(self, mapType):
+        self.mapType = mapType
+        self.keyType = mapType.keyType
+        self.valueType = mapType.valueType
+
     def deserialize(self, reader):
         """Deserialize into an list of elements.
         """
-        count = reader.readInt()
+        count = reader.readLength()
         value = dict()
         #print "count is", count
         for c in range(count):
@@ -467,26 +574,46 @@ class HashMapCustomFieldSerializer(CustomFieldSerializer):
             #print "got value", value[key]
         return value
 
+    def deserializeSteps(self, reader):
+        count = reader.readLength()
+        value = dict()
+        yield value
+        for c in xrange(count):
+            key = yield READ_OBJECT
+            value[key] = yield READ_OBJECT
+
     def serialize(self, value, writer):
         """Serialize into tokens.
         """
         writer.writeInt(len(value))
         #print "hashmap custsom: ", len(value)
+        keyType, valueType = self.keyType, self.valueType
         for key, subvalue in value.iteritems():
             #print "hashmap: write key", key
-            writer.writeObject(key)
+            if key is not None and keyType is not None:
+                writer.writeObject(key, getValueType(key, keyType))
+            else:
+                writer.writeObject(key)
             #print "hashmap: write value", subvalue
-            writer.writeObject(subvalue)
+            if subvalue is not None and valueType is not None:
+                writer.writeObject(subvalue, getValueType(subvalue, valueType))
+            else:
+                writer.writeObject(subvalue)
         # done
 
 registerCustomFieldSerializer(HashMapCustomFieldSerializer, HashMap)
 
 
 class ArrayList(Object):
-    
+    """A list, optionally with a declared type of its elements.
+    """
+
     def __init__(self, compoundType=None):
         self.compoundType = compoundType
 
+    def getSerializerKey(self):
+        return (self.__class__, _getSerializerKey(self.compoundType))
+
     def getTypeName(self):
         return 'java.util.ArrayList'
 
@@ -507,18 +634,24 @@ class ArrayListCustomFieldSerializer(CustomFieldSerializer):
     def deserialize(self, reader):
         """Deserialize into an list of elements.
         """
-        count = reader.readInt()
+        count = reader.readLength()
         value = list()
         for c in range(count):
             value.append(reader.readObject())
         return value
 
+    def deserializeSteps(self, reader):
+        count = reader.readLength()
+        value = list()
+        yield value
+        for c in xrange(count):
+            value.append((yield READ_OBJECT))
+
     def serialize(self, value, writer):
         """Serialize into tokens.
         """
         writer.writeInt(len(value))
-        for subvalue in value:
-            writer.writeObject(subvalue)
+        writer.writeObjectList(value, self.compoundType)
 
 registerCustomFieldSerializer(ArrayListCustomFieldSerializer, ArrayList)
 
@@ -593,6 +726,18 @@ class IntegerCustomFieldSerializer(_PrimitiveCustomFieldSerialzier):
 registerCustomFieldSerializer(IntegerCustomFieldSerializer, Integer)
 
 
+class LongCustomFieldSerializer(_PrimitiveCustomFieldSerialzier):
+    className = 'J'
+
+    def deserialize(self, reader):
+        return reader.readLong()
+
+    def serialize(self, value, writer):
+        writer.writeLong(value)
+
+registerCustomFieldSerializer(LongCustomFieldSerializer, Long)
+
+
 class StringCustomFieldSerializer(_PrimitiveCustomFieldSerialzier):
     className = 'java.lang.String'
     
@@ -619,24 +764,37 @@ registerCustomFieldSerializer(DoubleCustomFieldSerializer, Double)
 
 class AnnotationBuilder:
     """Annotation builder.
+
+    Signatures are verified once; the annotations of good ones are
+    cached, and so are the errors of bad ones (up to C{maxBadSignatures}
+    of them), so that clients of an old build do not cost a signature
+    computation per call.
     """
     
-    def __init__(self):
+    def __init__(self, maxBadSignatures=1000):
         self.annotationCache = {}
+        self.badSignatures = {}
+        self.maxBadSignatures = maxBadSignatures
 
-    def buildAnnotation(self, typeSignature):
+    def buildAnnotation(self, typeSignature, verify=True):
         """Build an annotation from a type signature.
+
+        If verify is false, a signature that has not been verified before
+        is not (and its annotation is not cached).
         """
         if typeSignature in self.annotationCache:
             return self.annotationCache[typeSignature]
+        if typeSignature in self.badSignatures:
+            raise error.BadSignature(*self.badSignatures[typeSignature])
         # we have to treat arrays in a special way.
         if typeSignature[0] == '[':
             if typeSignature[1] == 'L':
                 ref = SerializedInstanceReference(typeSignature[2:])
-                compoundType = self.buildAnnotation(ref.typeName[:-1])
+                compoundType = self.buildAnnotation(ref.typeName[:-1],
+                                                    verify)
             else:
                 ref = SerializedInstanceReference(typeSignature[1:])
-                compoundType = self.buildAnnotation(ref.typeName)
+                compoundType = self.buildAnnotation(ref.typeName, verify)
             typeInstance = Array(compoundType)
         else:
             ref = SerializedInstanceReference(typeSignature)
@@ -647,9 +805,13 @@ class AnnotationBuilder:
 
         if ref.typeName not in TYPES_EXCLUDED_FROM_SIGNATURES:
             if ref.signature is not None:
-                # FIXME: should we cache the signature?
+                if not verify:
+                    return typeInstance
                 signature = generateSignature(typeInstance)
                 if long(ref.signature) != signature:
+                    if len(self.badSignatures) < self.maxBadSignatures:
+                        self.badSignatures[typeSignature] = (
+                            long(ref.signature), signature)
                     raise error.BadSignature(
                         long(ref.signature), signature
                         )
@@ -690,22 +852,40 @@ class RuntimeExceptionType(Object):
 registerTypeProtocol(RuntimeExceptionType, IEmpty)
 
 
-def registerRuntimeException(instanceClass, className, protocol=None):
+def registerRuntimeException(instanceClass, className, protocol=None,
+                              cacheable=False):
     """Register the instance class as a runtime exception.
+
+    The serialized form of one exception of a cacheable class is reused
+    for all of them, so only classes without fields can be cacheable.
     """
+    if protocol is None:
+        protocol = IEmpty
+    if cacheable and list(protocol.names()):
+        raise ValueError("%s has fields and can not be cacheable"
+                         % (className,))
     class Type(Object):
         superType = RuntimeExceptionType()
         def getTypeName(self):
             return className
-    if protocol is None:
-        protocol = IEmpty
+        def getCacheKey(self, instance):
+            return ()
+    Type.cacheable = cacheable
     registerTypeProtocol(Type, protocol)
     registerTypeAdapter(Type, instanceClass)
+    # let clients deserialize the exception.
+    class InstanceFactory:
+        def __init__(self, typeInstance):
+            pass
+        def buildInstance(self):
+            return instanceClass()
+    registerAdapter(InstanceFactory, Type, igwt.IInstanceFactory)
 
 
 registerRuntimeException(
     error.IncompatibleRemoteServiceException, 
-    'com.google.gwt.user.client.rpc.IncompatibleRemoteServiceException'
+    'com.google.gwt.user.client.rpc.IncompatibleRemoteServiceException',
+    cacheable=True
 )
 
 # register some other errors:
@@ -731,3 +911,22 @@ registerRuntimeException(
     INoSuchMethodException
 )
 
+
+
+registerRuntimeException(
+    error.DeadlineExceeded,
+    'org.twisted.gwt.client.rpc.DeadlineExceededException',
+    cacheable=True
+)
+
+registerRuntimeException(
+    error.Overloaded,
+    'org.twisted.gwt.client.rpc.ServiceOverloadedException',
+    cacheable=True
+)
+
+registerRuntimeException(
+    error.LimitExceeded,
+    'org.twisted.gwt.client.rpc.LimitExceededException',
+    cacheable=True
+)
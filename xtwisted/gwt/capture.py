@@ -0,0 +1,129 @@
+# capture and replay of service traffic
+
+import os
+import json
+import time
+import random
+
+from twisted.internet import defer
+from twisted.python import logfile
+
+from xtwisted.gwt import rpc
+
+
+class TrafficCapture:
+    """Record a sample of the requests to a servlet in a rotating file.
+
+    Each record is written as a line of JSON with the raw body of the
+    request, the size of the response, the number of seconds it took to
+    process the request, and whether it succeeded (C{'OK'}), raised an
+    exception that was sent to the client (C{'EX'}) or failed
+    (C{'error'}).  Processes must not share a file.
+
+        servlet.capture = TrafficCapture('/var/tmp/service.capture', 0.01)
+
+    @ivar sampleRate: Fraction of the requests that are recorded.
+    """
+
+    def __init__(self, path, sampleRate=1.0, rotateLength=10000000,
+                 maxRotatedFiles=None):
+        directory, name = os.path.split(os.path.abspath(path))
+        self.logFile = logfile.LogFile(name, directory, rotateLength,
+                                       maxRotatedFiles=maxRotatedFiles)
+        self.sampleRate = sampleRate
+        self.recorded = 0
+
+    def sample(self):
+        """Return true if the next request should be recorded.
+        """
+        return random.random() < self.sampleRate
+
+    def record(self, body, responseSize, duration, status):
+        """Record a request.
+        """
+        self.logFile.write(json.dumps({
+            'time': time.time(), 'body': body.decode('utf-8'),
+            'responseSize': responseSize, 'duration': duration,
+            'status': status,
+            }) + '\n')
+        self.recorded += 1
+
+    def flush(self):
+        self.logFile.flush()
+
+    def close(self):
+        self.logFile.close()
+
+
+def readCapture(path):
+    """Iterate over the records of a capture file.
+
+    The body of each record is returned as an UTF-8 encoded string.
+    """
+    f = open(path)
+    try:
+        for line in f:
+            record = json.loads(line)
+            record['body'] = record['body'].encode('utf-8')
+            yield record
+    finally:
+        f.close()
+
+
+def getMethodName(body):
+    """Return the interface name and method name called by a request body.
+    """
+    tokens = body.decode('utf-8').split(rpc.SEPARATOR)
+    version, count = int(tokens[0]), int(tokens[2])
+    position = 3 + count
+    if version > 2:
+        # skip module base URL and strong name.
+        position += 2
+    interfaceIndex, methodIndex = tokens[position:position + 2]
+    return (tokens[2 + int(interfaceIndex)], tokens[2 + int(methodIndex)])
+
+
+# statistics key of bodies whose method can not be found.
+MALFORMED = (u'?', u'?')
+
+
+class Replayer:
+    """Feed captured requests to a servlet, one at a time, and collect
+    per-method statistics.
+
+    @ivar statistics: Dictionary that maps (interfaceName, methodName) to
+        a dictionary with the number of C{calls}, the number of calls
+        that resulted in C{errors}, and the total number of C{seconds}
+        they took.  Bodies that are too malformed to name a method are
+        counted as errors under L{MALFORMED}.
+    """
+
+    def __init__(self, servlet, clock=time.time):
+        self.servlet = servlet
+        self.clock = clock
+        self.statistics = dict()
+
+    @defer.inlineCallbacks
+    def replay(self, bodies):
+        """Replay request bodies.
+
+        Returns a deferred that fires with the statistics when all
+        requests have been processed.
+        """
+        for body in bodies:
+            key = MALFORMED
+            started = self.clock()
+            try:
+                key = getMethodName(body)
+                chunks = yield self.servlet.processRequest(body)
+                failed = not chunks[0].startswith('//OK')
+            except Exception:
+                failed = True
+            stats = self.statistics.get(key)
+            if stats is None:
+                stats = self.statistics[key] = {
+                    'calls': 0, 'errors': 0, 'seconds': 0.0}
+            stats['calls'] += 1
+            stats['errors'] += failed
+            stats['seconds'] += self.clock() - started
+        defer.returnValue(self.statistics)
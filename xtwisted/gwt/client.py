@@ -0,0 +1,273 @@
+# client side of GWT RPC, for tests and load generation
+
+import re
+
+from twisted.internet import defer
+
+from xtwisted.gwt import igwt, annotation, rpc, error
+
+
+# argument types of values that are not adaptable to IType.
+argumentTypes = {
+    bool: annotation.Boolean,
+    int: annotation.Integer,
+    long: annotation.Long,
+    float: annotation.Double,
+    }
+
+
+def getArgumentType(value):
+    """Return the type that value is sent as, when it is not given.
+    """
+    typeClass = argumentTypes.get(type(value))
+    if typeClass is not None:
+        return typeClass()
+    return igwt.IType(value)
+
+
+def getTypeSignature(typeInstance):
+    """Return the signature that a value of the given type is announced
+    with in a call.  Primitive types are announced by name only.
+    """
+    if typeInstance.isPrimitive():
+        return typeInstance.getTypeName()
+    return annotation.getTypeSignature(typeInstance)
+
+
+class CallWriter(rpc.Response):
+    """Writer of the body of a call.
+
+    Values are written just like the servlet writes them in responses,
+    but the tokens are laid out in the order a request is read in.
+    """
+
+    def __init__(self, version=5, flags=0):
+        rpc.Response.__init__(self, None)
+        self.version = version
+        self.flags = flags
+
+    def addString(self, strval):
+        if strval is not None and rpc.SEPARATOR in strval:
+            # the servlet does not unescape strings.
+            raise error.SerializationException(
+                "strings can not hold %r" % rpc.SEPARATOR)
+        return rpc.Response.addString(self, strval)
+
+    def _longToken(self, encoded):
+        # calls are not JavaScript; longs are sent as bare tokens.
+        return encoded
+
+    def writeCall(self, moduleBaseURL, strongName, interfaceName,
+                  methodName, argTypes, args):
+        """Write a call of a method with the given arguments.
+        """
+        if self.version > 2:
+            self.writeString(moduleBaseURL)
+            self.writeString(strongName)
+        self.writeString(interfaceName)
+        self.writeString(methodName)
+        self.writeInt(len(argTypes))
+        for typeInstance in argTypes:
+            self.writeString(getTypeSignature(typeInstance))
+        for value, typeInstance in zip(args, argTypes):
+            self.serializeValue(value, typeInstance)
+
+    def toString(self):
+        """Return the body of the call as a UTF-8 encoded string.
+        """
+        tokens = [unicode(self.version), unicode(self.flags),
+                  unicode(len(self.stringTable))]
+        tokens.extend(self.stringTable)
+        tokens.extend([token.decode('ascii') for token in self.tokenStream])
+        return (rpc.SEPARATOR.join(tokens) + rpc.SEPARATOR).encode('utf-8')
+
+
+_responseTokens = re.compile(
+    r"""\s*('(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*"|[\[\],]|[^\[\],\s]+)""")
+
+_unescapedChars = dict([(v, k) for (k, v) in rpc.escapedChars.iteritems()])
+
+_escapeSequence = re.compile(r"\\(x[0-9a-fA-F]{2}|u[0-9a-fA-F]{4}|.)")
+
+
+def _unescape(match):
+    sequence = match.group(1)
+    if len(sequence) > 1:
+        return unichr(int(sequence[1:], 16))
+    return _unescapedChars.get(sequence, sequence)
+
+
+def unescapeString(val):
+    """Return the value of a quoted JavaScript string literal.
+    """
+    return _escapeSequence.sub(_unescape, val[1:-1])
+
+
+def _parseArray(tokens, position):
+    # tokens[position] is the opening bracket.
+    elements = list()
+    position += 1
+    while True:
+        token = tokens[position]
+        if token == ']':
+            return elements, position + 1
+        if token == ',':
+            position += 1
+        elif token == '[':
+            element, position = _parseArray(tokens, position)
+            elements.append(element)
+        elif token[0] in '\'"':
+            elements.append(unescapeString(token))
+            position += 1
+        else:
+            elements.append(token)
+            position += 1
+
+
+def parseResponse(content):
+    """Parse the body of a response.
+
+    Returns a tuple of (ok, tokens, stringTable, flags, version), where
+    ok is false if the response carries an exception, and tokens are in
+    the order they are read.
+    """
+    content = content.decode('utf-8')
+    if content.startswith(u'//OK'):
+        ok = True
+    elif content.startswith(u'//EX'):
+        ok = False
+    else:
+        raise error.SerializationException("malformed response")
+    tokens = _responseTokens.findall(content, 4)
+    try:
+        elements, position = _parseArray(tokens, 0)
+    except IndexError:
+        raise error.SerializationException("truncated response")
+    payload, stringTable = elements[:-3], elements[-3]
+    flags, version = int(elements[-2]), int(elements[-1])
+    payload.reverse()
+    return ok, payload, stringTable, flags, version
+
+
+class ResponseReader(rpc.Request):
+    """Reader of the body of a response.
+    """
+
+    def __init__(self):
+        rpc.Request.__init__(self, None)
+
+    def prepareToRead(self, content):
+        (self.ok, tokens, stringTable,
+         self.flags, self.version) = parseResponse(content)
+        self.tokenStream = rpc.TokenStream(tokens)
+        for index, strval in enumerate(stringTable):
+            self.stringTable[index + 1] = strval
+
+    def readResult(self, returnType):
+        """Read the value returned by a method of the given return type.
+
+        Raises the exception that the method failed with.
+        """
+        if not self.ok:
+            raise self.readObject()
+        if isinstance(returnType, annotation.Void):
+            return None
+        if returnType.isPrimitive():
+            return self.deserializeValue(returnType)
+        # the servlet writes other values, strings too, as objects.
+        return self.readObject()
+
+
+def encodeCall(remoteInterface, methodName, args, argTypes=None,
+               moduleBaseURL=u'', strongName=u'', version=5, flags=0):
+    """Return the body of a call of a method of a remote interface.
+
+    Types of the arguments are derived from their values unless they are
+    given.
+    """
+    if argTypes is None:
+        argTypes = [getArgumentType(value) for value in args]
+    writer = CallWriter(version, flags)
+    writer.writeCall(moduleBaseURL, strongName,
+                     remoteInterface.__remote_name__, methodName,
+                     argTypes, args)
+    return writer.toString()
+
+
+def decodeResponse(content, returnType):
+    """Return the value carried by the body of a response, or raise the
+    exception it carries.
+    """
+    reader = ResponseReader()
+    reader.prepareToRead(content)
+    return reader.readResult(returnType)
+
+
+class ServiceProxy:
+    """Client of a remote interface provided by a servlet in the same
+    process.
+
+    Lets client-side behaviour be tested with Trial against a Python
+    servlet, without a compiled GWT frontend:
+
+        proxy = ServiceProxy(IThingService, ThingServlet())
+        d = proxy.callRemote('getThing', u'name')
+
+    Calls go through the same encoding and decoding as calls made by a
+    GWT client.
+    """
+    moduleBaseURL = u'http://localhost/'
+    strongName = u'PYTHON'
+    version = 5
+
+    def __init__(self, remoteInterface, servlet=None):
+        self.remoteInterface = remoteInterface
+        self.servlet = servlet
+
+    def encodeCall(self, methodName, args, argTypes=None):
+        """Return the body of a call of the given method.
+        """
+        # raises KeyError for methods that are not in the interface.
+        self.remoteInterface[methodName]
+        return encodeCall(self.remoteInterface, methodName, args, argTypes,
+                          self.moduleBaseURL, self.strongName, self.version)
+
+    def callRemote(self, methodName, *args, **kw):
+        """Call a remote method.
+
+        Returns a deferred that fires with the returned value, or fails
+        with the exception raised by the method.  The types of the
+        arguments may be given as a list with the keyword argument
+        argTypes.
+        """
+        try:
+            method = self.remoteInterface[methodName]
+            body = self.encodeCall(methodName, args, kw.get('argTypes'))
+        except Exception:
+            return defer.fail()
+        d = self.sendRequest(body)
+        d.addCallback(decodeResponse, method.returnTypeSignature)
+        return d
+
+    def sendRequest(self, body):
+        """Send the body of a call and return a deferred that fires with
+        the body of the response.
+        """
+        d = self.servlet.processRequest(body)
+        d.addCallback(''.join)
+        return d
+
+
+class HTTPServiceProxy(ServiceProxy):
+    """Client of a remote interface provided by a servlet at a URL.
+    """
+    contentType = "text/x-gwt-rpc; charset=utf-8"
+
+    def __init__(self, remoteInterface, url):
+        ServiceProxy.__init__(self, remoteInterface)
+        self.url = url
+
+    def sendRequest(self, body):
+        from twisted.web.client import getPage
+        return getPage(self.url, method='POST', postdata=body,
+                       headers={'Content-Type': self.contentType})
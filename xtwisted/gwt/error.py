@@ -8,6 +8,11 @@ class MissingSerializer(SerializationException):
     """
 
 
+class LimitExceeded(SerializationException):
+    """The request exceeds a limit of the servlet.
+    """
+
+
 class BadSignature(SerializationException):
     """Bad signature.
     """
@@ -18,6 +23,12 @@ class IncompatibleRemoteServiceException(Exception):
     """
 
 
+class UnsupportedProtocol(IncompatibleRemoteServiceException):
+    """The call was made in a protocol version, or with protocol flags,
+    that are not understood.
+    """
+
+
 class MissingProtocol(Exception):
     """Missing type protocol.
     """
@@ -27,7 +38,25 @@ class NoSuchInterface(Exception):
     """No such interface.
     """
 
+    def __init__(self, interfaceName=None):
+        Exception.__init__(self, interfaceName)
+        self.interfaceName = interfaceName
+
 
 class NoSuchMethod(Exception):
     """Bad method.
     """
+
+    def __init__(self, methodName=None):
+        Exception.__init__(self, methodName)
+        self.methodName = methodName
+
+
+class DeadlineExceeded(Exception):
+    """The method did not complete within its deadline.
+    """
+
+
+class Overloaded(Exception):
+    """The call was rejected because the service is overloaded.
+    """
@@ -0,0 +1,98 @@
+# results of remote methods that are futures or coroutines
+
+from twisted.internet import defer
+from twisted.python import failure, threadable
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+try:
+    from concurrent import futures as concurrent
+except ImportError:
+    concurrent = None
+
+
+# classes of the futures that remote methods may return
+futureTypes = ()
+if concurrent is not None:
+    futureTypes += (concurrent.Future,)
+if asyncio is not None:
+    futureTypes += (asyncio.Future,)
+
+
+def registerFutureType(futureType):
+    """Have instances of futureType, a class of futures with the interface
+    of asyncio futures, be treated as futures.
+    """
+    global futureTypes
+    if futureType not in futureTypes:
+        futureTypes += (futureType,)
+
+
+def isFuture(value):
+    """Return true if value is a future, that is an instance of
+    concurrent.futures.Future, asyncio.Future (where they can be imported)
+    or a class registered with L{registerFutureType}.
+    """
+    return isinstance(value, futureTypes)
+
+
+def isCoroutine(value):
+    """Return true if value is an asyncio (or trollius) coroutine.
+    """
+    return asyncio is not None and asyncio.iscoroutine(value)
+
+
+def _fire(d, future):
+    if d.called:
+        # cancelled
+        return
+    if future.cancelled():
+        d.errback(failure.Failure(defer.CancelledError()))
+        return
+    exception = future.exception()
+    if exception is not None:
+        d.errback(failure.Failure(exception))
+    else:
+        d.callback(future.result())
+
+
+def deferredFromFuture(future):
+    """Return a deferred that fires with the result of future.
+
+    Cancelling the deferred cancels the future.  The deferred is fired in
+    the thread that called this function, which must be the reactor
+    thread, also when the future completes in another thread.
+    """
+    def cancel(d):
+        future.cancel()
+    d = defer.Deferred(cancel)
+    threadID = threadable.getThreadID()
+    def done(future):
+        if threadable.getThreadID() == threadID:
+            _fire(d, future)
+        else:
+            from twisted.internet import reactor
+            reactor.callFromThread(_fire, d, future)
+    future.add_done_callback(done)
+    return d
+
+
+def toDeferred(result):
+    """Return a deferred for a future or a coroutine, and any other result
+    as it is.
+
+    Coroutines are scheduled with C{asyncio.ensure_future} on the current
+    event loop.  Twisted does not run that loop, so the application must
+    run it alongside the reactor, or the deferred never fires.
+    """
+    if isCoroutine(result):
+        result = asyncio.ensure_future(result)
+    if isFuture(result):
+        return deferredFromFuture(result)
+    return result
@@ -5,6 +5,7 @@ class IType(Interface):
     """Base class for types.
     """
     superType = Attribute("superType", "super type of type")
+    cacheable = Attribute("cacheable", "true if instances are immutable")
 
     def isPrimitive():
         """Return true if type is primtive.
@@ -35,6 +36,12 @@ class ICustomFieldSerializer(IType):
         """Deserialize value.
         """
 
+    # a custom field serializer may also provide deserializeSteps(reader),
+    # a generator that yields the new instance first, and then the type
+    # of each value that it wants read (or annotation.READ_OBJECT), which
+    # is sent back to it.  objects that are read this way can be nested
+    # to any depth.
+
 
 class IInstanceFactory(Interface):
     """Builder of instances.
@@ -90,6 +97,11 @@ class ITokenReader(Interface):
         """Read a string from the transport token stream.
         """
 
+    def readLength():
+        """Read the number of elements of a collection from the transport
+        token stream, and check it against the limits of the reader.
+        """
+
     def readObject():
         """Read any type of object specified by the type name.
         """
@@ -107,4 +119,9 @@ class ITokenWriter(Interface):
         """Write a string to the transport token stream.
         """
 
+    def writeObjectList(values, declaredType):
+        """Write the elements of a list to the transport token stream as
+        objects, each of its own type or else of the declared type.
+        """
+
 
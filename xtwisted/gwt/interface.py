@@ -67,14 +67,117 @@ RemoteInterface = RemoteInterfaceClass("RemoteInterface",
                                        __module__="zope.interface")
 
 
+def _remoteOption(name, value):
+    """Return a decorator that records an option on a remote method
+    declaration.  The option is picked up by L{RemoteMethod}.
+    """
+    def decorator(func):
+        options = func.__dict__.setdefault('__remote_options__', {})
+        options[name] = value
+        return func
+    return decorator
+
+
+def deadline(seconds):
+    """Declare that the remote method must complete within the given
+    number of seconds.  Calls that take longer are cancelled, and the
+    client is sent a DeadlineExceededException.
+
+        class IThingService(RemoteInterface):
+
+            @deadline(5)
+            def exportThings():
+                return gwttypes.ArrayListType()
+    """
+    return _remoteOption('deadline', seconds)
+
+
+def concurrency(limit, maxQueued=0, targetLatency=None):
+    """Declare that at most limit calls to the remote method may run
+    concurrently in a servlet, and that at most maxQueued calls may wait
+    for their turn.  Other calls are rejected with a
+    ServiceOverloadedException.
+
+    If targetLatency (in seconds) is given, the limit is adapted to the
+    observed latency of the method, and limit is used as the upper bound.
+    """
+    return _remoteOption('concurrency', (limit, maxQueued, targetLatency))
+
+
+def longPoll(timeout):
+    """Declare that the remote method is long-polled: it waits, usually on
+    an L{xtwisted.gwt.push.EventBus}, until there is something to send.
+    Calls that wait longer than timeout seconds are cancelled and
+    answered with null.
+
+        class IUpdateService(RemoteInterface):
+
+            @longPoll(30)
+            def getUpdate(topic):
+                return UpdateType()
+    """
+    return _remoteOption('longPoll', timeout)
+
+
+def deferredValues():
+    """Declare that results of the remote method may hold deferreds as
+    field values, list elements or map values.  The object graph of each
+    result is searched for them, and they are waited upon concurrently
+    before the result is written.  Results of other methods are written
+    as they are.
+
+        class IThingService(RemoteInterface):
+
+            @deferredValues()
+            def getThings():
+                return gwttypes.ArrayListType(ThingType())
+    """
+    return _remoteOption('deferredValues', True)
+
+
+# priority classes of remote methods; lower is more urgent.
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+
+
+def priority(level):
+    """Declare the priority class of the remote method, one of
+    INTERACTIVE, NORMAL (the default) and BULK.  Servlets that schedule
+    calls admit waiting calls of more urgent classes first, and may
+    give each class a budget of its own.
+    """
+    return _remoteOption('priority', level)
+
+
 class RemoteMethod:
     """Method that can be invoked from the client-side.
+
+    @ivar deadline: Number of seconds the method may run before it is
+        cancelled, or C{None}.
+
+    @ivar concurrency: Tuple of (limit, maxQueued, targetLatency) that
+        limits concurrent calls to the method, or C{None}.
+
+    @ivar priority: Priority class of the method.
+
+    @ivar longPoll: Number of seconds a long-polled method may wait, or
+        C{None}.
+
+    @ivar deferredValues: If true, deferreds held by results of the
+        method are resolved before the results are written.
     """
     
     def __init__(self, name, interface, func):
         self.name = name
         self.interface = interface
         self.func = func
+        options = getattr(func, '__remote_options__', {})
+        self.deadline = options.get('deadline')
+        self.concurrency = options.get('concurrency')
+        self.priority = options.get('priority', NORMAL)
+        self.longPoll = options.get('longPoll')
+        self.deferredValues = options.get('deferredValues', False)
         argcount = self.func.func_code.co_argcount
         self.returnTypeSignature = func(*([None] * argcount))
 
@@ -0,0 +1,266 @@
+# admission control for service servlets
+
+from collections import deque
+
+from twisted.internet import defer
+
+from xtwisted.gwt import error
+
+
+def _seconds(clock):
+    if clock is None:
+        from twisted.internet import reactor as clock
+    return clock.seconds()
+
+
+class ConcurrencyLimiter:
+    """Limit the number of calls that run concurrently.
+
+    Calls that can not run right away are queued, up to a bound.  Calls
+    that do not even fit in the queue are shed by raising
+    L{error.Overloaded}.
+
+    @ivar limit: Number of calls that may run concurrently.
+    @ivar maxQueued: Number of calls that may wait for admission.
+    @ivar active: Number of calls that are currently running.
+    @ivar accepted: Number of calls that have been admitted.
+    @ivar shed: Number of calls that have been rejected.
+    @ivar completed: Number of admitted calls that have completed.
+    """
+
+    def __init__(self, limit, maxQueued=0, clock=None):
+        self.limit = limit
+        self.maxQueued = maxQueued
+        self.clock = clock
+        self.waiting = deque()
+        self.active = 0
+        self.accepted = 0
+        self.shed = 0
+        self.completed = 0
+        self._dispatching = False
+
+    def seconds(self):
+        return _seconds(self.clock)
+
+    def acquire(self):
+        """Acquire a slot.
+
+        Returns a deferred that fires when the caller has been admitted.
+        The caller must call L{release} when done.  Raises
+        L{error.Overloaded} if the call can neither run nor be queued.
+        """
+        if self.active < self.limit:
+            self.active += 1
+            self.accepted += 1
+            return defer.succeed(self)
+        if len(self.waiting) >= self.maxQueued:
+            self.shed += 1
+            raise error.Overloaded()
+        d = defer.Deferred(self.waiting.remove)
+        self.waiting.append(d)
+        return d
+
+    def release(self, latency=None):
+        """Release a slot acquired with L{acquire}.
+
+        @param latency: Number of seconds the call took, if known.
+        """
+        self.active -= 1
+        self.completed += 1
+        self._dispatch()
+
+    def _dispatch(self):
+        # calls that complete right away release their slot from within
+        # the loop below; let the outermost loop admit the next call.
+        if self._dispatching:
+            return
+        self._dispatching = True
+        try:
+            while self.waiting and self.active < self.limit:
+                d = self.waiting.popleft()
+                self.active += 1
+                self.accepted += 1
+                d.callback(self)
+        finally:
+            self._dispatching = False
+
+    def run(self, f, *args, **kw):
+        """Run f once admitted, and release the slot when it is done.
+
+        Returns a deferred that fires with the result of f.  Raises
+        L{error.Overloaded} if the call is shed.
+        """
+        d = self.acquire()
+        d.addCallback(self._cbAdmitted, f, args, kw)
+        return d
+
+    def _cbAdmitted(self, ignored, f, args, kw):
+        started = self.seconds()
+        def done(result):
+            self.release(self.seconds() - started)
+            return result
+        return defer.maybeDeferred(f, *args, **kw).addBoth(done)
+
+    def getStatistics(self):
+        """Return a dictionary of counters, for monitoring.
+        """
+        return {
+            'limit': self.limit, 'active': self.active,
+            'queued': len(self.waiting), 'accepted': self.accepted,
+            'shed': self.shed, 'completed': self.completed,
+            }
+
+
+class AdaptiveConcurrencyLimiter(ConcurrencyLimiter):
+    """Concurrency limiter that adapts its limit to observed latency.
+
+    The limit grows by one for every C{limit} calls that complete within
+    the target latency, and is cut by C{backoff} when a call takes
+    longer (additive increase, multiplicative decrease).
+
+    @ivar targetLatency: Number of seconds a call is expected to take.
+    """
+    backoff = 0.9
+
+    def __init__(self, limit, maxQueued=0, clock=None, targetLatency=1.0,
+                 minLimit=1, maxLimit=None):
+        ConcurrencyLimiter.__init__(self, limit, maxQueued, clock)
+        self.targetLatency = targetLatency
+        self.minLimit = minLimit
+        if maxLimit is None:
+            maxLimit = limit
+        self.maxLimit = maxLimit
+        self._limit = float(limit)
+
+    def release(self, latency=None):
+        if latency is not None:
+            if latency > self.targetLatency:
+                self._limit = max(self.minLimit, self._limit * self.backoff)
+            else:
+                self._limit = min(self.maxLimit,
+                                  self._limit + 1.0 / self._limit)
+            self.limit = int(self._limit)
+        ConcurrencyLimiter.release(self, latency)
+
+
+def buildLimiter(limit, maxQueued=0, targetLatency=None, clock=None):
+    """Return a limiter, which is adaptive if targetLatency is given.
+    """
+    if targetLatency is None:
+        return ConcurrencyLimiter(limit, maxQueued, clock)
+    return AdaptiveConcurrencyLimiter(limit, maxQueued, clock,
+                                      targetLatency=targetLatency)
+
+
+class PriorityScheduler:
+    """Schedule calls of different priority classes onto a shared budget
+    of workers.
+
+    Each priority class has a queue of its own, and may be given a budget
+    of its own that caps how many of the workers it can occupy.  When a
+    worker becomes free the most urgent waiting call is admitted, so
+    calls of a low priority can not starve those of a higher priority.
+    Priorities are integers, where lower is more urgent.
+
+    @ivar limit: Number of calls that may run concurrently.
+    @ivar budgets: Dictionary that maps a priority to the number of
+        workers calls of that priority may occupy.
+    @ivar maxQueued: Number of calls that may wait in each queue.
+    """
+
+    def __init__(self, limit, budgets=None, maxQueued=0, clock=None):
+        self.limit = limit
+        self.budgets = budgets or {}
+        self.maxQueued = maxQueued
+        self.clock = clock
+        self.queues = dict()
+        self.active = dict()
+        self.accepted = dict()
+        self.shed = dict()
+        self.totalActive = 0
+        self._dispatching = False
+
+    def seconds(self):
+        return _seconds(self.clock)
+
+    def _canRun(self, priority):
+        budget = self.budgets.get(priority, self.limit)
+        return (self.totalActive < self.limit
+                and self.active.get(priority, 0) < budget)
+
+    def _admit(self, priority):
+        self.totalActive += 1
+        self.active[priority] = self.active.get(priority, 0) + 1
+        self.accepted[priority] = self.accepted.get(priority, 0) + 1
+
+    def acquire(self, priority):
+        """Acquire a worker for a call of the given priority.
+
+        Returns a deferred that fires when the caller has been admitted.
+        The caller must call L{release} when done.  Raises
+        L{error.Overloaded} if the queue of the priority is full.
+        """
+        queue = self.queues.get(priority)
+        if not queue and self._canRun(priority):
+            self._admit(priority)
+            return defer.succeed(self)
+        if queue is None:
+            queue = self.queues[priority] = deque()
+        if len(queue) >= self.maxQueued:
+            self.shed[priority] = self.shed.get(priority, 0) + 1
+            raise error.Overloaded()
+        d = defer.Deferred(queue.remove)
+        queue.append(d)
+        return d
+
+    def release(self, priority, latency=None):
+        """Release a worker acquired with L{acquire}.
+        """
+        self.totalActive -= 1
+        self.active[priority] -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        if self._dispatching:
+            return
+        self._dispatching = True
+        try:
+            for priority in sorted(self.queues):
+                queue = self.queues[priority]
+                while queue and self._canRun(priority):
+                    self._admit(priority)
+                    queue.popleft().callback(self)
+        finally:
+            self._dispatching = False
+
+    def run(self, priority, f, *args, **kw):
+        """Run f once admitted, and release the worker when it is done.
+
+        Returns a deferred that fires with the result of f.  Raises
+        L{error.Overloaded} if the call is shed.
+        """
+        d = self.acquire(priority)
+        d.addCallback(self._cbAdmitted, priority, f, args, kw)
+        return d
+
+    def _cbAdmitted(self, ignored, priority, f, args, kw):
+        started = self.seconds()
+        def done(result):
+            self.release(priority, self.seconds() - started)
+            return result
+        return defer.maybeDeferred(f, *args, **kw).addBoth(done)
+
+    def getStatistics(self):
+        """Return a dictionary that maps each priority to its counters.
+        """
+        statistics = dict()
+        for priority in set(self.accepted) | set(self.shed) | set(self.queues):
+            queue = self.queues.get(priority, ())
+            statistics[priority] = {
+                'budget': self.budgets.get(priority, self.limit),
+                'active': self.active.get(priority, 0),
+                'queued': len(queue),
+                'accepted': self.accepted.get(priority, 0),
+                'shed': self.shed.get(priority, 0),
+                }
+        return statistics
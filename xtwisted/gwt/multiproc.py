@@ -0,0 +1,244 @@
+"""
+Serve a service servlet from several worker processes that share one
+listening socket:
+
+    python -m xtwisted.gwt.multiproc --port 8080 --workers 4 \\
+        thing.service.ThingServlet
+
+The parent process binds the socket, starts the workers and restarts
+them when they exit.  Each worker imports and instantiates the servlet,
+warms it up, and then starts accepting connections on the inherited
+socket.  With --reuse-port, workers instead bind sockets of their own
+with SO_REUSEPORT, and let the kernel balance connections between them.
+"""
+
+import os
+import sys
+import socket
+
+from twisted.application import service
+from twisted.internet import protocol, defer
+from twisted.python import usage, reflect, log
+from twisted.web import server
+
+from xtwisted.gwt import annotation, error, web
+
+
+class Options(usage.Options):
+    synopsis = "[options] servlet"
+
+    optParameters = [
+        ['port', 'p', 8080, "Port to listen on.", int],
+        ['interface', 'i', '', "Interface to listen on."],
+        ['workers', 'w', None,
+         "Number of worker processes (default: number of CPUs).", int],
+        ['backlog', None, 50, "Size of the listen queue.", int],
+        ['fd', None, None, "Listening socket inherited by a worker.", int],
+        ]
+
+    optFlags = [
+        ['reuse-port', None,
+         "Let each worker bind its own socket with SO_REUSEPORT."],
+        ['worker', None, "Run as a worker process."],
+        ]
+
+    def parseArgs(self, servlet):
+        self['servlet'] = servlet
+
+    def postOptions(self):
+        if self['workers'] is None:
+            self['workers'] = cpuCount()
+
+
+def cpuCount():
+    """Return the number of processors, or 1 if it can not be told.
+    """
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+
+def listen(port, interface='', backlog=50, reusePort=False):
+    """Return a listening TCP socket.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reusePort:
+        # not all versions of the socket module know about the option.
+        SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def warmUp(resource):
+    """Prepare caches before a worker starts to accept connections.
+
+    Signatures of all registered types are computed, and the resource
+    is given a chance to warm up by calling its C{warmUp} method, if it
+    has one.
+    """
+    for typeClass in annotation.typeRegistry.values():
+        try:
+            annotation.getTypeSignature(typeClass())
+        except (error.MissingProtocol, error.MissingSerializer):
+            pass
+    warmUpResource = getattr(resource, 'warmUp', None)
+    if warmUpResource is not None:
+        warmUpResource()
+
+
+class WorkerProtocol(protocol.ProcessProtocol):
+    """Protocol for a worker process, that reports its end to the
+    supervisor.
+    """
+
+    def __init__(self, supervisor, number):
+        self.supervisor = supervisor
+        self.number = number
+        self.ended = defer.Deferred()
+
+    def processEnded(self, reason):
+        self.supervisor.workerEnded(self, reason)
+        self.ended.callback(None)
+
+
+class Supervisor(service.Service):
+    """Service that starts worker processes and restarts them when they
+    exit.
+
+    @ivar restartDelay: Number of seconds to wait before a worker that
+        exited is restarted.
+    """
+    restartDelay = 1.0
+
+    def __init__(self, servletName, port, interface='', workers=1,
+                 backlog=50, reusePort=False, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.servletName = servletName
+        self.port = port
+        self.interface = interface
+        self.workerCount = workers
+        self.backlog = backlog
+        self.reusePort = reusePort
+        self.socket = None
+        self.workers = dict()
+        self.restarts = 0
+
+    def startService(self):
+        service.Service.startService(self)
+        if not self.reusePort:
+            self.socket = listen(self.port, self.interface, self.backlog)
+        for number in range(self.workerCount):
+            self.startWorker(number)
+
+    def getWorkerArguments(self):
+        """Return the command line of a worker.
+        """
+        args = [sys.executable, '-m', 'xtwisted.gwt.multiproc', '--worker',
+                '--port', str(self.port), '--interface', self.interface,
+                '--backlog', str(self.backlog)]
+        if self.socket is not None:
+            args.extend(['--fd', '3'])
+        else:
+            args.append('--reuse-port')
+        args.append(self.servletName)
+        return args
+
+    def startWorker(self, number):
+        """Start worker process number.
+        """
+        childFDs = {0: 0, 1: 1, 2: 2}
+        if self.socket is not None:
+            childFDs[3] = self.socket.fileno()
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(sys.path)
+        worker = WorkerProtocol(self, number)
+        self.workers[number] = worker
+        self.reactor.spawnProcess(worker, sys.executable,
+                                  self.getWorkerArguments(),
+                                  env=env, childFDs=childFDs)
+
+    def workerEnded(self, worker, reason):
+        """Called when a worker process has exited.
+        """
+        del self.workers[worker.number]
+        if self.running:
+            log.msg("worker %d exited (%s), restarting"
+                    % (worker.number, reason.getErrorMessage()))
+            self.restarts += 1
+            self.reactor.callLater(self.restartDelay, self.startWorker,
+                                   worker.number)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        ended = list()
+        for worker in self.workers.values():
+            ended.append(worker.ended)
+            try:
+                worker.transport.signalProcess('TERM')
+            except Exception:
+                # the process is already gone.
+                pass
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        return defer.DeferredList(ended)
+
+
+def runWorker(options, reactor=None):
+    """Serve the servlet from this process.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    resource = reflect.namedAny(options['servlet'])()
+    warmUp(resource)
+    site = server.Site(resource)
+    site.requestFactory = web.ServiceRequest
+    if options['fd'] is not None:
+        fd = options['fd']
+    else:
+        sock = listen(options['port'], options['interface'],
+                      options['backlog'], reusePort=True)
+        fd = os.dup(sock.fileno())
+        sock.close()
+    reactor.adoptStreamPort(fd, socket.AF_INET, site)
+    # the reactor has a copy of the socket of its own.
+    os.close(fd)
+    reactor.run()
+
+
+def main(argv=None, reactor=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError, e:
+        print >>sys.stderr, '%s\n%s' % (options, e)
+        return 1
+    if reactor is None:
+        from twisted.internet import reactor
+    log.startLogging(sys.stderr)
+    if options['worker']:
+        runWorker(options, reactor)
+        return 0
+    supervisor = Supervisor(options['servlet'], options['port'],
+                            options['interface'], options['workers'],
+                            options['backlog'], options['reuse-port'],
+                            reactor)
+    reactor.callWhenRunning(supervisor.startService)
+    reactor.addSystemEventTrigger('before', 'shutdown',
+                                  supervisor.stopService)
+    reactor.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
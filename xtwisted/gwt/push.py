@@ -0,0 +1,55 @@
+# in-process events for long-polled remote methods
+
+from twisted.internet import defer
+
+from xtwisted.gwt import rpc
+
+
+class EventBus:
+    """Publish events to the calls that wait for them.
+
+    Long-polled methods (see L{interface.longPoll}) return the deferred
+    of L{wait}, which fires with the next event published to the topic.
+    All calls woken up by one publish share its serialized body (see
+    L{rpc.shareResult}).
+
+    @ivar waiting: Dictionary that maps each topic to the list of
+        deferreds that wait for its next event.
+    """
+
+    def __init__(self):
+        self.waiting = dict()
+
+    def wait(self, topic):
+        """Return a deferred that fires with the next event published to
+        topic.  Cancelling the deferred stops the wait.
+        """
+        def cancel(d):
+            waiting = self.waiting.get(topic)
+            if waiting is not None and d in waiting:
+                waiting.remove(d)
+                if not waiting:
+                    del self.waiting[topic]
+        d = defer.Deferred(cancel)
+        self.waiting.setdefault(topic, []).append(d)
+        return d
+
+    def publish(self, topic, event):
+        """Hand event to everyone that waits on topic, and return their
+        number.
+        """
+        waiting = self.waiting.pop(topic, ())
+        if waiting:
+            rpc.shareResult(event, self._fire, waiting, event)
+        return len(waiting)
+
+    def _fire(self, waiting, event):
+        for d in waiting:
+            d.callback(event)
+
+    def getWaitingCount(self, topic=None):
+        """Return the number of calls that wait on topic, or on any topic.
+        """
+        if topic is not None:
+            return len(self.waiting.get(topic, ()))
+        return sum(map(len, self.waiting.itervalues()))
@@ -2,14 +2,98 @@ from twisted.python import reflect, failure, components, log
 from twisted.internet import defer
 from zope.interface import implements, Interface
 
-from xtwisted.gwt import igwt, annotation, util, error
+from xtwisted.gwt import igwt, annotation, util, error, limit, accounting
+from xtwisted.gwt import futures
 from xtwisted.gwt.interface import remoteInterfaceRegistry
+from functools import partial
+from operator import attrgetter
+from collections import OrderedDict
 import time
+import random
 
 
 SEPARATOR = u'|'
 
 
+# protocol versions.  Versions up to 2 send no module base URL and
+# strong name, and versions before BASE64_LONG_VERSION send longs as
+# pairs of doubles rather than base-64 strings.  Versions after
+# MAX_VERSION are not understood.
+DEFAULT_VERSION = 5
+BASE64_LONG_VERSION = 6
+MAX_VERSION = 7
+
+# flags that are understood; neither elided type names nor RPC tokens
+# are supported.
+SUPPORTED_FLAGS = 0
+
+BASE64_DIGITS = ('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+                 '0123456789$_')
+
+_base64Values = dict([(c, i) for (i, c) in enumerate(BASE64_DIGITS)])
+
+
+def longToBase64(value):
+    """Return the base-64 encoding of a signed 64-bit long, without
+    leading zero digits.
+    """
+    value = long(value) & 0xffffffffffffffffL
+    digits = []
+    while True:
+        digits.append(BASE64_DIGITS[value & 0x3f])
+        value >>= 6
+        if not value:
+            break
+    digits.reverse()
+    return ''.join(digits)
+
+
+def longFromBase64(encoded):
+    """Return the signed 64-bit long of a base-64 encoding.
+    """
+    # 11 digits hold 66 bits.
+    if not encoded or len(encoded) > 11:
+        raise error.SerializationException("bad long %r" % encoded)
+    value = 0L
+    try:
+        for c in encoded:
+            value = (value << 6) | _base64Values[c]
+    except KeyError:
+        raise error.SerializationException("bad long %r" % encoded)
+    if value > 0xffffffffffffffffL:
+        raise error.SerializationException("bad long %r" % encoded)
+    if value & 0x8000000000000000L:
+        value -= 0x10000000000000000L
+    return value
+
+
+INFINITY = float('inf')
+
+
+def formatDouble(value):
+    """Return the shortest token that reads back as the double value.
+
+    Integral values are written without a fraction, and with an exponent
+    if that is shorter.  Values that are not finite are written as
+    JavaScript writes them.
+    """
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    if value in (INFINITY, -INFINITY):
+        return value > 0 and 'Infinity' or '-Infinity'
+    # repr is the shortest string that reads back as the same double.
+    mantissa, e, exponent = repr(value).partition('e')
+    if mantissa.endswith('.0'):
+        mantissa = mantissa[:-2]
+    if exponent:
+        return '%se%d' % (mantissa, int(exponent))
+    zeros = len(mantissa) - len(mantissa.rstrip('0'))
+    if zeros > 2:
+        return '%se%d' % (mantissa[:-zeros], zeros)
+    return mantissa
+
+
 JS_ESCAPE_CHAR = '\\'
 JS_QUOTE_CHAR = '\''
 escapedChars = {
@@ -59,22 +143,373 @@ def escapeString(val):
 
 class TokenStream(list):
 
+    position = 0
+
     def next(self):
         """Return next token.
         """
-        return self.pop(0)
+        token = self[self.position]
+        self.position += 1
+        return token
+
+    def available(self):
+        """Return the number of tokens that have not been read.
+        """
+        return len(self) - self.position
+
+
+class IncrementalParser:
+    """Parser for the body of a request that is fed while the body
+    arrives.
+
+    The body is split into tokens as it is fed, and the header and the
+    string table are parsed as soon as their tokens are available.  The
+    separator is ASCII, so it never occurs within an encoded character
+    and each token can be decoded on its own.
+
+    @ivar tokenStream: Tokens parsed so far.
+    @ivar version: Protocol version, or C{None} if not yet parsed.
+    @ivar flags: Protocol flags.
+    @ivar stringTable: Table of strings, indexed by a 1-based integer.
+    @ivar size: Number of bytes fed.
+    @ivar error: Failure that stopped parsing, or C{None}.
+    @ivar maxSize: Number of bytes the body may hold, or C{None}.
+    @ivar maxTokens: Number of separators the body may hold, or C{None}.
+    @ivar maxStrings: Number of strings the string table may hold, or
+        C{None}.
+    """
+    byteSeparator = SEPARATOR.encode('ascii')
+
+    def __init__(self, maxSize=None, maxTokens=None, maxStrings=None):
+        self.tokenStream = TokenStream()
+        self.stringTable = dict()
+        self.version = self.flags = self.stringCount = None
+        self.maxSize = maxSize
+        self.maxTokens = maxTokens
+        self.maxStrings = maxStrings
+        self.size = 0
+        self.separators = 0
+        self.error = None
+        self.finished = False
+        self._partial = []
+
+    def feed(self, data):
+        """Feed a chunk of the body to the parser.
+
+        Errors are not raised, but recorded in C{error}.  Bodies that
+        exceed a limit are discarded as soon as that is known, before
+        more of them is decoded.
+        """
+        self.size += len(data)
+        if self.error is not None:
+            return
+        if self.maxSize is not None and self.size > self.maxSize:
+            self.abort(error.LimitExceeded("body is too large"))
+            return
+        parts = data.split(self.byteSeparator)
+        self.separators += len(parts) - 1
+        if self.maxTokens is not None and self.separators > self.maxTokens:
+            self.abort(error.LimitExceeded(
+                "tokens exceeds %d" % (self.maxTokens,)))
+            return
+        if len(parts) == 1:
+            self._partial.append(data)
+            return
+        if self._partial:
+            self._partial.append(parts[0])
+            parts[0] = ''.join(self._partial)
+        self._partial = [parts.pop()]
+        try:
+            self.tokenStream.extend([part.decode('utf-8') for part in parts])
+            self._advance()
+        except Exception:
+            self.error = failure.Failure()
+
+    def finish(self):
+        """Signal that the whole body has been fed.
+        """
+        if self.finished:
+            return
+        self.finished = True
+        if self.error is not None:
+            return
+        try:
+            self.tokenStream.append(''.join(self._partial).decode('utf-8'))
+            self._advance()
+        except Exception:
+            self.error = failure.Failure()
+        self._partial = None
+
+    def abort(self, reason):
+        """Stop parsing, and drop what has been parsed.
+        """
+        self.error = failure.Failure(reason)
+        self.tokenStream = TokenStream()
+        self.stringTable = dict()
+        self._partial = []
+
+    def _advance(self):
+        tokenStream = self.tokenStream
+        if self.stringCount is None:
+            if tokenStream.available() < 3:
+                return
+            self.version = int(tokenStream.next())
+            self.flags = int(tokenStream.next())
+            self.stringCount = int(tokenStream.next())
+            if (self.maxStrings is not None
+                and self.stringCount > self.maxStrings):
+                self.abort(error.LimitExceeded(
+                    "strings exceeds %d" % (self.maxStrings,)))
+                return
+        stringTable = self.stringTable
+        count = min(self.stringCount - len(stringTable),
+                    tokenStream.available())
+        for i in range(count):
+            stringTable[len(stringTable) + 1] = tokenStream.next()
+
+    def isComplete(self):
+        """Return true if the header and the string table are parsed.
+        """
+        return (self.stringCount is not None
+                and len(self.stringTable) == self.stringCount)
+
+    def getBody(self):
+        """Return the body that was fed to the parser, once finished.
+        """
+        return SEPARATOR.join(self.tokenStream).encode('utf-8')
+
+
+# values that never hold references to other values, and therefore
+# never has to be searched for deferreds.
+ATOMIC_TYPES = (basestring, int, long, float, bool)
+
+
+def _serializableFieldNames(instance):
+    """Return names of the fields that will be serialized for instance.
+
+    Only instances that are serialized by the generic field serializer
+    have fields.
+    """
+    typeInstance = igwt.IType(instance, None)
+    if typeInstance is None:
+        return ()
+    if typeInstance.cacheable and (instance, typeInstance) in fragmentCache:
+        # already serialized, so it holds no deferreds.
+        return ()
+    serializer = annotation.getCustomFieldSerializer(typeInstance)
+    if not isinstance(serializer, annotation.GenericFieldSerializer):
+        return ()
+    names = list()
+    while typeInstance is not None:
+        names.extend(serializer.gatherSerializableFields(typeInstance))
+        typeInstance = typeInstance.superType
+    return names
+
+
+def _findDeferreds(value):
+    """Search the object graph rooted at value for deferreds.
+
+    Returns a list of (setter, key, deferred) tuples, where
+    C{setter(key, result)} replaces the deferred with its result.
+    """
+    found = list()
+    seen = set()
+    stack = [value]
+    while stack:
+        value = stack.pop()
+        if value is None or isinstance(value, ATOMIC_TYPES):
+            continue
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        if isinstance(value, dict):
+            items = value.iteritems()
+            setter = value.__setitem__
+        elif isinstance(value, list):
+            items = enumerate(value)
+            setter = value.__setitem__
+        else:
+            items = [(fieldName, getattr(value, fieldName, None))
+                     for fieldName in _serializableFieldNames(value)]
+            setter = partial(setattr, value)
+        for key, subvalue in items:
+            if isinstance(subvalue, defer.Deferred):
+                found.append((setter, key, subvalue))
+            else:
+                stack.append(subvalue)
+    return found
+
+
+def _cbResolved(result, setter, key):
+    setter(key, result)
+    # the result may in turn hold deferreds
+    return resolveDeferreds(result)
+
+
+def _ebResolve(reason):
+    reason.trap(defer.FirstError)
+    return reason.value.subFailure
+
+
+def resolveDeferreds(value):
+    """Resolve all deferreds in the object graph rooted at value.
+
+    Deferreds may be used as field values, list elements and map values.
+    They are waited upon concurrently, and replaced in place by their
+    results.  Returns a deferred that fires with value when the graph is
+    free of deferreds, or fails with the first failure encountered.
+    """
+    found = _findDeferreds(value)
+    if not found:
+        return defer.succeed(value)
+    pending = [d.addCallback(_cbResolved, setter, key)
+               for (setter, key, d) in found]
+    def cancel(d):
+        for p in pending:
+            p.cancel()
+    resolved = defer.Deferred(cancel)
+    dl = defer.DeferredList(pending, fireOnOneErrback=True,
+                            consumeErrors=True)
+    dl.addCallbacks(lambda ignore: value, _ebResolve)
+    dl.chainDeferred(resolved)
+    return resolved
+
+
+def asDeferred(result):
+    """Return result, which is either ready or a deferred, as a deferred.
+    """
+    if isinstance(result, defer.Deferred):
+        return result
+    if isinstance(result, failure.Failure):
+        return defer.fail(result)
+    return defer.succeed(result)
+
+
+class Fragment:
+    """Serialized form of an instance, that can be spliced into responses.
+
+    @ivar tokens: Tokens of the instance, in the order they are written.
+    @ivar strings: Strings referenced by the tokens.
+    @ivar stringRefs: Positions of the tokens that are 1-based indices
+        into C{strings}.
+    @ivar objects: Objects that were serialized.
+    """
+
+    def __init__(self, tokens, strings, stringRefs, objects):
+        self.tokens = tokens
+        self.strings = strings
+        self.stringRefs = stringRefs
+        self.objects = objects
+
+
+class FragmentCache:
+    """Cache of serialized instances of cacheable types.
+
+    Each entry holds the fragments of an instance for the protocol
+    versions it has been serialized for.  Entries are evicted in least
+    recently used order when there are more than C{maxSize} of them.
+    """
+
+    def __init__(self, maxSize=10000):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, instance, typeInstance):
+        key = typeInstance.getCacheKey(instance)
+        if key is None:
+            key = (typeInstance.__class__, id(instance))
+            entry = self.entries.get(key)
+            # identities are reused once an instance is gone, so check
+            # that the entry is for this very instance.
+            if entry is not None and entry[0] is not instance:
+                entry = None
+        else:
+            key = (typeInstance.__class__, key)
+            entry = self.entries.get(key)
+        return key, entry
+
+    def __contains__(self, item):
+        instance, typeInstance = item
+        return self._lookup(instance, typeInstance)[1] is not None
+
+    def get(self, instance, typeInstance, version=DEFAULT_VERSION):
+        """Return the cached fragment for instance in the given protocol
+        version, or C{None}.
+        """
+        key, entry = self._lookup(instance, typeInstance)
+        if entry is None or version not in entry[1]:
+            self.misses += 1
+            return None
+        # move the entry to the end, as the most recently used
+        del self.entries[key]
+        self.entries[key] = entry
+        self.hits += 1
+        return entry[1][version]
+
+    def put(self, instance, typeInstance, fragment,
+            version=DEFAULT_VERSION):
+        """Cache the fragment of instance in the given protocol version.
+        """
+        key, entry = self._lookup(instance, typeInstance)
+        self.entries.pop(key, None)
+        if entry is None:
+            entry = (instance, dict())
+        entry[1][version] = fragment
+        self.entries[key] = entry
+        while len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+
+fragmentCache = FragmentCache()
+
+
+class _StringToken(str):
+    """A token that is an index into the string table.
+    """
 
 
 class Response:
     """Response.
+
+    @ivar stringTableSize: Number of bytes of the written string table.
+
+    @ivar compact: If true, the string table is ordered by the number of
+        references to each string when the response is written, so that
+        the strings used most get the shortest indices.
+
+    @cvar minBatchSize: Number of elements a list of instances of one
+        class must hold to be written in one pass; see
+        L{writeObjectList}.
+
+    @cvar recursionDepth: Number of levels of objects that serializers
+        write by recursion, below each object that the explicit stack of
+        L{writeObject} writes.
     """
     implements(igwt.ITokenWriter)
 
+    stringTableSize = 0
+    compact = False
+    minBatchSize = 8
+    recursionDepth = 20
+    version = DEFAULT_VERSION
+    flags = 0
+    _writing = False
+    _markers = None
+    _depth = 0
+
     def __init__(self, servlet):
         self.tokenStream = list()
         self.objectDatabase = list()
         self.stringTable = list()
+        self._stringIndices = dict()
         self.servlet = servlet
+        if getattr(servlet, 'compactPayloads', False):
+            self.compact = True
 
     def serializeValue(self, value, typeInstance):
         """Serialize value.
@@ -96,24 +531,244 @@ class Response:
         if instance is None:
             self.writeString(None)
             return 
+        if self._writing:
+            # called by a serializer.  shallow objects are written right
+            # away; deeper ones are left for the engine to write once the
+            # tokens before them have been emitted.
+            if self._depth < self.recursionDepth:
+                self._depth += 1
+                self._writeObject1(instance, typeInstance)
+                self._depth -= 1
+                return
+            self._markers.append(len(self.tokenStream))
+            self.tokenStream.append((instance, typeInstance))
+            return
+        output = self.tokenStream
+        self._writing = True
+        try:
+            self._writeObjects(output, instance, typeInstance)
+        finally:
+            self.tokenStream = output
+            self._markers = None
+            self._depth = 0
+            self._writing = False
+
+    def writeObjectList(self, values, declaredType=None):
+        """Write the elements of a list as objects.
+
+        Lists of instances of one class, that are written by the generic
+        field serializer, are written in one pass: the type, signature
+        and fields are resolved once, and the tokens of each field are
+        written for all elements at a time.
+        """
+        if (self._writing and len(values) >= self.minBatchSize
+                and self._writeBatch(values, declaredType)):
+            return
+        for value in values:
+            if value is None or declaredType is None:
+                self.writeObject(value)
+            else:
+                self.writeObject(value,
+                                 annotation.getValueType(value, declaredType))
+
+    def _writeBatch(self, values, declaredType):
+        """Write a list of instances of one class, and return true, or
+        return false if the list can not be written in one pass.
+        """
+        getClass = attrgetter('__class__')
+        if len(set(map(getClass, values))) != 1:
+            return False
+        if declaredType is None:
+            typeInstance = igwt.IType(values[0], None)
+        else:
+            typeInstance = annotation.getValueType(values[0], declaredType)
+        if typeInstance is None or typeInstance.cacheable:
+            return False
+        serializer = annotation.getCustomFieldSerializer(typeInstance)
+        if serializer.__class__ is not annotation.GenericFieldSerializer:
+            return False
+        count = len(values)
+        # strings and objects added by fields are taken back if the list
+        # turns out not to fit in one pass.
+        stringCount = len(self.stringTable)
+        objectCount = len(self.objectDatabase)
+        signature = self._stringToken(
+            self.addString(annotation.getTypeSignature(typeInstance)))
+        columns = list()
+        rowWidth = 1
+        hasObjects = False
+        for fieldName, fieldType in serializer.getFieldPlan():
+            tokens, width, columnHasObjects = self._columnTokens(
+                map(attrgetter(fieldName), values), fieldType)
+            if width is None:
+                self._truncate(stringCount, objectCount)
+                return False
+            hasObjects = hasObjects or columnHasObjects
+            columns.append((tokens, width))
+            rowWidth += width
+        rows = [None] * (count * rowWidth)
+        rows[0::rowWidth] = [signature] * count
+        offset = 1
+        for tokens, width in columns:
+            for index in xrange(width):
+                rows[offset + index::rowWidth] = tokens[index::width]
+            offset += width
+        self.objectDatabase.extend(values)
+        if hasObjects:
+            base = len(self.tokenStream)
+            self._markers.extend([base + position
+                                  for (position, token) in enumerate(rows)
+                                  if type(token) is tuple])
+        self.tokenStream.extend(rows)
+        return True
+
+    def _truncate(self, stringCount, objectCount):
+        """Forget the strings and objects added after the string table and
+        the object database held the given numbers of them.
+        """
+        for strval in self.stringTable[stringCount:]:
+            del self._stringIndices[strval]
+        del self.stringTable[stringCount:]
+        del self.objectDatabase[objectCount:]
+
+    def _columnTokens(self, column, declaredType):
+        """Return the tokens of the values of a field of several
+        instances, the number of tokens of each value (or C{None} if
+        values differ in that), and whether objects are left among them.
+        """
+        # the type of a value depends on its class only.
+        samples = dict(zip(map(attrgetter('__class__'), column),
+                           column)).values()
+        typeInstances = [annotation.getValueType(value, declaredType)
+                         for value in samples]
+        sameType = not [t for t in typeInstances if t is not declaredType]
+        typeClass = declaredType.__class__
+        if sameType and typeClass is annotation.Integer:
+            return map(str, map(long, column)), 1, False
+        if sameType and typeClass is annotation.Double:
+            return map(formatDouble, column), 1, False
+        if sameType and typeClass is annotation.String:
+            stringToken, addString = self._stringToken, self.addString
+            return ([stringToken(addString(value)) for value in column],
+                    1, False)
+        output, markers = self.tokenStream, self._markers
+        self.tokenStream, self._markers = tokens, columnMarkers = [], []
+        widths = set()
+        try:
+            for value in column:
+                written = len(tokens)
+                if sameType:
+                    self.serializeValue(value, declaredType)
+                else:
+                    self.serializeValue(
+                        value, annotation.getValueType(value, declaredType))
+                widths.add(len(tokens) - written)
+        finally:
+            self.tokenStream, self._markers = output, markers
+        # the columns are interleaved by position, so every value must be
+        # written as the same number of tokens.
+        if len(widths) != 1:
+            return tokens, None, False
+        return tokens, widths.pop(), bool(columnMarkers)
+
+    def _writeObjects(self, output, instance, typeInstance):
+        """Write instance, and the objects it refers to, to output.
+
+        Objects are written depth first with an explicit stack, so graphs
+        of any depth can be written.  While an object is serialized the
+        token stream is a list of its own, where the objects it refers to
+        are written in place up to C{recursionDepth} levels down, and
+        deeper ones are left as (instance, typeInstance) tuples at the
+        positions noted in C{_markers}.  The tokens up to each tuple are
+        then emitted to output, followed by those of its object.
+        """
+        extend = output.extend
+        writeObject1 = self._writeObject1
+        stack = list()
+        tokens, markers, start = [(instance, typeInstance)], [0], 0
+        while True:
+            if not markers:
+                extend(tokens[start:])
+                if not stack:
+                    return
+                tokens, markers, start = stack.pop()
+                continue
+            # markers are kept last to first.
+            position = markers.pop()
+            if position > start:
+                extend(tokens[start:position])
+            start = position + 1
+            instance, typeInstance = tokens[position]
+            self.tokenStream = nested = []
+            self._markers = nestedMarkers = []
+            self._depth = 0
+            writeObject1(instance, typeInstance)
+            if not nestedMarkers:
+                extend(nested)
+                continue
+            nestedMarkers.reverse()
+            stack.append((tokens, markers, start))
+            tokens, markers, start = nested, nestedMarkers, 0
+
+    def _writeObject1(self, instance, typeInstance):
+        """Write a single instance to the token stream.
+        """
         if typeInstance is None:
             typeInstance = igwt.IType(instance)
         #if instance in self.objectDatabase:
         #    self.writeInt(self.objectDatabase.index(instance))
         #    return
+        if typeInstance.cacheable:
+            self.writeCachedObject(instance, typeInstance)
+            return
         self.objectDatabase.append(instance)
         self.writeString(annotation.getTypeSignature(typeInstance))
         self.serialize(instance, typeInstance)
-        
+
+    def writeCachedObject(self, instance, typeInstance):
+        """Write an instance of a cacheable type, reusing its serialized
+        form if it is in the fragment cache.
+        """
+        fragment = fragmentCache.get(instance, typeInstance, self.version)
+        if fragment is None:
+            recorder = _FragmentRecorder(self.servlet)
+            recorder.version = self.version
+            recorder.objectDatabase.append(instance)
+            recorder.writeString(annotation.getTypeSignature(typeInstance))
+            recorder.serialize(instance, typeInstance)
+            fragment = recorder.getFragment()
+            fragmentCache.put(instance, typeInstance, fragment, self.version)
+        self.writeFragment(fragment)
+
+    def writeFragment(self, fragment):
+        """Splice a serialized fragment into the token stream, mapping its
+        string indices to indices of the string table of the response.
+        """
+        tokens = list(fragment.tokens)
+        strings = fragment.strings
+        for position in fragment.stringRefs:
+            index = int(tokens[position])
+            if index != 0:
+                index = self.addString(strings[index - 1])
+            tokens[position] = self._stringToken(index)
+        self.tokenStream.extend(tokens)
+        self.objectDatabase.extend(fragment.objects)
+
     def writeInt(self, val):
         """Write an integer to the token stream.
         """
-        self.tokenStream.append(unicode(long(val)))
+        self.tokenStream.append(str(long(val)))
 
     def writeLong(self, val):
         """
         Write a long value.
+
+        Versions up to 5 write it as a pair of doubles, later versions as
+        a base-64 string.
         """
+        if self.version >= BASE64_LONG_VERSION:
+            self.tokenStream.append(self._longToken(longToBase64(val)))
+            return
         highBits, lowBits = long(val) >> 32, long(val) & 0xffffffffL
         TWO_PWR_16_DBL = 0x10000
         TWO_PWR_32_DBL = TWO_PWR_16_DBL * TWO_PWR_16_DBL
@@ -121,51 +776,132 @@ class Response:
         low = float(lowBits)
         if low < 0.0:
             low += TWO_PWR_32_DBL
-        self.writeInt(low) 
-        self.writeInt(high)
+        self.writeDouble(low)
+        self.writeDouble(high)
 
     def writeDouble(self, val):
-        self.tokenStream.append(unicode(float(val)))
+        self.tokenStream.append(formatDouble(val))
 
     def addString(self, strval):
         """Add a string to the string table and return the index.
         """
         if strval is None:
             return 0
-        if strval in self.stringTable:
-            return self.stringTable.index(strval) + 1
-        self.stringTable.append(strval)
-        return len(self.stringTable)
+        index = self._stringIndices.get(strval)
+        if index is None:
+            self.stringTable.append(strval)
+            index = self._stringIndices[strval] = len(self.stringTable)
+        return index
+
+    def _stringToken(self, index):
+        if self.compact:
+            return _StringToken(index)
+        return str(index)
+
+    def compactStringTable(self):
+        """Order the string table by the number of references to each
+        string, most referenced first, and rewrite the references.
+
+        Only references written while C{compact} is set are known.
+        """
+        counts = dict()
+        for token in self.tokenStream:
+            if type(token) is _StringToken:
+                counts[token] = counts.get(token, 0) + 1
+        order = sorted(range(1, len(self.stringTable) + 1),
+                       key=lambda index: -counts.get(str(index), 0))
+        if order == range(1, len(self.stringTable) + 1):
+            return
+        indices = dict()
+        for newIndex, index in enumerate(order):
+            indices[str(index)] = _StringToken(newIndex + 1)
+        self.stringTable = [self.stringTable[index - 1] for index in order]
+        self._stringIndices = dict(
+            [(strval, index + 1)
+             for (index, strval) in enumerate(self.stringTable)])
+        self.tokenStream = [
+            type(token) is _StringToken and indices.get(token, token) or token
+            for token in self.tokenStream]
+
+    def _longToken(self, encoded):
+        # responses are JavaScript, where the long is a string literal.
+        return '"%s"' % encoded
 
     def writeString(self, strval):
         """Write string to token stream.
         """
-        self.writeInt(self.addString(strval))
+        self.tokenStream.append(self._stringToken(self.addString(strval)))
 
     def _writePayload(self):
-        """Write payload into a string and return it.
+        """Write payload into a byte string and return it.
         """
-        return u','.join(reversed(self.tokenStream))
+        return ','.join(reversed(self.tokenStream))
 
     def _writeStringTable(self):
-        """Write string table into a string and return it.
+        """Write string table into a byte string and return it.
+
+        Escaped strings only hold ASCII characters, so the table is
+        encoded in one go.
         """
-        return u'[%s]' % u','.join(
+        table = u','.join(
             [escapeString(s) for s in self.stringTable]
-            )
+            ).encode('ascii')
+        self.stringTableSize = len(table)
+        return table
     
     def _writeHeader(self):
-        """Write header to a string and return it.
+        """Write header to a byte string and return it.
+        """
+        return '%d,%d' % (self.flags, self.version)
+
+    def toChunks(self, prefix=''):
+        """Return content of response as a list of UTF-8 encoded byte
+        strings, to be written in order.
+
+        The payload and the string table are not copied into a single
+        string.
         """
-        return u','.join([unicode(self.flags), unicode(self.version)])
+        if self.compact:
+            self.compactStringTable()
+        return [prefix + '[', self._writePayload(), ',[',
+                self._writeStringTable(), '],', self._writeHeader(), ']']
 
     def toString(self):
         """Return content of response as a string.
         """
-        components = [
-            self._writePayload(), self._writeStringTable(), self._writeHeader()
-            ]
-        return u'[%s]' % u','.join(components)
+        return ''.join(self.toChunks())
+
+
+class _FragmentRecorder(Response):
+    """Response that records the serialized form of a single instance.
+
+    All of its string references are recorded as such, whether or not
+    it is compact, since the response that the fragment is spliced into
+    maps them to its own string table (see L{Response.writeFragment}).
+    """
+
+    def _stringToken(self, index):
+        return _StringToken(index)
+
+    def getFragment(self):
+        """Return the recorded fragment.
+        """
+        stringRefs = [position
+                      for (position, token) in enumerate(self.tokenStream)
+                      if type(token) is _StringToken]
+        tokens = [str(token) for token in self.tokenStream]
+        return Fragment(tokens, self.stringTable, stringRefs,
+                        self.objectDatabase)
+
+
+def summarizeArguments(arguments, maxLength=200):
+    """Return a summary of arguments, that is at most maxLength
+    characters long.
+    """
+    summary = ', '.join([repr(argument) for argument in arguments])
+    if len(summary) > maxLength:
+        summary = summary[:maxLength - 3] + '...'
+    return '(%s)' % summary
 
 
 class Request:
@@ -175,13 +911,82 @@ class Request:
         back references.
 
     @ivar stringTable: Table of strings, indexed by a 1-based integer.
+
+    @ivar timings: List of (phase, seconds) tuples, that tell how long
+        each phase of the evaluation took.  Only recorded if the servlet
+        has a slow request threshold.
+
+    @ivar payloadAccounting: L{accounting.PayloadAccounting} that the
+        sizes of the request and its response are added to, or C{None}.
+
+    @ivar peakMemory: Largest number of bytes traced by tracemalloc at
+        the end of a phase, if memory is traced and payloads accounted.
+
+    @ivar permutation: The L{Permutation} of the client build that sent
+        the request, or C{None}.
+
+    @ivar verifySignatures: If false, type signatures that have not been
+        seen before are trusted rather than verified.
+
+    @ivar verifiedSignatures: Number of type signatures of objects that
+        have been verified while reading the request.
+
+    @ivar version: Protocol version of the request, at most
+        L{MAX_VERSION} for requests that are evaluated.
+
+    @ivar method: The L{MethodDispatch} that the request resolved to, or
+        C{None}.
     """
     implements(igwt.ITokenReader)
 
+    permutation = None
+    verifySignatures = True
+    verifiedSignatures = 0
+    version = DEFAULT_VERSION
+    interfaceName = methodName = None
+    method = None
+    arguments = ()
+    depth = 0
+    payloadAccounting = None
+    peakMemory = None
+    _lastMark = None
+
     def __init__(self, servlet):
         self.servlet = servlet
         self.stringTable = dict()
         self.objectDatabase = list()
+        self.timings = list()
+        if getattr(servlet, 'slowRequestThreshold', None) is not None:
+            self._lastMark = self.started = servlet.getClock().seconds()
+        if servlet is not None:
+            self.payloadAccounting = servlet.getPayloadAccounting()
+        if self.payloadAccounting is not None and accounting.isTracing():
+            self.peakMemory = self._memoryBase = accounting.tracedMemory()
+
+    def mark(self, phase):
+        """Record the time spent in phase, since the previous phase ended.
+        """
+        if self.peakMemory is not None:
+            # other requests allocate concurrently, so this is only an
+            # approximation.
+            self.peakMemory = max(self.peakMemory, accounting.tracedMemory())
+        if self._lastMark is None:
+            return
+        now = self.servlet.getClock().seconds()
+        self.timings.append((phase, now - self._lastMark))
+        self._lastMark = now
+
+    def getLimit(self, name):
+        """Return the named limit of the servlet, or C{None}.
+        """
+        return getattr(self.servlet, name, None)
+
+    def checkLimit(self, name, value, what):
+        """Raise L{error.LimitExceeded} if value exceeds the named limit.
+        """
+        limit = self.getLimit(name)
+        if limit is not None and value > limit:
+            raise error.LimitExceeded("%s exceeds %d" % (what, limit))
 
     def prepareToRead(self, content):
         """Prepare to read.
@@ -192,6 +997,9 @@ class Request:
         """Build string table from the token stream.
         """
         count = self.readInt()
+        if count < 0 or count > self.tokenStream.available():
+            raise error.SerializationException("bad string count %d" % count)
+        self.checkLimit('maxStrings', count, "strings")
         for i in range(count):
             self.stringTable[i + 1] = self.readToken()
 
@@ -213,10 +1021,25 @@ class Request:
     def readLong(self):
         """Return a long from the token stream.
         """
+        if self.version >= BASE64_LONG_VERSION:
+            return longFromBase64(self.readToken())
         low = self.readDouble()
         high = self.readDouble()
         return long(high) + long(low)
 
+    def readLength(self):
+        """Read the number of elements of a collection.
+
+        Every element takes at least one token, so the number can not
+        exceed the number of tokens that are left.  This is checked
+        before anything is allocated for the elements.
+        """
+        length = self.readInt()
+        if length < 0 or length > self.tokenStream.available():
+            raise error.SerializationException("bad length %d" % length)
+        self.checkLimit('maxCollectionLength', length, "collection length")
+        return length
+
     def readString(self):
         """Return a string from the token stream.
         """
@@ -235,19 +1058,83 @@ class Request:
 
     def reserveObject(self):
         id = len(self.objectDatabase)
+        self.checkLimit('maxObjects', id + 1, "objects")
         self.objectDatabase.append(None)
         return id
 
-    def deserializeObject(self, typeSignature):
-        """Deserialize an object according to the given type signature.
+    def _beginObject(self, typeSignature):
+        """Begin to deserialize an object according to the given type
+        signature.
+
+        Returns a tuple of the instance, and a generator that reads the
+        rest of it, or C{None} if the instance is complete.
         """
         id = self.reserveObject()
-        typeInstance = annotation.buildAnnotation(typeSignature)
+        typeInstance = annotation.buildAnnotation(typeSignature,
+                                                  self.verifySignatures)
+        if self.verifySignatures:
+            self.verifiedSignatures += 1
         customSerializer = annotation.getCustomFieldSerializer(typeInstance)
-        instance = customSerializer.deserialize(self)
+        self.depth += 1
+        self.checkLimit('maxDepth', self.depth, "nesting depth")
+        deserializeSteps = getattr(customSerializer, 'deserializeSteps', None)
+        if deserializeSteps is None:
+            instance = customSerializer.deserialize(self)
+            self.depth -= 1
+            self.rememberObject(instance, id)
+            return instance, None
+        steps = deserializeSteps(self)
+        instance = steps.next()
+        # remembered before its fields are read, so that they can refer
+        # back to it.
         self.rememberObject(instance, id)
+        return instance, steps
+
+    def _readObjects(self, instance, steps):
+        """Complete the deserialization of instance, and of the objects it
+        refers to.
+
+        Objects are read depth first with an explicit stack of the
+        generators of their serializers, so graphs of any depth can be
+        read.  A generator yields the type of each value it wants read,
+        or L{annotation.READ_OBJECT} for an object of any type, and is
+        sent the value.
+        """
+        stack = [(steps, instance)]
+        value = None
+        while stack:
+            try:
+                wanted = stack[-1][0].send(value)
+            except StopIteration:
+                value = stack.pop()[1]
+                self.depth -= 1
+                continue
+            if (wanted is not annotation.READ_OBJECT
+                and annotation.isPrimitiveType(wanted)):
+                customSerializer = annotation.getCustomFieldSerializer(wanted)
+                value = customSerializer.deserialize(self)
+                continue
+            typeSignatureIndex = self.readInt()
+            if typeSignatureIndex == 0:
+                value = None
+            elif typeSignatureIndex < 0:
+                value = self.objectDatabase[-(typeSignatureIndex + 1)]
+            else:
+                value, steps = self._beginObject(
+                    self.stringTable[typeSignatureIndex])
+                if steps is not None:
+                    stack.append((steps, value))
+                    value = None
         return instance
 
+    def deserializeObject(self, typeSignature):
+        """Deserialize an object according to the given type signature.
+        """
+        instance, steps = self._beginObject(typeSignature)
+        if steps is None:
+            return instance
+        return self._readObjects(instance, steps)
+
     def readObject(self):
         # read the type signature of the serialized object.  if there
         # is no signature available, it must be the null instance.
@@ -283,91 +1170,483 @@ class Request:
     def _ebInvoke(self, reason, response):
         """Report back an error.
         """
-        log.err(reason)
+        if reason.check(defer.CancelledError):
+            # nobody is waiting for the response.
+            return reason
+        if reason.check(error.BadSignature) and self.permutation is not None:
+            self.permutation.badSignatures += 1
+        if not reason.check(error.Overloaded, error.LimitExceeded):
+            self.servlet.logFailure(reason)
+        self.mark('invoke')
         typeInstance = igwt.IType(reason.value, None)
         if typeInstance is None:
             reason.value = error.IncompatibleRemoteServiceException()
             typeInstance = igwt.IType(reason.value)
         response.writeObject(reason.value, typeInstance)
-        return u'//EX' + response.toString()
+        chunks = response.toChunks('//EX')
+        self.mark('serialize')
+        return chunks
 
-    def _cbInvoke(self, result, response, signature):
+    def _cbInvoke(self, result, response, method):
+        """Write the result, once deferreds held by it are resolved if
+        the method is declared to have them.
+        """
+        self.mark('invoke')
+        if not method.signature.deferredValues:
+            return self._cbResolved(result, response, method)
+        d = resolveDeferreds(result)
+        d.addCallback(self._cbResolved, response, method)
+        return d
+
+    def _cbResolved(self, result, response, method):
         """Return value.
         """
-        if not isinstance(signature.returnTypeSignature, annotation.Void):
-            if (signature.returnTypeSignature.isPrimitive() or
-                isinstance(signature.returnTypeSignature, 
-                           annotation.ArrayList)):
-                response.serializeValue(result, signature.returnTypeSignature)
-            else:
-                response.writeObject(result)
-        return u'//OK' + response.toString()
-
-    def invoke(self, provider, signature, arguments, response):
-        """Invoke method ok servlet interface provider.
-        """
-        methodName = signature.name
-        func = getattr(provider, str(methodName), None)
-        if func is None:
-            raise error.NoSuchMethod()
-        d = defer.maybeDeferred(func, *arguments)
-        d.addCallback(self._cbInvoke, response, signature)
+        self.mark('resolve')
+        if sharedResults and not isinstance(result, SerializedResult):
+            result = sharedResults.get(id(result), result)
+        if isinstance(result, SerializedResult):
+            chunks = result.getChunks(response,
+                                      method.signature.returnTypeSignature)
+        else:
+            method.writeResult(result, response)
+            chunks = response.toChunks('//OK')
+        self.mark('serialize')
+        return chunks
+
+    def invoke(self, method, arguments, response):
+        """Invoke a method of the servlet, as dispatched by a
+        L{MethodDispatch}.
+        """
+        signature = method.signature
+        scheduler = self.servlet.getScheduler()
+        limiter = self.servlet.getMethodLimiter(signature)
+        if (scheduler is None and limiter is None
+            and signature.deadline is None and signature.longPoll is None):
+            # plain values are written right away, without deferreds.
+            result = method.func(*arguments)
+            if not isinstance(result, defer.Deferred):
+                result = futures.toDeferred(result)
+            if isinstance(result, defer.Deferred):
+                return result.addCallback(self._cbInvoke, response, method)
+            if signature.deferredValues:
+                return self._cbInvoke(result, response, method)
+            self.mark('invoke')
+            return self._cbResolved(result, response, method)
+        func = method.call
+        if scheduler is not None:
+            arguments = [signature.priority, func] + list(arguments)
+            func = scheduler.run
+        if limiter is None:
+            d = defer.maybeDeferred(func, *arguments)
+        else:
+            d = limiter.run(func, *arguments)
+        d.addCallback(self._cbInvoke, response, method)
+        if signature.deadline is not None:
+            self._setDeadline(d, signature.deadline)
+        if signature.longPoll is not None:
+            self._setPollTimeout(d, signature.longPoll, response, method)
         return d
 
-    def _evaluate1(self, response):
-        remoteInterfaceName, methodName = self.readString(), self.readString()
+    def _setPollTimeout(self, d, timeout, response, method):
+        """Cancel d unless it has fired within timeout seconds, and respond
+        with null (nothing for void methods) instead.
+        """
+        expired = []
+        def expire():
+            expired.append(True)
+            d.cancel()
+        delayedCall = self.servlet.callLater(timeout, expire)
+        def done(result):
+            if delayedCall.active():
+                delayedCall.cancel()
+            if expired and isinstance(result, failure.Failure):
+                result.trap(defer.CancelledError)
+                return self._cbInvoke(None, response, method)
+            return result
+        d.addBoth(done)
 
-        try:
-            remoteInterface = remoteInterfaceRegistry[remoteInterfaceName]
-        except KeyError:
-            raise
+    def _setDeadline(self, d, timeout):
+        """Cancel d unless it has fired within timeout seconds.
 
-        provider = remoteInterface(self.servlet, None)
-        if provider is None:
-            raise error.NoSuchInterface()
+        The cancellation is reported as L{error.DeadlineExceeded}.
+        """
+        expired = []
+        def expire():
+            expired.append(True)
+            d.cancel()
+        delayedCall = self.servlet.callLater(timeout, expire)
+        def done(result):
+            if delayedCall.active():
+                delayedCall.cancel()
+            if expired and isinstance(result, failure.Failure):
+                result.trap(defer.CancelledError)
+                raise error.DeadlineExceeded()
+            return result
+        d.addBoth(done)
 
-        try:
-            methodSignature = remoteInterface[methodName]
-        except KeyError:
-            raise error.NoSuchMethod()
+    def _evaluate1(self, response):
+        remoteInterfaceName, methodName = self.readString(), self.readString()
+        self.interfaceName, self.methodName = remoteInterfaceName, methodName
 
         # The argument type signatures are embedded in the token stream,
         # so the server can figure out what method to invoke if there are
         # several methods with the same name.
         #
         # We do not really case since we can only have one method per name.
-        # But we read them the signatures and build annotations, to
-        #
-        #  (1) know how to deserialize the values, and
-        #  (2) check signatures
+        # But the signatures are part of the key of the dispatch table,
+        # which knows how to deserialize the values.
         count = self.readInt()
-        argTypeNames = [self.readString() for i in range(count)]
-        argTypeInstances = [annotation.buildAnnotation(t) for t in argTypeNames]
-        arguments = self.deserializeValues(argTypeInstances)
+        argTypeNames = tuple([self.readString() for i in range(count)])
+        method = self.servlet.getMethodDispatch(
+            remoteInterfaceName, methodName, argTypeNames)
+        self.method = method
+        arguments = [readArgument(self) for readArgument in method.readers]
+        self.arguments = arguments
+        if (self.permutation is not None and self.verifySignatures
+            and self.verifiedSignatures):
+            # every signature in the request checked out, and there was
+            # at least one.
+            self.permutation.verified()
+        self.mark('deserialize')
 
         # invoke method:
-        return self.invoke(
-            provider, methodSignature, arguments, response
-            )
+        return self.invoke(method, arguments, response)
 
     def evaluate(self, content):
         """Evalutate request.
         
-        Returns a deferred that will be invoked with a Response object.
+        Returns a deferred that will be invoked with the response, as a
+        list of UTF-8 encoded byte strings.
+        """
+        return asDeferred(self.evaluateNow(content))
+
+    def evaluateNow(self, content):
+        """Evaluate request.
+
+        Returns the response (or a failure) if it is ready at once, that is
+        if the method returned a plain value, and a deferred just like
+        L{evaluate} otherwise.
         """
+        self.checkLimit('maxRequestSize', len(content), "request size")
+        # tokens are counted in the raw bytes, before the content is
+        # decoded and split; the separator is never part of a multi-byte
+        # UTF-8 sequence.
+        self.checkLimit('maxTokens', content.count('|'), "tokens")
         self.prepareToRead(content.decode('utf-8'))
         response = Response(self.servlet)
 
         response.version, response.flags = self.readInt(), self.readInt()
         self.buildStringTable()
+        self.mark('parse')
+        return self._evaluate(response)
+
+    def evaluateParsed(self, parser):
+        """Evaluate a request whose body has been fed to an
+        L{IncrementalParser}.
+
+        Returns a deferred just like L{evaluate}.
+        """
+        return asDeferred(self.evaluateParsedNow(parser))
+
+    def evaluateParsedNow(self, parser):
+        """Evaluate a parsed request.
+
+        Returns the response or a deferred, just like L{evaluateNow}.
+        """
+        parser.finish()
+        if parser.error is not None:
+            parser.error.raiseException()
+        if not parser.isComplete():
+            raise error.SerializationException("truncated request")
+        self.checkLimit('maxRequestSize', parser.size, "request size")
+        self.checkLimit('maxTokens', len(parser.tokenStream) - 1, "tokens")
+        self.checkLimit('maxStrings', parser.stringCount, "strings")
+        self.tokenStream = parser.tokenStream
+        self.stringTable = parser.stringTable
+        response = Response(self.servlet)
+        response.version, response.flags = parser.version, parser.flags
+        self.mark('parse')
+        return self._evaluate(response)
+
+    def _evaluate(self, response):
+        self.version = response.version
+        if (response.version > MAX_VERSION
+                or response.flags & ~SUPPORTED_FLAGS):
+            result = failure.Failure(error.UnsupportedProtocol(
+                "unsupported protocol version %d (flags %d)" % (
+                    response.version, response.flags)))
+            # answer in the nearest version, for the client to report.
+            response.version = min(response.version, MAX_VERSION)
+            response.flags = SUPPORTED_FLAGS
+        else:
+            if response.version > 2:
+                self.moduleBaseURL = self.readString()
+                self.strongName = self.readString()
+                self.permutation = self.servlet.getPermutation(
+                    self.strongName)
+                if self.permutation is not None:
+                    self.permutation.calls += 1
+                    self.verifySignatures = not self.permutation.trusted
+            try:
+                result = self._evaluate1(response)
+            except:
+                result = failure.Failure()
+        if isinstance(result, defer.Deferred):
+            result.addErrback(self._ebInvoke, response)
+            if self._lastMark is not None:
+                result.addBoth(self._checkSlow, response)
+            if self.payloadAccounting is not None:
+                result.addBoth(self._account, response)
+            return result
+        # the response is ready; run the same steps without a deferred.
+        if isinstance(result, failure.Failure):
+            try:
+                result = self._ebInvoke(result, response)
+            except:
+                result = failure.Failure()
+        if self._lastMark is not None:
+            result = self._checkSlow(result, response)
+        if self.payloadAccounting is not None:
+            result = self._account(result, response)
+        return result
+
+    def _account(self, result, response):
+        """Add the sizes of the request and its response to the payload
+        accounting of the servlet.  Requests that did not resolve to a
+        remote method are accounted under L{accounting.UNKNOWN}.
+        """
+        if self.method is not None:
+            key = (self.interfaceName, self.methodName)
+        else:
+            key = accounting.UNKNOWN
+        if isinstance(result, list):
+            responseBytes = sum(map(len, result))
+        else:
+            responseBytes = 0
+        if self.peakMemory is not None:
+            peakMemory = self.peakMemory - self._memoryBase
+        else:
+            # estimate the memory held by the tokens of both messages.
+            peakMemory = (accounting.estimateSize(self.tokenStream)
+                          + accounting.estimateSize(response.tokenStream)
+                          + responseBytes)
+        self.payloadAccounting.add(key, {
+            'requestTokens': len(self.tokenStream),
+            'requestStringBytes': sum([len(s.encode('utf-8'))
+                                       for s in self.stringTable.values()]),
+            'requestObjects': len(self.objectDatabase),
+            'responseTokens': len(response.tokenStream),
+            'responseStringBytes': response.stringTableSize,
+            'responseObjects': len(response.objectDatabase),
+            'responseBytes': responseBytes,
+            'peakMemory': peakMemory,
+            })
+        return result
+
+    def _checkSlow(self, result, response):
+        """Log the request if it took longer than the slow request
+        threshold of the servlet.
+        """
+        elapsed = self.servlet.getClock().seconds() - self.started
+        if elapsed < self.servlet.slowRequestThreshold:
+            return result
+        limiter = self.servlet.getSlowRequestLimiter()
+        if not limiter.allow():
+            return result
+        suppressed, limiter.suppressed = limiter.suppressed, 0
+        if isinstance(result, list):
+            responseSize = sum(map(len, result))
+        else:
+            responseSize = 0
+        log.msg(format="slow request: %(interface)s.%(method)s took "
+                "%(elapsed).3fs (%(timings)s); request %(requestTokens)d "
+                "tokens, %(requestStrings)d strings, %(requestObjects)d "
+                "objects; response %(responseTokens)d tokens, "
+                "%(responseStrings)d strings, %(responseObjects)d objects, "
+                "%(responseSize)d bytes; arguments %(arguments)s"
+                "%(suppressedNote)s",
+                interface=self.interfaceName, method=self.methodName,
+                elapsed=elapsed,
+                timings=', '.join(['%s %.3fs' % timing
+                                   for timing in self.timings]),
+                requestTokens=len(self.tokenStream),
+                requestStrings=len(self.stringTable),
+                requestObjects=len(self.objectDatabase),
+                responseTokens=len(response.tokenStream),
+                responseStrings=len(response.stringTable),
+                responseObjects=len(response.objectDatabase),
+                responseSize=responseSize,
+                arguments=summarizeArguments(self.arguments),
+                suppressedNote=(suppressed and
+                                ' (%d slow requests not logged)' % suppressed
+                                or ''),
+                slowRequest=True)
+        return result
+
+
+class Permutation:
+    """A client build, identified by the strong name of its permutation.
+
+    @ivar calls: Number of calls made by the build.
+
+    @ivar badSignatures: Number of calls that failed on a type signature
+        that did not match the one of the server.
+
+    @ivar trusted: True if type signatures of the build are trusted
+        without being verified.
+    """
+
+    def __init__(self, strongName, trustVerified=False):
+        self.strongName = strongName
+        self.trustVerified = trustVerified
+        self.calls = self.badSignatures = 0
+        self.trusted = False
+
+    def verified(self):
+        """Note that all type signatures of a call of the build have been
+        verified, and that it had some.  Builds that have never sent a bad
+        signature are then trusted, if they are to be.
+        """
+        if self.trustVerified and not self.badSignatures:
+            self.trusted = True
+
+    def getStatistics(self):
+        return {'calls': self.calls, 'badSignatures': self.badSignatures,
+                'trusted': self.trusted}
+
+
+def _writeNothing(result, response):
+    pass
+
+
+def getResultWriter(returnType):
+    """Return a callable that writes a value returned by a method of the
+    given return type to a response.  The type of the value is looked up
+    if the return type is C{None}.
+    """
+    if isinstance(returnType, annotation.Void):
+        return _writeNothing
+    if returnType is not None and (
+        returnType.isPrimitive()
+        or isinstance(returnType, annotation.ArrayList)):
+        def writeValue(result, response):
+            response.serializeValue(result, returnType)
+        return writeValue
+    def writeObject(result, response):
+        response.writeObject(result,
+                             annotation.getValueType(result, returnType))
+    return writeObject
+
+
+class SerializedResult:
+    """A value serialized once into the body of a response.
+
+    Remote methods may return one instead of the value, to send the same
+    result to many clients without encoding it for each.  The value is
+    serialized once for each protocol version, flags and return type that
+    it is asked for, and written as is to later calls with the same.  The
+    value must be free of deferreds, and must not change.
+
+    @ivar returnType: Type signature that the value is written as, or
+        C{None} for the return type of the method that returns it.
+
+    @ivar chunks: Dictionary that maps each C{(version, flags,
+        returnType, compact)} to a tuple of the byte strings of the
+        response body.
+    """
+
+    def __init__(self, value, returnType=None, version=5, flags=0):
+        self.value = value
+        self.returnType = returnType
+        self.chunks = dict()
+        if version is not None:
+            self.serialize(version, flags)
+
+    def serialize(self, version, flags, returnType=None, compact=False):
+        """Return the chunks of the body for a protocol version and flags,
+        serializing the value unless it was for them already.  If compact
+        is true, the string table is compacted (see L{Response.compact}).
+        """
+        if self.returnType is not None:
+            returnType = self.returnType
+        key = (version, flags, returnType, compact)
+        chunks = self.chunks.get(key)
+        if chunks is None:
+            response = Response(None)
+            response.version, response.flags = version, flags
+            response.compact = compact
+            getResultWriter(returnType)(self.value, response)
+            chunks = tuple(response.toChunks('//OK'))
+            self.chunks[key] = chunks
+        return chunks
+
+    def getChunks(self, response, returnType=None):
+        """Return the chunks of the body of a response with the value, for
+        the protocol version, flags and compaction of the given empty
+        response.
+        """
+        return list(self.serialize(response.version, response.flags,
+                                   returnType, response.compact))
+
+
+# SerializedResult of each value that the calls answered by shareResult
+# share, by the id of the value.
+sharedResults = {}
+
+
+def shareResult(value, f, *args):
+    """Call f, and have every remote call that it answers with value
+    share one serialization of it.  The value must not change until f
+    returns.
+    """
+    key = id(value)
+    previous = sharedResults.get(key)
+    sharedResults[key] = SerializedResult(value, version=None)
+    try:
+        return f(*args)
+    finally:
+        if previous is None:
+            del sharedResults[key]
+        else:
+            sharedResults[key] = previous
+
 
-        if response.version > 2:
-            self.moduleBaseURL = self.readString()
-            self.strongName = self.readString()
+class MethodDispatch:
+    """A remote method of a servlet, resolved once for a signature of its
+    arguments.
 
-        return defer.maybeDeferred(
-            self._evaluate1, response
-            ).addErrback(self._ebInvoke, response)
+    @ivar signature: The L{RemoteMethod} declaration.
+
+    @ivar func: The callable that implements the method.
+
+    @ivar readers: One callable per argument that reads it from a
+        L{Request}.
+
+    @ivar writeResult: Callable that writes a returned value to a
+        L{Response}.
+    """
+
+    def __init__(self, provider, signature, argTypeNames):
+        self.signature = signature
+        self.func = getattr(provider, str(signature.name), None)
+        if self.func is None:
+            raise error.NoSuchMethod(signature.name)
+        self.readers = [
+            self._buildReader(annotation.buildAnnotation(typeName))
+            for typeName in argTypeNames]
+        self.writeResult = getResultWriter(signature.returnTypeSignature)
+
+    def call(self, *arguments):
+        """Call the method.  Futures and coroutines that it returns are
+        returned as deferreds.
+        """
+        return futures.toDeferred(self.func(*arguments))
+
+    def _buildReader(self, typeInstance):
+        if annotation.isPrimitiveType(typeInstance):
+            customSerializer = igwt.ICustomFieldSerializer(typeInstance)
+            return customSerializer.deserialize
+        return Request.readObject
 
 
 class _ServiceServlet:
@@ -375,12 +1654,348 @@ class _ServiceServlet:
 
     @cvar remoteInterfaces: Dictionary that map from client-side interface name
         to serverside interface class.
+
+    @cvar clock: Provider of IReactorTime used to schedule deadlines, or
+        C{None} to use the global reactor.
+
+    @cvar maxConcurrentRequests: Number of requests that may be processed
+        concurrently, or C{None} for no limit.
+
+    @cvar maxQueuedRequests: Number of requests that may wait for
+        processing when C{maxConcurrentRequests} is reached.  Requests
+        beyond that are shed.
+
+    @cvar targetLatency: If set, the request limit is adapted to keep
+        request latency (in seconds) below it.
+
+    @cvar maxConcurrentCalls: Number of calls that may run concurrently
+        when calls are scheduled by priority, or C{None} to not schedule
+        calls.
+
+    @cvar priorityBudgets: Dictionary that maps a priority class to the
+        number of concurrent calls it may occupy.
+
+    @cvar maxQueuedCalls: Number of calls that may wait in the queue of
+        each priority class.
+
+    @cvar slowRequestThreshold: Number of seconds after which a request
+        is logged as slow, with timings and sizes, or C{None} to not
+        time requests.
+
+    @cvar slowRequestLogRate: Number of slow requests that may be logged
+        per second.  The rest are counted, and the count is logged with
+        the next slow request.
+
+    @cvar errorLogRate: Number of failed calls that may be logged per
+        second, or C{None} to log every failure.  The rest are counted,
+        and the count is logged with the next failure.
+
+    @cvar errorLogSampleRate: Fraction of failed calls that are
+        considered for the log.  All failures are counted by exception
+        class; see L{getFailureStatistics}.
+
+    @cvar accountPayloads: If true, the sizes of requests and responses
+        are aggregated by method; see L{getPayloadStatistics}.
+
+    @cvar compactPayloads: If true, the string table of each response is
+        ordered so that the most referenced strings get the shortest
+        indices; see L{Response.compactStringTable}.
+
+    @cvar trustVerifiedPermutations: If true, once all type signatures of
+        a call from a client build (identified by its strong name) have
+        been verified, and there was at least one, signatures from that
+        build are trusted without being verified.
+
+    @cvar maxPermutations: Number of client builds that calls are
+        counted for; the least recently seen build is forgotten to make
+        room for a new one.  See L{getPermutationStatistics}.
+
+    @cvar maxRequestSize: Number of bytes a request body may hold.
+
+    @cvar maxTokens: Number of tokens a request may hold.
+
+    @cvar maxStrings: Number of strings the string table of a request
+        may hold.
+
+    @cvar maxCollectionLength: Number of elements an array, list or map
+        of a request may hold.
+
+    @cvar maxDepth: Number of levels objects of a request may be nested.
+
+    @cvar maxObjects: Number of objects a request may hold.
+
+    Requests that exceed any of the limits are rejected with
+    L{error.LimitExceeded}.  Limits that are C{None} are not enforced.
     """
+    clock = None
+    maxConcurrentRequests = None
+    maxQueuedRequests = 0
+    targetLatency = None
+    maxConcurrentCalls = None
+    priorityBudgets = {}
+    maxQueuedCalls = 100
+    slowRequestThreshold = None
+    slowRequestLogRate = 1.0
+    errorLogRate = None
+    errorLogSampleRate = 1.0
+    accountPayloads = False
+    compactPayloads = False
+    trustVerifiedPermutations = False
+    maxPermutations = 1000
+    maxRequestSize = None
+    maxTokens = None
+    maxStrings = None
+    maxCollectionLength = None
+    maxDepth = None
+    maxObjects = None
+
+    _requestLimiter = None
+    _methodLimiters = None
+    _scheduler = None
+    _slowRequestLimiter = None
+    _payloadAccounting = None
+    _dispatchTable = None
+    _errorLogLimiter = None
+    _failureCounts = None
+    _permutations = None
+
+    def getMethodDispatch(self, interfaceName, methodName, argTypeNames):
+        """Return the L{MethodDispatch} of a remote method of the servlet.
+
+        Methods are resolved the first time they are called with a given
+        signature of their arguments, and kept in the dispatch table of
+        the servlet.
+        """
+        key = (interfaceName, methodName, argTypeNames)
+        if self._dispatchTable is None:
+            self._dispatchTable = dict()
+        method = self._dispatchTable.get(key)
+        if method is None:
+            try:
+                remoteInterface = remoteInterfaceRegistry[interfaceName]
+            except KeyError:
+                raise error.NoSuchInterface(interfaceName)
+            provider = remoteInterface(self, None)
+            if provider is None:
+                raise error.NoSuchInterface(interfaceName)
+            try:
+                signature = remoteInterface[methodName]
+            except KeyError:
+                raise error.NoSuchMethod(methodName)
+            method = MethodDispatch(provider, signature, argTypeNames)
+            # calls with the wrong number of arguments fail; do not let
+            # them fill the table.
+            if len(argTypeNames) == signature.func.func_code.co_argcount:
+                self._dispatchTable[key] = method
+        return method
+
+    def getClock(self):
+        """Return the clock of the servlet.
+        """
+        clock = self.clock
+        if clock is None:
+            from twisted.internet import reactor as clock
+        return clock
+
+    def callLater(self, delay, f, *args, **kw):
+        """Schedule a call using the clock of the servlet.
+        """
+        return self.getClock().callLater(delay, f, *args, **kw)
+
+    def getRequestLimiter(self):
+        """Return the limiter that admits requests to the servlet, or
+        C{None} if requests are not limited.
+        """
+        if (self._requestLimiter is None
+            and self.maxConcurrentRequests is not None):
+            self._requestLimiter = limit.buildLimiter(
+                self.maxConcurrentRequests, self.maxQueuedRequests,
+                self.targetLatency, self.getClock()
+                )
+        return self._requestLimiter
+
+    def getMethodLimiter(self, method):
+        """Return the limiter that admits calls to the given remote
+        method, or C{None} if calls are not limited.
+        """
+        if method.concurrency is None:
+            return None
+        if self._methodLimiters is None:
+            self._methodLimiters = dict()
+        limiter = self._methodLimiters.get(method)
+        if limiter is None:
+            limitCount, maxQueued, targetLatency = method.concurrency
+            limiter = limit.buildLimiter(limitCount, maxQueued,
+                                         targetLatency, self.getClock())
+            self._methodLimiters[method] = limiter
+        return limiter
+
+    def getScheduler(self):
+        """Return the scheduler that runs calls by priority, or C{None}
+        if calls are not scheduled.
+        """
+        if self._scheduler is None and self.maxConcurrentCalls is not None:
+            self._scheduler = limit.PriorityScheduler(
+                self.maxConcurrentCalls, self.priorityBudgets,
+                self.maxQueuedCalls, self.getClock()
+                )
+        return self._scheduler
+
+    def getSlowRequestLimiter(self):
+        """Return the rate limiter of the slow request log.
+        """
+        if self._slowRequestLimiter is None:
+            self._slowRequestLimiter = util.RateLimiter(
+                self.slowRequestLogRate, clock=self.getClock())
+        return self._slowRequestLimiter
+
+    def getPermutation(self, strongName):
+        """Return the L{Permutation} of the client build with the given
+        strong name.  Builds are kept track of in least recently used
+        order, up to C{maxPermutations} of them.
+        """
+        if self._permutations is None:
+            self._permutations = OrderedDict()
+        permutation = self._permutations.pop(strongName, None)
+        if permutation is None:
+            permutation = Permutation(strongName,
+                                      self.trustVerifiedPermutations)
+            while len(self._permutations) >= self.maxPermutations:
+                self._permutations.popitem(last=False)
+        # put the build at the end, as the most recently used.
+        self._permutations[strongName] = permutation
+        return permutation
+
+    def getPermutationStatistics(self):
+        """Return the number of calls, calls with bad signatures, and
+        whether it is trusted, by strong name of client build.
+        """
+        return dict([(strongName, permutation.getStatistics())
+                     for (strongName, permutation)
+                     in (self._permutations or {}).iteritems()])
+
+    def getErrorLogLimiter(self):
+        """Return the rate limiter of the error log, or C{None} if every
+        failure is logged.
+        """
+        if self._errorLogLimiter is None and self.errorLogRate is not None:
+            self._errorLogLimiter = util.RateLimiter(
+                self.errorLogRate, clock=self.getClock())
+        return self._errorLogLimiter
+
+    def logFailure(self, reason):
+        """Count a failed call, and log it unless too many failures have
+        been logged lately.
+        """
+        if self._failureCounts is None:
+            self._failureCounts = dict()
+        name = reflect.qual(reason.type)
+        self._failureCounts[name] = self._failureCounts.get(name, 0) + 1
+        if (self.errorLogSampleRate < 1.0
+            and random.random() >= self.errorLogSampleRate):
+            return
+        why = None
+        limiter = self.getErrorLogLimiter()
+        if limiter is not None:
+            if not limiter.allow():
+                return
+            suppressed, limiter.suppressed = limiter.suppressed, 0
+            if suppressed:
+                why = '%d failures not logged' % suppressed
+        if reason.check(error.UnsupportedProtocol):
+            # the client speaks another protocol; there is no traceback
+            # worth logging.
+            message = "refused call: %s" % (reason.getErrorMessage(),)
+            if why is not None:
+                message = "%s (%s)" % (message, why)
+            log.msg(message)
+            return
+        log.err(reason, why)
+
+    def getFailureStatistics(self):
+        """Return the number of failed calls by qualified name of their
+        exception class.
+        """
+        return dict(self._failureCounts or {})
+
+    def getPayloadAccounting(self):
+        """Return the payload accounting of the servlet, or C{None} if
+        payloads are not accounted.
+        """
+        if self._payloadAccounting is None and self.accountPayloads:
+            self._payloadAccounting = accounting.PayloadAccounting()
+        return self._payloadAccounting
+
+    def getPayloadStatistics(self):
+        """Return payload sizes by method, keyed by C{(interfaceName,
+        methodName)}, or L{accounting.UNKNOWN} for requests that did not
+        resolve to a method.  See
+        L{accounting.PayloadAccounting.getStatistics}.
+        """
+        if self._payloadAccounting is None:
+            return {}
+        return self._payloadAccounting.getStatistics()
+
+    def getLimiterStatistics(self):
+        """Return counters of the limiters of the servlet.
+
+        The counters of the request limiter are found under the key
+        C{None}, and those of each remote method under the key
+        C{(interfaceName, methodName)}.
+        """
+        statistics = dict()
+        if self._requestLimiter is not None:
+            statistics[None] = self._requestLimiter.getStatistics()
+        for method, limiter in (self._methodLimiters or {}).iteritems():
+            key = (method.interface.__remote_name__, method.name)
+            statistics[key] = limiter.getStatistics()
+        return statistics
+
+    def getSchedulerStatistics(self):
+        """Return counters of the scheduler, by priority class.
+        """
+        if self._scheduler is None:
+            return {}
+        return self._scheduler.getStatistics()
 
     def processRequest(self, content):
         """Process request.
 
         Returns a deferred that will be invoked with the result (as a
-        string) that should be sent back to the client.
+        list of UTF-8 encoded byte strings) that should be sent back to
+        the client.
         """
         return Request(self).evaluate(content)
+
+    def processRequestNow(self, content):
+        """Process request.
+
+        Returns the response (or a failure) if it is ready at once, and a
+        deferred just like L{processRequest} otherwise.
+        """
+        return Request(self).evaluateNow(content)
+
+    def processParsedRequest(self, parser):
+        """Process a request whose body has been fed to an
+        L{IncrementalParser}.
+
+        Returns a deferred just like L{processRequest}.
+        """
+        return Request(self).evaluateParsed(parser)
+
+    def buildParser(self, maxSize=None):
+        """Return an L{IncrementalParser} that enforces the limits of the
+        servlet on a body while it is fed, and at most maxSize bytes.
+        """
+        if self.maxRequestSize is not None and (
+            maxSize is None or self.maxRequestSize < maxSize):
+            maxSize = self.maxRequestSize
+        return IncrementalParser(maxSize, self.maxTokens, self.maxStrings)
+
+    def processParsedRequestNow(self, parser):
+        """Process a parsed request.
+
+        Returns the response or a deferred, just like
+        L{processRequestNow}.
+        """
+        return Request(self).evaluateParsedNow(parser)
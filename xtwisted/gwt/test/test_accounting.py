@@ -0,0 +1,88 @@
+from twisted.trial import unittest
+
+from xtwisted.gwt import accounting
+from xtwisted.gwt.test.test_rpc import ThingServlet, Thing, buildRequest
+
+
+def sample(**kw):
+    values = dict.fromkeys(accounting.FIELDS, 0)
+    values.update(kw)
+    return values
+
+
+class PayloadAccountingTest(unittest.TestCase):
+    """Tests for aggregating payload sizes by method.
+    """
+
+    def setUp(self):
+        self.accounting = accounting.PayloadAccounting()
+
+    def test_aggregate(self):
+        """Verify that totals, maxima and means are kept per method.
+        """
+        self.accounting.add(('I', 'a'), sample(responseBytes=10))
+        self.accounting.add(('I', 'a'), sample(responseBytes=30))
+        stats = self.accounting.getStatistics()[('I', 'a')]
+        self.assertEquals(stats['calls'], 2)
+        self.assertEquals(stats['total']['responseBytes'], 40)
+        self.assertEquals(stats['max']['responseBytes'], 30)
+        self.assertEquals(stats['mean']['responseBytes'], 20.0)
+
+    def test_largest(self):
+        """Verify that methods are ranked by their largest payloads.
+        """
+        self.accounting.add(('I', 'a'), sample(responseBytes=10))
+        self.accounting.add(('I', 'b'), sample(responseBytes=1000))
+        self.accounting.add(('I', 'c'), sample(responseBytes=100))
+        self.assertEquals(self.accounting.getLargest('responseBytes', 2),
+                          [(1000, ('I', 'b')), (100, ('I', 'c'))])
+
+
+class ServletAccountingTest(unittest.TestCase):
+    """Tests for the payload accounting of servlets.
+    """
+
+    def setUp(self):
+        self.servlet = ThingServlet()
+        self.servlet.accountPayloads = True
+
+    def test_disabled(self):
+        """Verify that payloads are not accounted unless asked for.
+        """
+        servlet = ThingServlet()
+        servlet.thing = Thing(u'a')
+        servlet.processRequest(buildRequest(u'getThing'))
+        self.assertEquals(servlet.getPayloadStatistics(), {})
+
+    def test_request(self):
+        """Verify that the sizes of a request and its response are
+        accounted to the method.
+        """
+        self.servlet.things = [Thing(u'a'), Thing(u'bc')]
+        chunks = self.successResultOf(
+            self.servlet.processRequest(buildRequest(u'getThings')))
+        stats = self.servlet.getPayloadStatistics()[
+            (u'test.rpc.ThingService', u'getThings')]
+        self.assertEquals(stats['calls'], 1)
+        maximum = stats['max']
+        self.assertEquals(maximum['requestTokens'],
+                          len(buildRequest(u'getThings').split('|')))
+        self.assertEquals(maximum['requestStringBytes'],
+                          len(u'http://localhost/STRONGNAME'
+                              u'test.rpc.ThingServicegetThings'))
+        self.assertEquals(maximum['responseTokens'], 6)
+        self.assertEquals(maximum['responseObjects'], 3)
+        self.assertEquals(maximum['responseStringBytes'], len(chunks[3]))
+        self.assertEquals(maximum['responseBytes'], len(''.join(chunks)))
+        self.assertTrue(maximum['peakMemory'] > 0)
+
+    def test_unknown(self):
+        """Verify that requests for methods that do not exist are all
+        accounted under one key.
+        """
+        for methodName in (u'missing', u'other'):
+            self.servlet.processRequest(buildRequest(methodName))
+        self.flushLoggedErrors()
+        stats = self.servlet.getPayloadStatistics()
+        self.assertEquals(stats.keys(), [accounting.UNKNOWN])
+        self.assertEquals(stats[accounting.UNKNOWN]['calls'], 2)
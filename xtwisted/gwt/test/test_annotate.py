@@ -148,3 +148,27 @@ class BuilderTest(unittest.TestCase):
             self.builder.buildAnnotation, 'java.util.HashMap/123'
             )
 
+    def test_badSignatureCached(self):
+        """Test that a bad signature is not verified again.
+        """
+        calls = []
+        def generateSignature(typeInstance):
+            calls.append(typeInstance)
+            return 1
+        self.patch(annotation, 'generateSignature', generateSignature)
+        for i in range(2):
+            self.assertRaises(
+                error.BadSignature,
+                self.builder.buildAnnotation, 'java.util.HashMap/123'
+                )
+        self.assertEquals(len(calls), 1)
+
+    def test_unverified(self):
+        """Test that signatures are not verified, nor cached, if they are
+        not to be.
+        """
+        typeInstance = self.builder.buildAnnotation(
+            'java.util.HashMap/123', verify=False)
+        self.assertTrue(isinstance(typeInstance, annotation.HashMap))
+        self.assertEquals(self.builder.annotationCache, {})
+
@@ -0,0 +1,93 @@
+from twisted.trial import unittest
+
+from xtwisted.gwt import capture
+from xtwisted.gwt.test.test_rpc import ThingServlet, Thing, buildRequest
+from xtwisted.gwt.test.test_web import (ThingServlet as ThingResource,
+                                        requestFor)
+
+
+class TrafficCaptureTest(unittest.TestCase):
+    """Tests for capturing requests.
+    """
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.capture = capture.TrafficCapture(self.path)
+        self.addCleanup(self.capture.close)
+
+    def test_record(self):
+        """Verify that records are read back as they were written.
+        """
+        body = u'5|0|1|\xe5|'.encode('utf-8')
+        self.capture.record(body, 10, 0.5, 'OK')
+        self.capture.flush()
+        [record] = list(capture.readCapture(self.path))
+        self.assertEquals(record['body'], body)
+        self.assertEquals(record['responseSize'], 10)
+        self.assertEquals(record['duration'], 0.5)
+        self.assertEquals(record['status'], 'OK')
+
+    def test_sample(self):
+        """Verify that no requests are recorded at a zero sample rate.
+        """
+        self.capture.sampleRate = 0.0
+        self.assertFalse(self.capture.sample())
+        self.capture.sampleRate = 1.0
+        self.assertTrue(self.capture.sample())
+
+    def test_render(self):
+        """Verify that the servlet records the requests it renders.
+        """
+        servlet = ThingResource()
+        servlet.capture = self.capture
+        servlet.thing = Thing(u'a')
+        body = buildRequest(u'getThing')
+        request = requestFor(body)
+        servlet.render(request)
+        self.capture.flush()
+        [record] = list(capture.readCapture(self.path))
+        self.assertEquals(record['body'], body)
+        self.assertEquals(record['status'], 'OK')
+        self.assertEquals(record['responseSize'],
+                          len(''.join(request.written)))
+
+
+class ReplayTest(unittest.TestCase):
+    """Tests for replaying captured requests.
+    """
+
+    def test_getMethodName(self):
+        """Verify that the called method is found in a body.
+        """
+        self.assertEquals(capture.getMethodName(buildRequest(u'getThing')),
+                          (u'test.rpc.ThingService', u'getThing'))
+
+    def test_replay(self):
+        """Verify that calls are counted by method.
+        """
+        servlet = ThingServlet()
+        servlet.thing = Thing(u'a')
+        replayer = capture.Replayer(servlet)
+        d = replayer.replay([buildRequest(u'getThing')] * 2
+                            + [buildRequest(u'getThings')])
+        statistics = self.successResultOf(d)
+        self.assertEquals(
+            statistics[(u'test.rpc.ThingService', u'getThing')]['calls'], 2)
+        # the servlet has no things, so the call fails.
+        self.assertEquals(
+            statistics[(u'test.rpc.ThingService', u'getThings')]['errors'], 1)
+        self.flushLoggedErrors(AttributeError)
+
+    def test_malformed(self):
+        """Verify that bodies without a method are counted as errors, and
+        do not stop the replay.
+        """
+        servlet = ThingServlet()
+        servlet.thing = Thing(u'a')
+        replayer = capture.Replayer(servlet)
+        statistics = self.successResultOf(
+            replayer.replay(['7|0|', buildRequest(u'getThing')]))
+        self.assertEquals(statistics[capture.MALFORMED]['calls'], 1)
+        self.assertEquals(statistics[capture.MALFORMED]['errors'], 1)
+        self.assertEquals(
+            statistics[(u'test.rpc.ThingService', u'getThing')]['calls'], 1)
@@ -0,0 +1,364 @@
+from zope.interface import implements
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from xtwisted.gwt import annotation, gwttypes, rpc, error, client
+from xtwisted.gwt.interface import RemoteInterface, deferredValues
+from xtwisted.gwt.test.test_rpc import ThingType, Thing
+
+
+class NodeType(gwttypes.ObjectType):
+    __remote_name__ = 'test.client.Node'
+
+    label = annotation.RemoteAttribute(gwttypes.strType(), "label")
+    children = annotation.RemoteAttribute(gwttypes.ArrayListType(), "children")
+
+
+class Node(object):
+    gwttypes.instanceClassOf(NodeType)
+
+    def __init__(self, label=None, children=None):
+        self.label = label
+        self.children = children
+
+
+def buildChain(depth):
+    """Return a chain of depth nodes, each the only child of the one
+    before it.
+    """
+    node = None
+    for level in reversed(xrange(depth)):
+        node = Node(unicode(level), [node] if node is not None else [])
+    return node
+
+
+def getDepth(node):
+    depth = 0
+    while node is not None:
+        depth += 1
+        node = node.children[0] if node.children else None
+    return depth
+
+
+DEEP = 5000
+
+
+class RowType(gwttypes.ObjectType):
+    __remote_name__ = 'test.client.Row'
+
+    name = annotation.RemoteAttribute(gwttypes.strType(), "name")
+    count = annotation.RemoteAttribute(gwttypes.intType(), "count")
+    ratio = annotation.RemoteAttribute(gwttypes.doubleType(), "ratio")
+    stamp = annotation.RemoteAttribute(gwttypes.longType(), "stamp")
+    thing = annotation.RemoteAttribute(ThingType(), "thing")
+
+
+class Row(object):
+    gwttypes.instanceClassOf(RowType)
+
+    def __init__(self, name=None, count=0, ratio=0.0, stamp=0, thing=None):
+        self.name = name
+        self.count = count
+        self.ratio = ratio
+        self.stamp = stamp
+        self.thing = thing
+
+
+def buildRows(count):
+    return [Row(u'row%d' % (i % 3), i, i / 4.0, -i << 40,
+                i % 2 and Thing(u'schema%d' % i) or None)
+            for i in xrange(count)]
+
+
+def getRowValues(row):
+    return (row.name, row.count, row.ratio, row.stamp,
+            row.thing and row.thing.thingSchema)
+
+
+class IEchoService(RemoteInterface):
+    __remote_name__ = 'test.client.EchoService'
+
+    def echo(s):
+        return gwttypes.strType()
+
+    def add(a, b):
+        return gwttypes.intType()
+
+    def half(x):
+        return gwttypes.doubleType()
+
+    def negate(n):
+        return gwttypes.longType()
+
+    def getSchema(thing):
+        return gwttypes.strType()
+
+    def buildThing(schema):
+        return ThingType()
+
+    @deferredValues()
+    def buildThings(schemas):
+        return gwttypes.ArrayListType()
+
+    def getDepth(node):
+        return gwttypes.intType()
+
+    def buildChain(depth):
+        return NodeType()
+
+    def buildRows(count):
+        return gwttypes.ArrayListType(RowType())
+
+    def buildMixed():
+        return gwttypes.ArrayListType()
+
+    def ping():
+        return gwttypes.void
+
+    def expire():
+        return gwttypes.void
+
+
+class EchoServlet(rpc._ServiceServlet):
+    implements(IEchoService)
+
+    def echo(self, s):
+        return s
+
+    def add(self, a, b):
+        return a + b
+
+    def half(self, x):
+        return x / 2
+
+    def negate(self, n):
+        return -n
+
+    def getSchema(self, thing):
+        return thing.thingSchema
+
+    def buildThing(self, schema):
+        return Thing(schema)
+
+    def buildThings(self, schemas):
+        return [defer.succeed(Thing(schema)) for schema in schemas]
+
+    def getDepth(self, node):
+        return getDepth(node)
+
+    def buildChain(self, depth):
+        return buildChain(depth)
+
+    def buildRows(self, count):
+        return buildRows(count)
+
+    def buildMixed(self):
+        return buildRows(10) + [Thing(u'a'), None] + buildRows(10)
+
+    def ping(self):
+        self.pinged = True
+
+    def expire(self):
+        raise error.DeadlineExceeded()
+
+
+class ServiceProxyTest(unittest.TestCase):
+    """Tests for calling a servlet through the client.
+    """
+    version = 5
+
+    def setUp(self):
+        self.servlet = EchoServlet()
+        self.proxy = client.ServiceProxy(IEchoService, self.servlet)
+        self.proxy.version = self.version
+
+    def call(self, methodName, *args, **kw):
+        return self.successResultOf(
+            self.proxy.callRemote(methodName, *args, **kw))
+
+    def test_string(self):
+        """Verify that strings that need escaping survive a round trip.
+        """
+        value = u'it\'s "quoted"\n\\ 100% \xe5\u20ac\0'
+        self.assertEquals(self.call('echo', value), value)
+
+    def test_primitives(self):
+        """Verify that primitive arguments and results are encoded.
+        """
+        self.assertEquals(self.call('add', 2, 3), 5)
+        self.assertEquals(self.call('half', 3.0), 1.5)
+
+    def test_long(self):
+        """Verify that longs of any size survive a round trip.
+        """
+        for value in (0L, 1L, -1L, 1L << 40, (1L << 63) - 1, -(1L << 62),
+                      -1234567890123L):
+            self.assertEquals(self.call('negate', value), -value)
+
+    def test_object(self):
+        """Verify that objects are encoded and decoded.
+        """
+        self.assertEquals(self.call('getSchema', Thing(u'a')), u'a')
+        thing = self.call('buildThing', u'b')
+        self.assertIsInstance(thing, Thing)
+        self.assertEquals(thing.thingSchema, u'b')
+
+    def test_list(self):
+        """Verify that lists are encoded and decoded.
+        """
+        things = self.call('buildThings', [u'a', None, u'a'],
+                           argTypes=[gwttypes.ArrayListType()])
+        self.assertEquals([thing.thingSchema for thing in things],
+                          [u'a', None, u'a'])
+
+    def test_deepArgument(self):
+        """Verify that arguments nested deeper than the recursion limit
+        are encoded and decoded.
+        """
+        self.assertEquals(self.call('getDepth', buildChain(DEEP)), DEEP)
+
+    def test_deepResult(self):
+        """Verify that results nested deeper than the recursion limit are
+        encoded and decoded.
+        """
+        node = self.call('buildChain', DEEP)
+        self.assertEquals(getDepth(node), DEEP)
+        for level in xrange(DEEP):
+            self.assertEquals(node.label, unicode(level))
+            node = node.children[0] if node.children else None
+
+    def test_deepResultWithoutRecursion(self):
+        """Verify that results are written just as well when every object
+        is written by the explicit stack.
+        """
+        self.patch(rpc.Response, 'recursionDepth', 0)
+        self.assertEquals(getDepth(self.call('buildChain', 50)), 50)
+        things = self.call('buildThings', [u'a', None],
+                           argTypes=[gwttypes.ArrayListType()])
+        self.assertEquals([thing.thingSchema for thing in things],
+                          [u'a', None])
+
+    def test_rows(self):
+        """Verify that long lists of instances of one type, which are
+        written in one pass, survive a round trip.
+        """
+        rows = self.call('buildRows', 50)
+        self.assertEquals(map(getRowValues, rows),
+                          map(getRowValues, buildRows(50)))
+
+    def test_rowsOneByOne(self):
+        """Verify that lists that are too short to be written in one pass
+        are written one element at a time, just as well.
+        """
+        self.patch(rpc.Response, 'minBatchSize', 100)
+        rows = self.call('buildRows', 50)
+        self.assertEquals(map(getRowValues, rows),
+                          map(getRowValues, buildRows(50)))
+
+    def test_mixedRows(self):
+        """Verify that lists of instances of several classes survive a
+        round trip.
+        """
+        values = self.call('buildMixed')
+        self.assertEquals(map(getRowValues, values[:10] + values[12:]),
+                          map(getRowValues, buildRows(10) * 2))
+        self.assertEquals(values[10].thingSchema, u'a')
+        self.assertIdentical(values[11], None)
+
+    def test_void(self):
+        """Verify that methods without a result return None.
+        """
+        self.assertIdentical(self.call('ping'), None)
+        self.assertTrue(self.servlet.pinged)
+
+    def test_exception(self):
+        """Verify that an exception raised by the method is raised by the
+        client.
+        """
+        self.failureResultOf(self.proxy.callRemote('expire')).trap(
+            error.DeadlineExceeded)
+        self.flushLoggedErrors(error.DeadlineExceeded)
+
+    def test_noSuchMethod(self):
+        """Verify that methods must be part of the interface.
+        """
+        self.failureResultOf(self.proxy.callRemote('missing')).trap(KeyError)
+
+    def test_separator(self):
+        """Verify that strings that the servlet can not read are refused.
+        """
+        self.failureResultOf(self.proxy.callRemote('echo', u'a|b')).trap(
+            error.SerializationException)
+
+
+class ServiceProxyVersion6Test(ServiceProxyTest):
+    """Tests for calling a servlet with version 6 of the protocol.
+    """
+    version = 6
+
+
+class ServiceProxyVersion7Test(ServiceProxyTest):
+    """Tests for calling a servlet with version 7 of the protocol.
+    """
+    version = 7
+
+
+class CompactServiceProxyTest(ServiceProxyTest):
+    """Tests for calling a servlet that compacts its responses.
+    """
+
+    def setUp(self):
+        ServiceProxyTest.setUp(self)
+        self.servlet.compactPayloads = True
+
+
+class EncodeTest(unittest.TestCase):
+    """Tests for the encoding of calls.
+    """
+
+    def test_encodeCall(self):
+        """Verify the layout of the body of a call.
+        """
+        body = client.encodeCall(IEchoService, u'add', [2, 3],
+                                 moduleBaseURL=u'http://localhost/',
+                                 strongName=u'STRONGNAME')
+        self.assertEquals(
+            body,
+            '5|0|5|http://localhost/|STRONGNAME|test.client.EchoService|'
+            'add|I|1|2|3|4|2|5|5|2|3|')
+
+    def test_encodeLong(self):
+        """Verify that longs are sent as base-64 tokens from version 6.
+        """
+        body = client.encodeCall(IEchoService, u'negate', [-1L],
+                                 moduleBaseURL=u'http://localhost/',
+                                 strongName=u'STRONGNAME', version=7)
+        self.assertEquals(
+            body,
+            '7|0|5|http://localhost/|STRONGNAME|test.client.EchoService|'
+            'negate|J|1|2|3|4|1|5|P__________|')
+
+    def test_parseResponse(self):
+        """Verify that responses are split into their parts.
+        """
+        ok, tokens, strings, flags, version = client.parseResponse(
+            "//OK[2,1,0,['a','b\\x2C'],0,5]")
+        self.assertTrue(ok)
+        self.assertEquals(tokens, ['0', '1', '2'])
+        self.assertEquals(strings, [u'a', u'b,'])
+        self.assertEquals((flags, version), (0, 5))
+
+    def test_parseVoidResponse(self):
+        """Verify that a response without a payload is parsed.
+        """
+        ok, tokens, strings, flags, version = client.parseResponse(
+            "//OK[,[],0,5]")
+        self.assertEquals((tokens, strings), ([], []))
+
+    def test_malformed(self):
+        """Verify that bodies that are not responses are refused.
+        """
+        self.assertRaises(error.SerializationException,
+                          client.parseResponse, "<html>")
+        self.assertRaises(error.SerializationException,
+                          client.parseResponse, "//OK[1,[")
@@ -0,0 +1,140 @@
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from xtwisted.gwt import futures
+from xtwisted.gwt.test.test_rpc import ThingServlet, Thing, buildRequest
+
+
+class Future(object):
+    """Minimal future with the interface of asyncio futures.
+    """
+
+    def __init__(self):
+        self.callbacks = []
+        self._done = self._cancelled = False
+        self._result = self._exception = None
+
+    def add_done_callback(self, fn):
+        self.callbacks.append(fn)
+
+    def _finish(self):
+        self._done = True
+        for fn in self.callbacks:
+            fn(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def cancel(self):
+        if self._done:
+            return False
+        self._cancelled = True
+        self._finish()
+        return True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def exception(self):
+        return self._exception
+
+    def result(self):
+        return self._result
+
+
+class DeferredFromFutureTest(unittest.TestCase):
+    """Tests for bridging futures to deferreds.
+    """
+
+    def setUp(self):
+        self.patch(futures, 'futureTypes', futures.futureTypes)
+        futures.registerFutureType(Future)
+
+    def test_result(self):
+        """Verify that the deferred fires with the result of the future.
+        """
+        future = Future()
+        d = futures.toDeferred(future)
+        self.assertFalse(d.called)
+        future.set_result(1)
+        self.assertEquals(self.successResultOf(d), 1)
+
+    def test_exception(self):
+        """Verify that the deferred fails with the exception of the future.
+        """
+        future = Future()
+        d = futures.toDeferred(future)
+        future.set_exception(ValueError())
+        self.failureResultOf(d).trap(ValueError)
+
+    def test_cancel(self):
+        """Verify that cancelling the deferred cancels the future.
+        """
+        future = Future()
+        d = futures.toDeferred(future)
+        d.cancel()
+        self.assertTrue(future.cancelled())
+        self.failureResultOf(d).trap(defer.CancelledError)
+
+    def test_otherResults(self):
+        """Verify that other results are returned as they are.
+        """
+        self.assertEquals(futures.toDeferred(1), 1)
+        d = defer.Deferred()
+        self.assertIdentical(futures.toDeferred(d), d)
+
+    def test_unregistered(self):
+        """Verify that objects with an C{add_done_callback} method are not
+        futures unless their class is registered.
+        """
+        class Unregistered(object):
+            add_done_callback = Future.add_done_callback.im_func
+        value = Unregistered()
+        self.assertFalse(futures.isFuture(value))
+        self.assertIdentical(futures.toDeferred(value), value)
+        self.assertTrue(futures.isFuture(Future()))
+        futures.registerFutureType(Future)
+        self.assertEquals(futures.futureTypes.count(Future), 1)
+
+
+class ServletFutureTest(unittest.TestCase):
+    """Tests for remote methods that return futures.
+    """
+
+    def test_future(self):
+        """Verify that the response is written when the future completes.
+        """
+        self.patch(futures, 'futureTypes', futures.futureTypes)
+        futures.registerFutureType(Future)
+        servlet = ThingServlet()
+        servlet.thing = Future()
+        d = servlet.processRequest(buildRequest(u'getThing'))
+        self.assertFalse(d.called)
+        servlet.thing.set_result(Thing(u'a'))
+        self.assertTrue(''.join(self.successResultOf(d)).startswith('//OK'))
+
+    def test_coroutine(self):
+        """Verify that coroutines are run on the event loop.
+        """
+        asyncio = futures.asyncio
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        asyncio.set_event_loop(loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        @asyncio.coroutine
+        def getThing():
+            yield asyncio.From(asyncio.sleep(0))
+            raise asyncio.Return(Thing(u'a'))
+        servlet = ThingServlet()
+        servlet.getThing = getThing
+        d = servlet.processRequest(buildRequest(u'getThing'))
+        loop.run_until_complete(asyncio.sleep(0.01))
+        self.assertTrue(''.join(self.successResultOf(d)).startswith('//OK'))
+
+    if futures.asyncio is None or not hasattr(futures.asyncio, 'From'):
+        test_coroutine.skip = "trollius is not installed"
@@ -0,0 +1,139 @@
+from twisted.internet import defer, task
+from twisted.trial import unittest
+
+from xtwisted.gwt import limit, error
+from xtwisted.gwt.interface import INTERACTIVE, NORMAL, BULK
+
+
+class ConcurrencyLimiterTest(unittest.TestCase):
+    """Tests for the concurrency limiter.
+    """
+
+    def setUp(self):
+        self.limiter = limit.ConcurrencyLimiter(1, 1, task.Clock())
+
+    def test_admit(self):
+        """Verify that calls within the limit run right away.
+        """
+        d = self.limiter.run(lambda x: x, 1)
+        self.assertEquals(self.successResultOf(d), 1)
+        self.assertEquals(self.limiter.active, 0)
+        self.assertEquals(self.limiter.completed, 1)
+
+    def test_queue(self):
+        """Verify that calls beyond the limit wait for their turn.
+        """
+        first = defer.Deferred()
+        self.limiter.run(lambda: first)
+        d = self.limiter.run(lambda: 2)
+        self.assertFalse(d.called)
+        self.assertEquals(self.limiter.getStatistics()['queued'], 1)
+        first.callback(1)
+        self.assertEquals(self.successResultOf(d), 2)
+
+    def test_shed(self):
+        """Verify that calls are shed when the queue is full.
+        """
+        self.limiter.run(defer.Deferred)
+        self.limiter.run(defer.Deferred)
+        self.assertRaises(error.Overloaded, self.limiter.run, defer.Deferred)
+        self.assertEquals(self.limiter.shed, 1)
+
+    def test_cancelQueued(self):
+        """Verify that a cancelled call leaves the queue.
+        """
+        self.limiter.run(defer.Deferred)
+        d = self.limiter.run(defer.Deferred)
+        d.cancel()
+        self.failureResultOf(d).trap(defer.CancelledError)
+        self.assertEquals(self.limiter.getStatistics()['queued'], 0)
+
+    def test_drainQueue(self):
+        """Verify that queued calls that complete right away all get to
+        run.
+        """
+        self.limiter.maxQueued = 10
+        first = defer.Deferred()
+        self.limiter.run(lambda: first)
+        ds = [self.limiter.run(lambda: None) for i in range(10)]
+        first.callback(None)
+        self.assertEquals([d.called for d in ds], [True] * 10)
+
+
+class AdaptiveConcurrencyLimiterTest(unittest.TestCase):
+    """Tests for the adaptive concurrency limiter.
+    """
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.limiter = limit.AdaptiveConcurrencyLimiter(
+            10, clock=self.clock, targetLatency=1.0
+            )
+
+    def call(self, duration):
+        d = defer.Deferred()
+        self.limiter.run(lambda: d)
+        self.clock.advance(duration)
+        d.callback(None)
+
+    def test_decrease(self):
+        """Verify that the limit is cut when calls are slow.
+        """
+        self.call(2)
+        self.assertEquals(self.limiter.limit, 9)
+
+    def test_increase(self):
+        """Verify that the limit recovers when calls are fast, but not
+        beyond the maximum.
+        """
+        for i in range(5):
+            self.call(2)
+        for i in range(100):
+            self.call(0.5)
+        self.assertEquals(self.limiter.limit, 10)
+
+
+class PrioritySchedulerTest(unittest.TestCase):
+    """Tests for the priority scheduler.
+    """
+
+    def setUp(self):
+        self.scheduler = limit.PriorityScheduler(
+            2, {BULK: 1}, 10, task.Clock()
+            )
+
+    def test_budget(self):
+        """Verify that a class can not occupy more than its budget.
+        """
+        self.scheduler.run(BULK, defer.Deferred)
+        d = self.scheduler.run(BULK, lambda: None)
+        self.assertFalse(d.called)
+        d = self.scheduler.run(INTERACTIVE, lambda: 1)
+        self.assertEquals(self.successResultOf(d), 1)
+
+    def test_urgentFirst(self):
+        """Verify that waiting calls of an urgent class are admitted
+        before those of a less urgent class.
+        """
+        blockers = [defer.Deferred(), defer.Deferred()]
+        for blocker in blockers:
+            self.scheduler.run(NORMAL, lambda: blocker)
+        order = []
+        self.scheduler.run(BULK, order.append, BULK)
+        self.scheduler.run(NORMAL, order.append, NORMAL)
+        self.scheduler.run(INTERACTIVE, order.append, INTERACTIVE)
+        blockers[0].callback(None)
+        self.assertEquals(order, [INTERACTIVE, NORMAL, BULK])
+
+    def test_shed(self):
+        """Verify that calls are shed when the queue of their class is
+        full.
+        """
+        self.scheduler.maxQueued = 1
+        self.scheduler.run(BULK, defer.Deferred)
+        self.scheduler.run(BULK, defer.Deferred)
+        self.assertRaises(error.Overloaded,
+                          self.scheduler.run, BULK, defer.Deferred)
+        statistics = self.scheduler.getStatistics()
+        self.assertEquals(statistics[BULK]['shed'], 1)
+        self.assertEquals(statistics[BULK]['queued'], 1)
@@ -0,0 +1,109 @@
+from twisted.internet import task, error as ierror
+from twisted.python import failure
+from twisted.trial import unittest
+
+from xtwisted.gwt import multiproc
+
+
+class FakeTransport:
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.signals = []
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+
+
+class FakeReactor(task.Clock):
+    """Clock that records the processes it is asked to spawn.
+    """
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.spawned = []
+
+    def spawnProcess(self, protocol, executable, args, env=None,
+                     childFDs=None):
+        protocol.makeConnection(FakeTransport(protocol))
+        self.spawned.append((protocol, args, childFDs))
+
+
+def processEnded(protocol):
+    protocol.processEnded(failure.Failure(ierror.ProcessTerminated(1)))
+
+
+class SupervisorTest(unittest.TestCase):
+    """Tests for the supervisor of worker processes.
+    """
+
+    def setUp(self):
+        self.reactor = FakeReactor()
+        self.supervisor = multiproc.Supervisor(
+            'thing.ThingServlet', 0, '127.0.0.1', workers=2,
+            reactor=self.reactor)
+        self.supervisor.startService()
+        self.addCleanup(self.stopSupervisor)
+
+    def stopSupervisor(self):
+        d = self.supervisor.stopService()
+        for protocol in self.supervisor.workers.values():
+            processEnded(protocol)
+        return d
+
+    def test_start(self):
+        """Verify that workers inherit the listening socket.
+        """
+        self.assertEquals(len(self.reactor.spawned), 2)
+        protocol, args, childFDs = self.reactor.spawned[0]
+        self.assertEquals(childFDs[3], self.supervisor.socket.fileno())
+        self.assertIn('--worker', args)
+        self.assertEquals(args[-3:], ['--fd', '3', 'thing.ThingServlet'])
+
+    def test_reusePort(self):
+        """Verify that workers bind sockets of their own with SO_REUSEPORT.
+        """
+        supervisor = multiproc.Supervisor('thing.ThingServlet', 8080,
+                                          reusePort=True)
+        args = supervisor.getWorkerArguments()
+        self.assertIn('--reuse-port', args)
+        self.assertNotIn('--fd', args)
+
+    def test_restart(self):
+        """Verify that a worker that exits is restarted after a delay.
+        """
+        protocol = self.reactor.spawned[0][0]
+        processEnded(protocol)
+        self.assertEquals(len(self.reactor.spawned), 2)
+        self.reactor.advance(self.supervisor.restartDelay)
+        self.assertEquals(len(self.reactor.spawned), 3)
+        self.assertEquals(self.reactor.spawned[2][0].number, protocol.number)
+        self.assertEquals(self.supervisor.restarts, 1)
+
+    def test_stop(self):
+        """Verify that workers are terminated, and not restarted, when the
+        supervisor stops.
+        """
+        d = self.supervisor.stopService()
+        self.assertFalse(d.called)
+        for protocol, args, childFDs in self.reactor.spawned:
+            self.assertEquals(protocol.transport.signals, ['TERM'])
+            processEnded(protocol)
+        self.assertTrue(d.called)
+        self.reactor.advance(self.supervisor.restartDelay)
+        self.assertEquals(len(self.reactor.spawned), 2)
+        self.assertIdentical(self.supervisor.socket, None)
+
+
+class WarmUpTest(unittest.TestCase):
+
+    def test_warmUp(self):
+        """Verify that the resource is given a chance to warm up.
+        """
+        class Resource:
+            warm = False
+            def warmUp(self):
+                self.warm = True
+        resource = Resource()
+        multiproc.warmUp(resource)
+        self.assertTrue(resource.warm)
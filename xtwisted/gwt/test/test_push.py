@@ -0,0 +1,127 @@
+from zope.interface import implements
+from twisted.internet import defer, task
+from twisted.python import failure
+from twisted.trial import unittest
+
+from xtwisted.gwt import push, rpc, client
+from xtwisted.gwt.web import ServiceServlet
+from xtwisted.gwt.interface import RemoteInterface, longPoll
+from xtwisted.gwt.test.test_rpc import ThingType, Thing
+from xtwisted.gwt.test.test_web import requestFor
+
+
+class IUpdateService(RemoteInterface):
+    __remote_name__ = 'test.push.UpdateService'
+
+    @longPoll(30)
+    def getUpdate():
+        return ThingType()
+
+
+class UpdateServlet(ServiceServlet):
+    implements(IUpdateService)
+
+    def __init__(self):
+        ServiceServlet.__init__(self)
+        self.clock = task.Clock()
+        self.bus = push.EventBus()
+
+    def getUpdate(self):
+        return self.bus.wait('things')
+
+
+def buildPoll():
+    return client.encodeCall(IUpdateService, u'getUpdate', [])
+
+
+class EventBusTest(unittest.TestCase):
+    """Tests for the event bus.
+    """
+
+    def test_publish(self):
+        """Verify that everyone that waits on a topic gets the event.
+        """
+        bus = push.EventBus()
+        waiting = [bus.wait('a'), bus.wait('a'), bus.wait('b')]
+        event = object()
+        self.assertEquals(bus.publish('a', event), 2)
+        self.assertIdentical(self.successResultOf(waiting[0]), event)
+        self.assertIdentical(self.successResultOf(waiting[1]), event)
+        self.assertEquals(rpc.sharedResults, {})
+        self.assertFalse(waiting[2].called)
+        self.assertEquals(bus.getWaitingCount(), 1)
+        self.assertEquals(bus.publish('a', event), 0)
+
+    def test_cancel(self):
+        """Verify that cancelled waits are forgotten.
+        """
+        bus = push.EventBus()
+        d = bus.wait('a')
+        d.cancel()
+        self.failureResultOf(d).trap(defer.CancelledError)
+        self.assertEquals(bus.waiting, {})
+
+
+class LongPollTest(unittest.TestCase):
+    """Tests for long-polled remote methods.
+    """
+
+    def setUp(self):
+        self.servlet = UpdateServlet()
+
+    def test_event(self):
+        """Verify that waiting calls are answered with the published
+        event, which is serialized once.
+        """
+        requests = [requestFor(buildPoll()) for i in range(3)]
+        for request in requests:
+            self.servlet.render(request)
+        self.assertEquals([request.finished for request in requests],
+                          [0, 0, 0])
+        self.patch(rpc.Response, 'toChunks', countCalls(rpc.Response.toChunks))
+        self.servlet.bus.publish('things', Thing(u'a'))
+        bodies = [''.join(request.written) for request in requests]
+        self.assertTrue(bodies[0].startswith('//OK'))
+        self.assertEquals(bodies, [bodies[0]] * 3)
+        self.assertEquals(rpc.Response.toChunks.calls, 1)
+
+    def test_republish(self):
+        """Verify that an event changed in place and published again is
+        serialized again.
+        """
+        thing = Thing(u'a')
+        bodies = []
+        for schema in (u'a', u'b'):
+            thing.thingSchema = schema
+            request = requestFor(buildPoll())
+            self.servlet.render(request)
+            self.servlet.bus.publish('things', thing)
+            bodies.append(''.join(request.written))
+        self.assertIn("'a'", bodies[0])
+        self.assertIn("'b'", bodies[1])
+
+    def test_timeout(self):
+        """Verify that calls that wait too long are answered with null.
+        """
+        request = requestFor(buildPoll())
+        self.servlet.render(request)
+        self.servlet.clock.advance(30)
+        self.assertEquals(''.join(request.written), '//OK[0,[],0,5]')
+        self.assertEquals(self.servlet.bus.waiting, {})
+
+    def test_disconnect(self):
+        """Verify that the wait is cancelled when the client goes away.
+        """
+        request = requestFor(buildPoll())
+        self.servlet.render(request)
+        request.processingFailed(failure.Failure(Exception("lost")))
+        self.assertEquals(self.servlet.bus.waiting, {})
+        self.assertEquals(self.servlet.clock.getDelayedCalls(), [])
+
+
+def countCalls(f):
+    def wrapper(*args, **kw):
+        wrapper.calls += 1
+        return f(*args, **kw)
+    wrapper.calls = 0
+    return wrapper
@@ -0,0 +1,1226 @@
+from zope.interface import implements
+from twisted.internet import defer, task
+from twisted.python import log
+from twisted.trial import unittest
+
+from xtwisted.gwt import annotation, gwttypes, rpc, error, igwt, client
+from xtwisted.gwt.interface import RemoteInterface, deadline, concurrency
+from xtwisted.gwt.interface import priority, deferredValues, NORMAL, BULK
+
+
+class ThingType(gwttypes.ObjectType):
+    __remote_name__ = 'test.rpc.Thing'
+
+    thingSchema = annotation.RemoteAttribute(gwttypes.strType(), "schema")
+
+
+class Thing(object):
+    gwttypes.instanceClassOf(ThingType)
+
+    def __init__(self, thingSchema=None):
+        self.thingSchema = thingSchema
+
+
+class EntryType(gwttypes.ObjectType):
+    __remote_name__ = 'test.rpc.Entry'
+    cacheable = True
+
+    name = annotation.RemoteAttribute(gwttypes.strType(), "name")
+    thing = annotation.RemoteAttribute(ThingType(), "thing")
+
+
+class Entry(object):
+    gwttypes.instanceClassOf(EntryType)
+
+    def __init__(self, name=None, thing=None):
+        self.name = name
+        self.thing = thing
+
+
+class VersionedEntryType(EntryType):
+    __remote_name__ = 'test.rpc.VersionedEntry'
+
+    def getCacheKey(self, instance):
+        return instance.version
+
+
+class VersionedEntry(Entry):
+    gwttypes.instanceClassOf(VersionedEntryType)
+
+
+class StampType(gwttypes.ObjectType):
+    __remote_name__ = 'test.rpc.Stamp'
+    cacheable = True
+
+    millis = annotation.RemoteAttribute(gwttypes.longType(), "millis")
+
+
+class Stamp(object):
+    gwttypes.instanceClassOf(StampType)
+
+    def __init__(self, millis=0):
+        self.millis = millis
+
+
+class TaggedType(gwttypes.ObjectType):
+    __remote_name__ = 'test.rpc.Tagged'
+
+    name = annotation.RemoteAttribute(gwttypes.strType(), "name")
+    tags = annotation.RemoteAttribute(
+        gwttypes.ArrayListType(gwttypes.strType()), "tags")
+
+
+class Tagged(object):
+    gwttypes.instanceClassOf(TaggedType)
+
+    def __init__(self, name=None, tags=None):
+        self.name = name
+        self.tags = tags
+
+
+class IThingService(RemoteInterface):
+    __remote_name__ = 'test.rpc.ThingService'
+
+    def getThing():
+        return ThingType()
+
+    @deferredValues()
+    def getThings():
+        return gwttypes.ArrayListType()
+
+    @deadline(5)
+    @deferredValues()
+    def getSlowThing():
+        return ThingType()
+
+    @concurrency(1, 1)
+    def getLimitedThing():
+        return ThingType()
+
+    @priority(BULK)
+    def exportThings():
+        return gwttypes.ArrayListType()
+
+    def countThings(things):
+        return gwttypes.intType()
+
+
+class ThingServiceImpl:
+    implements(IThingService)
+
+    def getThing(self):
+        return self.thing
+
+    def getThings(self):
+        return self.things
+
+    def getSlowThing(self):
+        return self.thing
+
+    def getLimitedThing(self):
+        return self.thing
+
+    def exportThings(self):
+        return self.things
+
+    def countThings(self, things):
+        return len(things)
+
+
+class ThingServlet(rpc._ServiceServlet, ThingServiceImpl):
+    pass
+
+
+def buildRequest(methodName, version=5, flags=0):
+    """Build the body of a call to a method without arguments.
+    """
+    return client.encodeCall(IThingService, methodName, [],
+                             moduleBaseURL=u'http://localhost/',
+                             strongName=u'STRONGNAME', version=version,
+                             flags=flags)
+
+
+def buildRawRequest(methodName, strings, tokens):
+    """Build the body of a call to a method with arguments encoded by
+    tokens, that may be malformed.  Strings are added to the string
+    table from index 5.
+    """
+    strings = [u'http://localhost/', u'STRONGNAME',
+               IThingService.__remote_name__, methodName] + list(strings)
+    tokens = [5, 0, len(strings)] + strings + [1, 2, 3, 4] + list(tokens)
+    return (u'|'.join([unicode(t) for t in tokens]) + u'|').encode('utf-8')
+
+
+class ResolveDeferredsTest(unittest.TestCase):
+    """Tests for resolving deferreds before serialization.
+    """
+
+    def setUp(self):
+        self.servlet = ThingServlet()
+
+    def test_nothingToResolve(self):
+        """Verify that a graph without deferreds is passed through.
+        """
+        thing = Thing(u'a')
+        d = rpc.resolveDeferreds(thing)
+        d.addCallback(self.assertIdentical, thing)
+        return d
+
+    def test_resolveField(self):
+        """Verify that a deferred field value is replaced by its result.
+        """
+        pending = defer.Deferred()
+        thing = Thing(pending)
+        d = rpc.resolveDeferreds(thing)
+        self.assertFalse(d.called)
+        pending.callback(u'schema')
+        self.assertEquals(thing.thingSchema, u'schema')
+        self.assertIdentical(self.successResultOf(d), thing)
+
+    def test_resolveNested(self):
+        """Verify that deferreds in list elements, map values and in the
+        results of other deferreds are all resolved.
+        """
+        inner = defer.Deferred()
+        outer = defer.Deferred()
+        value = {u'key': [outer]}
+        d = rpc.resolveDeferreds(value)
+        outer.callback(Thing(inner))
+        self.assertFalse(d.called)
+        inner.callback(u'schema')
+        self.successResultOf(d)
+        self.assertEquals(value[u'key'][0].thingSchema, u'schema')
+
+    def test_failure(self):
+        """Verify that the first failure is reported.
+        """
+        d = rpc.resolveDeferreds([defer.fail(ValueError()), defer.Deferred()])
+        self.failureResultOf(d).trap(ValueError)
+
+    def test_serializeDeferredFields(self):
+        """Verify that a response with deferreds in it is serialized just
+        like one without.
+        """
+        self.servlet.things = [Thing(u'a'), Thing(u'b')]
+        expected = ''.join(self.successResultOf(
+            self.servlet.processRequest(buildRequest(u'getThings'))
+            ))
+        pending = [defer.Deferred(), defer.Deferred()]
+        self.servlet.things = [Thing(pending[0]), pending[1]]
+        d = self.servlet.processRequest(buildRequest(u'getThings'))
+        pending[1].callback(Thing(u'b'))
+        pending[0].callback(u'a')
+        self.assertEquals(''.join(self.successResultOf(d)), expected)
+        self.assertTrue(expected.startswith(u'//OK'))
+
+    def test_notDeclared(self):
+        """Verify that results of methods that are not declared to hold
+        deferreds are not searched for them.
+        """
+        searched = []
+        self.patch(rpc, '_findDeferreds', searched.append)
+        self.servlet.thing = Thing(u'a')
+        self.successResultOf(
+            self.servlet.processRequest(buildRequest(u'getThing')))
+        self.assertEquals(searched, [])
+
+
+class DeadlineTest(unittest.TestCase):
+    """Tests for per-method deadlines.
+    """
+
+    def setUp(self):
+        self.servlet = ThingServlet()
+        self.servlet.clock = task.Clock()
+
+    def test_declaration(self):
+        """Verify that the deadline is recorded on the remote method.
+        """
+        self.assertEquals(IThingService['getSlowThing'].deadline, 5)
+        self.assertIdentical(IThingService['getThing'].deadline, None)
+
+    def test_completeInTime(self):
+        """Verify that a call that completes in time is not affected.
+        """
+        self.servlet.thing = defer.Deferred()
+        d = self.servlet.processRequest(buildRequest(u'getSlowThing'))
+        self.servlet.clock.advance(4)
+        self.servlet.thing.callback(Thing(u'a'))
+        self.assertTrue(''.join(self.successResultOf(d)).startswith(u'//OK'))
+        self.assertEquals(self.servlet.clock.getDelayedCalls(), [])
+
+    def test_deadlineExceeded(self):
+        """Verify that a call is cancelled when its deadline passes, and
+        that the client is told so.
+        """
+        cancelled = []
+        self.servlet.thing = defer.Deferred(cancelled.append)
+        d = self.servlet.processRequest(buildRequest(u'getSlowThing'))
+        self.servlet.clock.advance(5)
+        self.assertEquals(len(cancelled), 1)
+        result = ''.join(self.successResultOf(d))
+        self.assertTrue(result.startswith(u'//EX'))
+        self.assertIn(u'DeadlineExceededException', result)
+        self.flushLoggedErrors(error.DeadlineExceeded)
+
+    def test_cancelResolution(self):
+        """Verify that deferreds held by the result are cancelled when the
+        deadline passes.
+        """
+        cancelled = []
+        self.servlet.thing = Thing(defer.Deferred(cancelled.append))
+        d = self.servlet.processRequest(buildRequest(u'getSlowThing'))
+        self.servlet.clock.advance(5)
+        self.assertEquals(len(cancelled), 1)
+        self.assertIn(u'DeadlineExceededException',
+                      ''.join(self.successResultOf(d)))
+        self.flushLoggedErrors(error.DeadlineExceeded)
+
+
+class SlowRequestTest(unittest.TestCase):
+    """Tests for the slow request log.
+    """
+
+    def setUp(self):
+        self.servlet = ThingServlet()
+        self.servlet.clock = task.Clock()
+        self.servlet.slowRequestThreshold = 1.0
+        self.messages = []
+        log.addObserver(self.observe)
+        self.addCleanup(log.removeObserver, self.observe)
+
+    def observe(self, event):
+        if event.get('slowRequest'):
+            self.messages.append(log.textFromEventDict(event))
+
+    def slowRequest(self, seconds):
+        self.servlet.thing = defer.Deferred()
+        d = self.servlet.processRequest(buildRequest(u'getThing'))
+        self.servlet.clock.advance(seconds)
+        self.servlet.thing.callback(Thing(u'a'))
+        return self.successResultOf(d)
+
+    def test_fast(self):
+        """Verify that requests within the threshold are not logged.
+        """
+        self.slowRequest(0.5)
+        self.assertEquals(self.messages, [])
+
+    def test_slow(self):
+        """Verify that slow requests are logged with timings and sizes.
+        """
+        chunks = self.slowRequest(2)
+        [message] = self.messages
+        self.assertIn('test.rpc.ThingService.getThing took 2.000s', message)
+        self.assertIn('invoke 2.000s', message)
+        self.assertIn('response 2 tokens, 2 strings, 1 objects, %d bytes'
+                      % len(''.join(chunks)), message)
+        self.assertIn('arguments ()', message)
+
+    def test_rateLimited(self):
+        """Verify that slow requests are not logged faster than the log
+        rate, and that those that were not logged are counted.
+        """
+        pending = [defer.Deferred(), defer.Deferred()]
+        for d in pending:
+            self.servlet.thing = d
+            self.servlet.processRequest(buildRequest(u'getThing'))
+        self.servlet.clock.advance(2)
+        for d in pending:
+            d.callback(Thing(u'a'))
+        self.assertEquals(len(self.messages), 1)
+        self.slowRequest(2)
+        self.assertEquals(len(self.messages), 2)
+        self.assertIn('(1 slow requests not logged)', self.messages[1])
+
+    def test_summarizeArguments(self):
+        """Verify that long argument summaries are truncated.
+        """
+        self.assertEquals(rpc.summarizeArguments([u'a', 1]), "(u'a', 1)")
+        summary = rpc.summarizeArguments([u'x' * 500])
+        self.assertEquals(len(summary), 202)
+        self.assertTrue(summary.endswith('...)'))
+
+
+class FailureTest(unittest.TestCase):
+    """Tests for the responses to, and the log of, failed calls.
+    """
+
+    def setUp(self):
+        self.patch(rpc, 'fragmentCache', rpc.FragmentCache())
+        self.servlet = ThingServlet()
+        self.servlet.clock = task.Clock()
+
+    def call(self, methodName, version=5):
+        return ''.join(self.successResultOf(
+            self.servlet.processRequest(buildRequest(methodName, version))))
+
+    def test_noSuchMethod(self):
+        """Verify that the name of a missing method is sent back, and that
+        names sent by clients are kept out of the fragment cache.
+        """
+        body = self.call(u'missing')
+        self.assertTrue(body.startswith('//EX'))
+        self.assertIn("'missing'", body)
+        self.assertIn("'other'", self.call(u'other'))
+        self.assertEquals(len(rpc.fragmentCache.entries), 0)
+        self.assertEquals(len(self.flushLoggedErrors(error.NoSuchMethod)), 2)
+
+    def test_cachedByClass(self):
+        """Verify that the serialized form of a cacheable exception is
+        reused for all exceptions of its class.
+        """
+        body = self.call(u'getThing', version=9)
+        self.assertTrue(body.startswith('//EX'))
+        self.assertEquals(self.call(u'getThing', version=9), body)
+        self.assertEquals(len(rpc.fragmentCache.entries), 1)
+        self.assertEquals(rpc.fragmentCache.hits, 1)
+        self.flushLoggedErrors(error.IncompatibleRemoteServiceException)
+
+    def test_cacheableWithFields(self):
+        """Verify that exceptions with fields can not be cacheable.
+        """
+        self.assertRaises(
+            ValueError, annotation.registerRuntimeException,
+            error.NoSuchMethod, 'test.rpc.BadException',
+            annotation.INoSuchMethodException, cacheable=True)
+
+    def test_rateLimited(self):
+        """Verify that failures are not logged faster than the log rate,
+        and that all are counted.
+        """
+        self.servlet.errorLogRate = 1.0
+        for i in range(3):
+            self.call(u'missing')
+        self.assertEquals(len(self.flushLoggedErrors(error.NoSuchMethod)), 1)
+        self.servlet.clock.advance(1)
+        self.call(u'missing')
+        self.assertEquals(len(self.flushLoggedErrors(error.NoSuchMethod)), 1)
+        self.assertEquals(self.servlet.getErrorLogLimiter().suppressed, 0)
+        self.assertEquals(self.servlet.getFailureStatistics(),
+                          {'xtwisted.gwt.error.NoSuchMethod': 4})
+
+    def test_sampled(self):
+        """Verify that failures outside the sample are counted, but not
+        logged.
+        """
+        self.servlet.errorLogSampleRate = 0.0
+        self.call(u'missing')
+        self.assertEquals(self.flushLoggedErrors(error.NoSuchMethod), [])
+        self.assertEquals(self.servlet.getFailureStatistics(),
+                          {'xtwisted.gwt.error.NoSuchMethod': 1})
+
+
+class MethodLimitTest(unittest.TestCase):
+    """Tests for per-method admission control.
+    """
+
+    def setUp(self):
+        self.servlet = ThingServlet()
+        self.servlet.thing = defer.Deferred()
+
+    def test_shed(self):
+        """Verify that calls beyond the queue are answered with a
+        ServiceOverloadedException.
+        """
+        ds = [self.servlet.processRequest(buildRequest(u'getLimitedThing'))
+              for i in range(3)]
+        self.assertEquals([d.called for d in ds[1:]], [False, True])
+        self.assertIn(u'ServiceOverloadedException',
+                      ''.join(self.successResultOf(ds[2])))
+        self.servlet.thing.callback(Thing(u'a'))
+        body = ''.join(self.successResultOf(ds[0]))
+        self.assertTrue(body.startswith(u'//OK'))
+
+    def test_statistics(self):
+        """Verify that the counters of the method limiter are exposed.
+        """
+        for i in range(3):
+            self.servlet.processRequest(buildRequest(u'getLimitedThing'))
+        statistics = self.servlet.getLimiterStatistics()
+        key = (IThingService.__remote_name__, 'getLimitedThing')
+        self.assertEquals(statistics[key]['shed'], 1)
+        self.assertEquals(statistics[key]['queued'], 1)
+
+
+class SchedulerTest(unittest.TestCase):
+    """Tests for scheduling calls by priority.
+    """
+
+    def setUp(self):
+        self.servlet = ThingServlet()
+        self.servlet.maxConcurrentCalls = 1
+
+    def test_declaration(self):
+        """Verify that the priority class is recorded on the remote method.
+        """
+        self.assertEquals(IThingService['exportThings'].priority, BULK)
+        self.assertEquals(IThingService['getThing'].priority, NORMAL)
+
+    def test_urgentFirst(self):
+        """Verify that a waiting call of a more urgent class is run before
+        a waiting bulk call.
+        """
+        self.servlet.thing = blocker = defer.Deferred()
+        self.servlet.processRequest(buildRequest(u'getThing'))
+        self.servlet.things = defer.Deferred()
+        bulk = self.servlet.processRequest(buildRequest(u'exportThings'))
+        self.servlet.thing = Thing(u'b')
+        normal = self.servlet.processRequest(buildRequest(u'getThing'))
+        statistics = self.servlet.getSchedulerStatistics()
+        self.assertEquals(statistics[NORMAL]['queued'], 1)
+        self.assertEquals(statistics[BULK]['queued'], 1)
+        blocker.callback(Thing(u'a'))
+        self.assertTrue(
+            ''.join(self.successResultOf(normal)).startswith(u'//OK'))
+        # the bulk call was admitted after the normal call completed.
+        statistics = self.servlet.getSchedulerStatistics()
+        self.assertEquals(statistics[BULK]['active'], 1)
+
+
+class FragmentCacheTest(unittest.TestCase):
+    """Tests for reusing the serialized form of cacheable instances.
+    """
+
+    def setUp(self):
+        self.patch(rpc, 'fragmentCache', rpc.FragmentCache(2))
+        self.servlet = ThingServlet()
+
+    def serialize(self, value, writeFirst=(), version=5):
+        response = rpc.Response(self.servlet)
+        response.version, response.flags = version, 0
+        for s in writeFirst:
+            response.writeString(s)
+        response.writeObject(value)
+        return response
+
+    def test_reuse(self):
+        """Verify that a cached instance is serialized just as when it is
+        not cached, with string indices mapped into the new response.
+        """
+        entry = Entry(u'entry', Thing(u'schema'))
+        first = self.serialize(entry).toString()
+        self.assertEquals(rpc.fragmentCache.misses, 1)
+        self.assertEquals(self.serialize(entry).toString(), first)
+        self.assertEquals(rpc.fragmentCache.hits, 1)
+        # with other strings written before it:
+        response = self.serialize(entry, [u'x', u'schema'])
+        self.assertEquals(response.stringTable, [
+            u'x', u'schema', annotation.getTypeSignature(EntryType()),
+            u'entry', annotation.getTypeSignature(ThingType())])
+        self.assertEquals(response.tokenStream[2:],
+                          [u'3', u'4', u'5', u'2'])
+        self.assertEquals(len(response.objectDatabase), 2)
+
+    def test_versionKey(self):
+        """Verify that instances with a version key share the cache entry
+        of their version.
+        """
+        first, second = VersionedEntry(u'a'), VersionedEntry(u'b')
+        first.version = second.version = 1
+        self.assertEquals(self.serialize(first).toString(),
+                          self.serialize(second).toString())
+        second.version = 2
+        self.assertNotEquals(self.serialize(first).toString(),
+                             self.serialize(second).toString())
+
+    def test_protocolVersions(self):
+        """Verify that an instance is cached apart for each protocol
+        version, as longs are written differently.
+        """
+        stamp = Stamp(1 << 40)
+        old = self.serialize(stamp, version=5).toString()
+        new = self.serialize(stamp, version=7).toString()
+        self.assertEquals(rpc.fragmentCache.misses, 2)
+        self.assertIn('"QAAAAAA"', new)
+        self.assertNotIn('"QAAAAAA"', old)
+        self.assertEquals(self.serialize(stamp, version=5).toString(), old)
+        self.assertEquals(self.serialize(stamp, version=7).toString(), new)
+        self.assertEquals(rpc.fragmentCache.hits, 2)
+
+    def test_evict(self):
+        """Verify that the least recently used entry is evicted.
+        """
+        entries = [Entry(u'a'), Entry(u'b'), Entry(u'c')]
+        for entry in entries:
+            self.serialize(entry)
+        self.assertNotIn((entries[0], EntryType()), rpc.fragmentCache)
+        self.assertIn((entries[2], EntryType()), rpc.fragmentCache)
+
+
+class ResponseTest(unittest.TestCase):
+    """Tests for writing responses.
+    """
+
+    def test_chunks(self):
+        """Verify that the response is written as byte strings, with
+        non-ASCII characters escaped.
+        """
+        response = rpc.Response(None)
+        response.version, response.flags = 5, 0
+        response.writeObject(Thing(u'\xe5\u20ac'))
+        chunks = response.toChunks('//OK')
+        self.assertEquals([type(chunk) for chunk in chunks],
+                          [str] * len(chunks))
+        expected = "//OK[2,1,['%s','\\xe5\\u20ac'],0,5]" % (
+            annotation.getTypeSignature(ThingType()),)
+        self.assertEquals(''.join(chunks), expected)
+
+    def test_batch(self):
+        """Verify that a list of instances of one class is written in one
+        pass, just like each instance on its own.
+        """
+        original = rpc.Response._writeBatch.im_func
+        batches = []
+        def writeBatch(response, values, declaredType):
+            written = original(response, values, declaredType)
+            batches.append(written)
+            return written
+        self.patch(rpc.Response, '_writeBatch', writeBatch)
+        things = [Thing(u'schema%d' % (i % 3)) for i in range(10)]
+        response = rpc.Response(None)
+        response.writeObject(things, gwttypes.ArrayListType(ThingType()))
+        self.assertEquals(batches, [True])
+        self.patch(rpc.Response, 'minBatchSize', 100)
+        expected = rpc.Response(None)
+        expected.writeObject(things, gwttypes.ArrayListType(ThingType()))
+        self.assertEquals(response.tokenStream, expected.tokenStream)
+        self.assertEquals(response.stringTable, expected.stringTable)
+        self.assertEquals(len(response.objectDatabase), 11)
+
+    def test_batchVariableWidth(self):
+        """Verify that a list whose instances write a field as different
+        numbers of tokens is written one instance at a time, without
+        leftovers of the attempt to write it in one pass.
+        """
+        values = [Tagged(u'n%d' % i, [u'a'] if i % 2 else [u'b', u'c', u'd'])
+                  for i in range(8)]
+        returnType = gwttypes.ArrayListType(TaggedType())
+        response = rpc.Response(None)
+        response.writeObject(values, returnType)
+        self.patch(rpc.Response, 'minBatchSize', 100)
+        expected = rpc.Response(None)
+        expected.writeObject(values, returnType)
+        self.assertEquals(response.tokenStream, expected.tokenStream)
+        self.assertEquals(response.stringTable, expected.stringTable)
+        self.assertEquals(len(response.objectDatabase),
+                          len(expected.objectDatabase))
+        decoded = client.decodeResponse(''.join(response.toChunks('//OK')),
+                                        returnType)
+        self.assertEquals([(value.name, value.tags) for value in decoded],
+                          [(value.name, value.tags) for value in values])
+
+    def test_formatDouble(self):
+        """Verify that doubles are written in their shortest form that
+        reads back as the same value.
+        """
+        for value, token in [(3.0, '3'), (-0.5, '-0.5'), (1e22, '1e22'),
+                             (1e-5, '1e-5'), (1000.0, '1e3'), (100.0, '100'),
+                             (1200000.0, '12e5'),
+                             (1 / 3.0, '0.3333333333333333'),
+                             (float('inf'), 'Infinity'),
+                             (float('-inf'), '-Infinity')]:
+            self.assertEquals(rpc.formatDouble(value), token)
+            self.assertEquals(float(token), value)
+        self.assertEquals(rpc.formatDouble(float('nan')), 'NaN')
+
+    def test_compactStringTable(self):
+        """Verify that strings are ordered by the number of references to
+        them, and that the references are rewritten.
+        """
+        response = rpc.Response(None)
+        response.compact = True
+        for s in [u'once', u'twice', u'thrice', u'twice', u'thrice',
+                  u'thrice', None]:
+            response.writeString(s)
+        response.writeInt(2)
+        response.compactStringTable()
+        self.assertEquals(response.stringTable,
+                          [u'thrice', u'twice', u'once'])
+        self.assertEquals(response.tokenStream,
+                          ['3', '2', '1', '2', '1', '1', '0', '2'])
+
+
+class VersionTest(unittest.TestCase):
+    """Tests for protocol versions.
+    """
+
+    def setUp(self):
+        self.servlet = ThingServlet()
+
+    def test_longToBase64(self):
+        """Verify that longs are encoded with the digits of GWT, without
+        leading zero digits.
+        """
+        self.assertEquals(rpc.longToBase64(0), 'A')
+        self.assertEquals(rpc.longToBase64(1), 'B')
+        self.assertEquals(rpc.longToBase64(64), 'BA')
+        self.assertEquals(rpc.longToBase64(-1), 'P__________')
+        self.assertEquals(rpc.longToBase64(-(1 << 63)), 'I' + 'A' * 10)
+
+    def test_longFromBase64(self):
+        """Verify that encoded longs are decoded.
+        """
+        for value in (0, 1, 63, 64, 1 << 40, (1 << 63) - 1, -1, -(1 << 63),
+                      -1234567890123):
+            self.assertEquals(
+                rpc.longFromBase64(rpc.longToBase64(value)), value)
+
+    def test_badLong(self):
+        """Verify that strings that are no encoded long are refused.
+        """
+        for encoded in ('', 'A*', 'A' * 12, 'a' * 11):
+            self.assertRaises(error.SerializationException,
+                              rpc.longFromBase64, encoded)
+
+    def test_readLong(self):
+        """Verify that longs are read as pairs of doubles in version 5,
+        and as base-64 strings later.
+        """
+        request = rpc.Request(None)
+        request.tokenStream = rpc.TokenStream(['1.0', '4.294967296E9'])
+        self.assertEquals(request.readLong(), (1 << 32) + 1)
+        for version in (6, 7):
+            request = rpc.Request(None)
+            request.version = version
+            request.tokenStream = rpc.TokenStream(['EAAAAB'])
+            self.assertEquals(request.readLong(), (1 << 32) + 1)
+
+    def test_writeLong(self):
+        """Verify that longs are written as pairs of doubles in version 5,
+        and as base-64 strings later.
+        """
+        response = rpc.Response(None)
+        response.writeLong((1 << 32) + 1)
+        self.assertEquals(len(response.tokenStream), 2)
+        for version in (6, 7):
+            response = rpc.Response(None)
+            response.version = version
+            response.writeLong((1 << 32) + 1)
+            self.assertEquals(response.tokenStream, ['"EAAAAB"'])
+
+    def assertIncompatible(self, body, version):
+        content = ''.join(self.successResultOf(
+            self.servlet.processRequest(body)))
+        self.assertTrue(content.startswith('//EX'))
+        self.assertIn(annotation.getTypeSignature(igwt.IType(
+            error.IncompatibleRemoteServiceException())), content)
+        self.assertTrue(content.endswith(',0,%d]' % version))
+        # refusals are logged without a traceback.
+        self.assertEquals(self.flushLoggedErrors(), [])
+
+    def test_supported(self):
+        """Verify that calls of supported versions are answered in their
+        version.
+        """
+        self.servlet.things = []
+        for version in range(1, rpc.MAX_VERSION + 1):
+            content = ''.join(self.successResultOf(
+                self.servlet.processRequest(
+                    buildRequest('getThings', version))))
+            self.assertTrue(content.startswith('//OK'))
+            self.assertTrue(content.endswith(',0,%d]' % version))
+
+    def test_unsupportedVersion(self):
+        """Verify that calls of later versions are refused, in the latest
+        supported version.
+        """
+        self.assertIncompatible(buildRequest('getThings', 8), 7)
+
+    def test_oldLong(self):
+        """Verify that versions before 6 read and write longs as pairs of
+        doubles.
+        """
+        for version in (3, 4, 5):
+            response = rpc.Response(None)
+            response.version = version
+            response.writeLong((1 << 32) + 1)
+            request = rpc.Request(None)
+            request.version = version
+            request.tokenStream = rpc.TokenStream(response.tokenStream)
+            self.assertEquals(len(response.tokenStream), 2)
+            self.assertEquals(request.readLong(), (1 << 32) + 1)
+
+    def test_unsupportedFlags(self):
+        """Verify that calls with flags that are not understood are
+        refused.
+        """
+        self.assertIncompatible(buildRequest('getThings', 7, 2), 7)
+
+
+class SynchronousTest(unittest.TestCase):
+    """Tests for writing responses without deferreds.
+    """
+
+    def setUp(self):
+        self.servlet = ThingServlet()
+
+    def test_plainValue(self):
+        """Verify that the response to a method that returns a plain value
+        is returned as is.
+        """
+        self.servlet.thing = Thing(u'a')
+        chunks = self.servlet.processRequestNow(buildRequest(u'getThing'))
+        self.assertIsInstance(chunks, list)
+        self.assertTrue(''.join(chunks).startswith('//OK'))
+
+    def test_exception(self):
+        """Verify that exceptions raised by the method are written right
+        away.
+        """
+        def getThing():
+            raise error.DeadlineExceeded()
+        self.servlet.getThing = getThing
+        chunks = self.servlet.processRequestNow(buildRequest(u'getThing'))
+        self.assertTrue(''.join(chunks).startswith('//EX'))
+        self.flushLoggedErrors(error.DeadlineExceeded)
+
+    def test_deferred(self):
+        """Verify that a deferred is returned when the method returns one,
+        or a value that holds one.
+        """
+        self.servlet.thing = defer.Deferred()
+        d = self.servlet.processRequestNow(buildRequest(u'getThing'))
+        self.assertIsInstance(d, defer.Deferred)
+        self.servlet.thing.callback(Thing(u'a'))
+        self.assertTrue(''.join(self.successResultOf(d)).startswith('//OK'))
+        self.servlet.things = [defer.succeed(Thing(u'a'))]
+        d = self.servlet.processRequestNow(buildRequest(u'getThings'))
+        self.assertTrue(''.join(self.successResultOf(d)).startswith('//OK'))
+
+
+class SerializedResultTest(unittest.TestCase):
+    """Tests for results that are serialized once.
+    """
+
+    def setUp(self):
+        self.servlet = ThingServlet()
+
+    def call(self, thing):
+        self.servlet.thing = thing
+        return ''.join(self.successResultOf(
+            self.servlet.processRequest(buildRequest(u'getThing'))))
+
+    def test_reused(self):
+        """Verify that a serialized result is written as the value would
+        be, without being serialized again.
+        """
+        thing = Thing(u'a')
+        result = rpc.SerializedResult(thing, ThingType())
+        self.assertEquals(''.join(result.serialize(5, 0)), self.call(thing))
+        thing.thingSchema = u'b'
+        self.assertEquals(self.call(result), ''.join(result.serialize(5, 0)))
+
+    def test_otherVersion(self):
+        """Verify that the value is serialized once for calls of each
+        protocol version.
+        """
+        thing = Thing(u'a')
+        result = rpc.SerializedResult(thing, ThingType(), version=6)
+        self.assertEquals([key[:2] for key in result.chunks], [(6, 0)])
+        body = self.call(result)
+        self.assertEquals(body, self.call(thing))
+        self.assertEquals(sorted(key[:2] for key in result.chunks),
+                          [(5, 0), (6, 0)])
+        self.patch(rpc, 'getResultWriter', None)
+        self.assertEquals(self.call(result), body)
+
+    def test_lazy(self):
+        """Verify that nothing is serialized up front without a version.
+        """
+        result = rpc.SerializedResult(Thing(u'a'), ThingType(), version=None)
+        self.assertEquals(result.chunks, {})
+        self.assertEquals(self.call(result), self.call(Thing(u'a')))
+
+    def test_returnType(self):
+        """Verify that the value is serialized once for each return type
+        that it is written as.
+        """
+        result = rpc.SerializedResult(None, version=None)
+        self.call(result)
+        self.servlet.things = result
+        self.successResultOf(
+            self.servlet.processRequest(buildRequest(u'getThings')))
+        self.assertEquals(len(result.chunks), 2)
+
+    def test_compact(self):
+        """Verify that the value is serialized with a compact string table
+        for servlets that compact payloads.
+        """
+        self.servlet.compactPayloads = True
+        result = rpc.SerializedResult(Thing(u'a'), ThingType(), version=None)
+        self.assertEquals(self.call(result), self.call(Thing(u'a')))
+        self.assertEquals([key[3] for key in result.chunks], [True])
+
+    def test_shared(self):
+        """Verify that calls answered with the same value by
+        L{rpc.shareResult} share its serialization.
+        """
+        thing = Thing(u'a')
+        bodies = []
+        def answer():
+            bodies.append(self.call(thing))
+            self.patch(rpc, 'getResultWriter', None)
+            bodies.append(self.call(thing))
+        rpc.shareResult(thing, answer)
+        self.assertEquals(bodies[0], bodies[1])
+        self.assertEquals(rpc.sharedResults, {})
+
+
+class TypedCollectionTest(unittest.TestCase):
+    """Tests for collections with declared element types.
+    """
+
+    def serialize(self, value, typeInstance):
+        response = rpc.Response(None)
+        response.version, response.flags = 5, 0
+        response.writeObject(value, typeInstance)
+        return response.toString()
+
+    def test_valueType(self):
+        """Verify that the declared type is used for direct instances of
+        its class, and that other values are adapted.
+        """
+        thingType = ThingType()
+        self.assertIdentical(
+            annotation.getValueType(Thing(), thingType), thingType)
+        entryType = EntryType()
+        self.assertIsInstance(
+            annotation.getValueType(VersionedEntry(), entryType),
+            VersionedEntryType)
+        self.assertIsInstance(
+            annotation.getValueType(u'a', thingType), annotation.String)
+
+    def test_unadaptedValueType(self):
+        """Verify that values of unregistered classes are written as the
+        declared type.
+        """
+        class Unregistered:
+            thingSchema = u'a'
+        thingType = ThingType()
+        self.assertIdentical(
+            annotation.getValueType(Unregistered(), thingType), thingType)
+        self.assertIdentical(annotation.getValueType(None, thingType),
+                             thingType)
+        self.assertEquals(self.serialize(Unregistered(), thingType),
+                          self.serialize(Thing(u'a'), thingType))
+
+    def test_serializerCached(self):
+        """Verify that the serializer of a type is looked up once, and
+        shared by equal types.
+        """
+        thingType = ThingType()
+        self.assertIdentical(annotation.getCustomFieldSerializer(thingType),
+                             annotation.getCustomFieldSerializer(ThingType()))
+        self.assertNotIn('__field_serializer__', thingType.__dict__)
+        listType = gwttypes.ArrayListType(EntryType())
+        self.assertIdentical(
+            annotation.getCustomFieldSerializer(listType),
+            annotation.getCustomFieldSerializer(
+                gwttypes.ArrayListType(EntryType())))
+        self.assertNotIdentical(
+            annotation.getCustomFieldSerializer(listType),
+            annotation.getCustomFieldSerializer(gwttypes.ArrayListType()))
+
+    def test_list(self):
+        """Verify that a typed list is written as an untyped one, also
+        when it holds subclasses and nulls.
+        """
+        first = VersionedEntry(u'a')
+        first.version = 1
+        values = [Entry(u'b'), first, None]
+        self.assertEquals(
+            self.serialize(values, gwttypes.ArrayListType(EntryType())),
+            self.serialize(values, gwttypes.ArrayListType()))
+
+    def test_map(self):
+        """Verify that a typed map is written as an untyped one.
+        """
+        values = {u'a': Thing(u'x'), u'b': None}
+        typed = gwttypes.HashMapType(gwttypes.strType(), ThingType())
+        self.assertEquals(self.serialize(values, typed),
+                          self.serialize(values, gwttypes.HashMapType()))
+
+
+class MethodDispatchTest(unittest.TestCase):
+    """Tests for the dispatch table of servlets.
+    """
+
+    def setUp(self):
+        self.servlet = ThingServlet()
+        self.servlet.thing = Thing(u'a')
+
+    def test_cached(self):
+        """Verify that a method is resolved once per argument signature.
+        """
+        interfaceName = IThingService.__remote_name__
+        first = self.servlet.getMethodDispatch(
+            interfaceName, u'getThing', ())
+        self.assertEquals(first.func, self.servlet.getThing)
+        self.assertIdentical(
+            self.servlet.getMethodDispatch(interfaceName, u'getThing', ()),
+            first)
+        self.assertEquals(len(self.servlet._dispatchTable), 1)
+
+    def test_call(self):
+        """Verify that calls are dispatched through the table.
+        """
+        for i in range(2):
+            chunks = self.successResultOf(
+                self.servlet.processRequest(buildRequest(u'getThing')))
+            self.assertTrue(''.join(chunks).startswith('//OK'))
+        self.assertEquals(len(self.servlet._dispatchTable), 1)
+
+    def test_wrongArgumentCount(self):
+        """Verify that calls with the wrong number of arguments are not
+        kept in the table.
+        """
+        self.servlet.getMethodDispatch(
+            IThingService.__remote_name__, u'getThing', (u'I',))
+        self.assertEquals(self.servlet._dispatchTable, {})
+
+    def test_noSuchMethod(self):
+        """Verify that methods that are not declared are refused.
+        """
+        self.assertRaises(error.NoSuchMethod, self.servlet.getMethodDispatch,
+                          IThingService.__remote_name__, u'missing', ())
+
+
+LIST_SIGNATURE = annotation.getTypeSignature(gwttypes.ArrayListType())
+THING_SIGNATURE = annotation.getTypeSignature(ThingType())
+
+
+def buildCountRequest(*tokens):
+    """Build the body of a call of countThings, with the list encoded by
+    tokens.  The list type is string 5 and the thing type string 6.
+    """
+    return buildRawRequest(u'countThings', [LIST_SIGNATURE, THING_SIGNATURE],
+                           (1, 5) + tokens)
+
+
+def buildPermutationRequest(thingSignature, strongName=u'STRONGNAME'):
+    """Build the body of a call of countThings with a list of one thing
+    of the given type signature.
+    """
+    body = buildRawRequest(u'countThings', [LIST_SIGNATURE, thingSignature],
+                           (1, 5, 5, 1, 6, 0))
+    return body.replace('STRONGNAME', strongName.encode('utf-8'))
+
+
+class PermutationTest(unittest.TestCase):
+    """Tests for the tracking of client builds.
+    """
+
+    def setUp(self):
+        self.servlet = ThingServlet()
+
+    def process(self, body):
+        return ''.join(self.successResultOf(self.servlet.processRequest(body)))
+
+    def test_statistics(self):
+        """Verify that calls and bad signatures are counted by strong
+        name.
+        """
+        self.process(buildPermutationRequest(THING_SIGNATURE, u'A'))
+        self.process(buildPermutationRequest(THING_SIGNATURE, u'A'))
+        result = self.process(buildPermutationRequest(
+            u'test.rpc.Thing/1', u'B'))
+        self.assertTrue(result.startswith('//EX'))
+        self.flushLoggedErrors(error.BadSignature)
+        self.assertEquals(self.servlet.getPermutationStatistics(), {
+            u'A': {'calls': 2, 'badSignatures': 0, 'trusted': False},
+            u'B': {'calls': 1, 'badSignatures': 1, 'trusted': False}})
+
+    def test_trusted(self):
+        """Verify that signatures of a build are trusted once a call of it
+        has been verified.
+        """
+        self.servlet.trustVerifiedPermutations = True
+        badSignature = u'test.rpc.Thing/2'
+        self.assertTrue(self.process(buildPermutationRequest(
+            badSignature, u'C')).startswith('//EX'))
+        self.assertTrue(self.process(buildPermutationRequest(
+            THING_SIGNATURE, u'D')).startswith('//OK'))
+        # the signature of the last call was verified, so D is trusted.
+        self.assertTrue(self.process(buildPermutationRequest(
+            u'test.rpc.Thing/3', u'D')).startswith('//OK'))
+        # builds that sent a bad signature are not trusted.
+        self.process(buildPermutationRequest(THING_SIGNATURE, u'C'))
+        self.assertFalse(self.servlet.getPermutation(u'C').trusted)
+        self.flushLoggedErrors(error.BadSignature)
+
+    def test_trustedWithoutSignatures(self):
+        """Verify that calls without type signatures do not make a build
+        trusted.
+        """
+        self.servlet.trustVerifiedPermutations = True
+        self.servlet.thing = Thing(u'a')
+        self.process(buildRequest(u'getThing'))
+        self.assertFalse(self.servlet.getPermutation(u'STRONGNAME').trusted)
+        result = self.process(buildPermutationRequest(u'test.rpc.Thing/3'))
+        self.assertTrue(result.startswith('//EX'))
+        self.flushLoggedErrors(error.BadSignature)
+
+    def test_maxPermutations(self):
+        """Verify that the least recently seen builds are forgotten.
+        """
+        self.servlet.maxPermutations = 2
+        for strongName in (u'A', u'B', u'A', u'C'):
+            self.process(buildPermutationRequest(THING_SIGNATURE, strongName))
+        statistics = self.servlet.getPermutationStatistics()
+        self.assertEquals(sorted(statistics), [u'A', u'C'])
+        self.assertEquals(statistics[u'A']['calls'], 2)
+
+
+class RequestLimitTest(unittest.TestCase):
+    """Tests for the limits on requests.
+    """
+
+    def setUp(self):
+        self.servlet = ThingServlet()
+
+    def process(self, body):
+        return ''.join(self.successResultOf(self.servlet.processRequest(body)))
+
+    def assertLimitExceeded(self, body):
+        result = self.process(body)
+        self.assertTrue(result.startswith('//EX'))
+        self.assertIn('LimitExceededException', result)
+
+    def test_withinLimits(self):
+        """Verify that requests within the limits are processed.
+        """
+        self.servlet.maxCollectionLength = 3
+        self.servlet.maxDepth = 2
+        self.servlet.maxObjects = 4
+        result = self.process(buildCountRequest(5, 3, 6, 0, 6, 0, 6, 0))
+        self.assertEquals(result, "//OK[3,[],0,5]")
+
+    def test_badLength(self):
+        """Verify that a collection can not claim more elements than there
+        are tokens left, whatever the limits.
+        """
+        result = self.process(buildCountRequest(5, 1000000000))
+        self.assertTrue(result.startswith('//EX'))
+        self.flushLoggedErrors(error.SerializationException)
+
+    def test_collectionLength(self):
+        self.servlet.maxCollectionLength = 2
+        self.assertLimitExceeded(buildCountRequest(5, 3, 6, 0, 6, 0, 6, 0))
+
+    def test_depth(self):
+        self.servlet.maxDepth = 3
+        self.assertLimitExceeded(buildCountRequest(5, 1, 5, 1, 5, 1, 5, 0))
+
+    def test_objects(self):
+        self.servlet.maxObjects = 3
+        self.assertLimitExceeded(buildCountRequest(5, 3, 6, 0, 6, 0, 6, 0))
+
+    def test_tokens(self):
+        """Verify that the tokens are counted before they are split.
+        """
+        self.servlet.maxTokens = 10
+        self.assertRaises(error.LimitExceeded, self.servlet.processRequest,
+                          buildCountRequest(5, 0))
+
+    def test_tokensBeforeDecoding(self):
+        """Verify that the tokens are counted before the body is decoded.
+        """
+        self.servlet.maxTokens = 10
+        self.assertRaises(error.LimitExceeded, self.servlet.processRequest,
+                          buildCountRequest(5, 0) + '\xff|' * 10)
+
+    def test_strings(self):
+        self.servlet.maxStrings = 5
+        self.assertRaises(error.LimitExceeded, self.servlet.processRequest,
+                          buildCountRequest(5, 0))
+
+    def test_size(self):
+        body = buildCountRequest(5, 0)
+        self.servlet.maxRequestSize = len(body) - 1
+        self.assertRaises(error.LimitExceeded, self.servlet.processRequest,
+                          body)
+
+    def test_parsedSize(self):
+        """Verify that a parser stops parsing a body that is too large.
+        """
+        body = buildRequest(u'getThing')
+        parser = rpc.IncrementalParser(maxSize=len(body) - 1)
+        parser.feed(body[:10])
+        parser.feed(body[10:])
+        self.assertEquals(list(parser.tokenStream), [])
+        self.assertRaises(error.LimitExceeded,
+                          self.servlet.processParsedRequest, parser)
+
+    def test_parsedStrings(self):
+        self.servlet.maxStrings = 5
+        parser = rpc.IncrementalParser()
+        parser.feed(buildCountRequest(5, 0))
+        self.assertRaises(error.LimitExceeded,
+                          self.servlet.processParsedRequest, parser)
+
+
+class IncrementalParserTest(unittest.TestCase):
+    """Tests for parsing request bodies while they arrive.
+    """
+
+    def test_byteByByte(self):
+        """Verify that a body fed a byte at a time is parsed like a
+        body that is read at once, including characters that are split
+        between chunks.
+        """
+        body = buildRequest(u'getThing').replace(
+            'STRONGNAME', u'STR\xe5\u20acNG'.encode('utf-8'))
+        parser = rpc.IncrementalParser()
+        for c in body:
+            parser.feed(c)
+        self.assertTrue(parser.isComplete())
+        parser.finish()
+        self.assertEquals((parser.version, parser.flags), (5, 0))
+        self.assertEquals(parser.stringTable[2], u'STR\xe5\u20acNG')
+        self.assertEquals(list(parser.tokenStream),
+                          body.decode('utf-8').split(u'|'))
+        self.assertEquals(parser.getBody(), body)
+
+    def test_headerFirst(self):
+        """Verify that the header and string table are parsed before the
+        rest of the body has arrived.
+        """
+        body = buildRequest(u'getThing')
+        parser = rpc.IncrementalParser()
+        parser.feed(body[:body.index('|1|2|') + 1])
+        self.assertTrue(parser.isComplete())
+        self.assertEquals(parser.stringTable[4], u'getThing')
+
+    def test_tokens(self):
+        """Verify that a body with too many tokens is dropped as it is
+        fed.
+        """
+        body = buildRequest(u'getThing')
+        parser = rpc.IncrementalParser(maxTokens=5)
+        parser.feed(body[:body.index('|1|2|') + 1])
+        parser.error.trap(error.LimitExceeded)
+        self.assertEquals(list(parser.tokenStream), [])
+        self.assertFalse(parser.finished)
+
+    def test_error(self):
+        """Verify that a malformed body is reported when evaluated.
+        """
+        parser = rpc.IncrementalParser()
+        parser.feed('5|x|')
+        parser.feed('1|')
+        self.assertRaises(ValueError,
+                          ThingServlet().processParsedRequest, parser)
+
+    def test_evaluate(self):
+        """Verify that a parsed request is evaluated.
+        """
+        servlet = ThingServlet()
+        servlet.thing = Thing(u'a')
+        body = buildRequest(u'getThing')
+        parser = rpc.IncrementalParser()
+        parser.feed(body)
+        parsed = servlet.processParsedRequest(parser)
+        self.assertEquals(
+            ''.join(self.successResultOf(parsed)),
+            ''.join(self.successResultOf(servlet.processRequest(body))))
@@ -0,0 +1,154 @@
+from StringIO import StringIO
+
+from twisted.internet import defer
+from twisted.python import failure
+from twisted.trial import unittest
+from twisted.web import server
+from twisted.web.test.test_web import DummyRequest, DummyChannel
+
+from xtwisted.gwt import error
+from xtwisted.gwt.web import ServiceServlet, ServiceRequest
+from xtwisted.gwt.test.test_rpc import ThingServiceImpl, Thing, buildRequest
+
+
+class ThingServlet(ServiceServlet, ThingServiceImpl):
+    pass
+
+
+def requestFor(body):
+    request = DummyRequest([''])
+    request.method = 'POST'
+    request.content = StringIO(body)
+    return request
+
+
+class ServiceServletTest(unittest.TestCase):
+    """Tests for the twisted.web integration.
+    """
+
+    def setUp(self):
+        self.servlet = ThingServlet()
+
+    def test_render(self):
+        """Verify that the response is written and the request finished.
+        """
+        self.servlet.thing = Thing(u'a')
+        request = requestFor(buildRequest(u'getThing'))
+        self.assertEquals(self.servlet.render(request), server.NOT_DONE_YET)
+        self.assertEquals(request.finished, 1)
+        body = ''.join(request.written)
+        self.assertTrue(body.startswith('//OK'))
+        self.assertEquals(request.outgoingHeaders['content-length'],
+                          len(body))
+
+    def test_cancelOnDisconnect(self):
+        """Verify that the call is cancelled, and nothing is written, when
+        the client goes away.
+        """
+        cancelled = []
+        self.servlet.thing = defer.Deferred(cancelled.append)
+        request = requestFor(buildRequest(u'getThing'))
+        self.servlet.render(request)
+        request.processingFailed(failure.Failure(Exception("lost")))
+        self.assertEquals(len(cancelled), 1)
+        self.assertEquals(request.written, [])
+        self.assertEquals(request.finished, 0)
+
+    def test_shed(self):
+        """Verify that requests beyond the servlet limit are answered with
+        503.
+        """
+        self.servlet.maxConcurrentRequests = 1
+        self.servlet.thing = defer.Deferred()
+        first = requestFor(buildRequest(u'getThing'))
+        self.servlet.render(first)
+        request = requestFor(buildRequest(u'getThing'))
+        self.assertEquals(self.servlet.render(request), '')
+        self.assertEquals(request.responseCode, 503)
+        self.servlet.thing.callback(Thing(u'a'))
+        self.assertEquals(first.finished, 1)
+
+    def test_limitExceeded(self):
+        """Verify that requests that exceed a limit are answered with 413.
+        """
+        self.servlet.maxRequestSize = 10
+        request = requestFor(buildRequest(u'getThing'))
+        self.servlet.render(request)
+        self.assertEquals(request.responseCode, 413)
+        self.assertEquals(request.finished, 1)
+
+
+class ServiceRequestTest(unittest.TestCase):
+    """Tests for the request that parses bodies while they arrive.
+    """
+
+    def buildRequest(self, contentType):
+        request = ServiceRequest(DummyChannel(), 1)
+        request.requestHeaders.setRawHeaders('content-type', [contentType])
+        return request
+
+    def test_parse(self):
+        """Verify that GWT RPC bodies are fed to a parser, and not kept.
+        """
+        servlet = ThingServlet()
+        servlet.thing = Thing(u'a')
+        request = self.buildRequest('text/x-gwt-rpc; charset=utf-8')
+        body = buildRequest(u'getThing')
+        request.gotLength(len(body))
+        request.handleContentChunk(body[:10])
+        request.handleContentChunk(body[10:])
+        self.assertEquals(request.content.getvalue(), '')
+        self.assertEquals(request.parser.size, len(body))
+        d = servlet._process(request)
+        self.assertTrue(''.join(self.successResultOf(d)).startswith('//OK'))
+
+    def test_tooLarge(self):
+        """Verify that bodies larger than the limit are not parsed, and
+        that the request is rejected.
+        """
+        servlet = ThingServlet()
+        request = self.buildRequest('text/x-gwt-rpc; charset=utf-8')
+        request.maxContentLength = 10
+        body = buildRequest(u'getThing')
+        request.gotLength(len(body))
+        request.handleContentChunk(body)
+        self.assertEquals(list(request.parser.tokenStream), [])
+        self.assertRaises(error.LimitExceeded, servlet._process, request)
+
+    def test_servletLimits(self):
+        """Verify that the limits of the servlet of the site are enforced
+        while the body arrives, before it is finished.
+        """
+        servlet = ThingServlet()
+        servlet.maxStrings = 2
+        request = self.buildRequest('text/x-gwt-rpc; charset=utf-8')
+        request.channel.site = server.Site(servlet)
+        body = buildRequest(u'getThing')
+        request.gotLength(len(body))
+        request.handleContentChunk(body[:body.index('|1|2|') + 1])
+        self.assertFalse(request.parser.finished)
+        request.parser.error.trap(error.LimitExceeded)
+        self.assertEquals(list(request.parser.tokenStream), [])
+        request.handleContentChunk(body[body.index('|1|2|') + 1:])
+        self.assertRaises(error.LimitExceeded, servlet._process, request)
+
+    def test_servletRequestSize(self):
+        """Verify that a body larger than the servlet accepts is rejected
+        by its length alone.
+        """
+        servlet = ThingServlet()
+        body = buildRequest(u'getThing')
+        servlet.maxRequestSize = len(body) - 1
+        request = self.buildRequest('text/x-gwt-rpc; charset=utf-8')
+        request.channel.site = server.Site(servlet)
+        request.gotLength(len(body))
+        request.parser.error.trap(error.LimitExceeded)
+
+    def test_otherContent(self):
+        """Verify that other bodies are buffered as usual.
+        """
+        request = self.buildRequest('text/plain')
+        request.gotLength(3)
+        request.handleContentChunk('abc')
+        self.assertIdentical(request.parser, None)
+        self.assertEquals(request.content.getvalue(), 'abc')
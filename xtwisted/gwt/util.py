@@ -38,3 +38,40 @@ class Registry:
         return (key in self.values)
 
     
+
+
+class RateLimiter:
+    """Token bucket that allows a number of events per second, with
+    bursts of up to C{burst} events.
+
+    @ivar suppressed: Number of events that have not been allowed since
+        an event last was.
+    """
+
+    def __init__(self, rate, burst=1, clock=None):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.suppressed = 0
+        self._last = None
+
+    def seconds(self):
+        clock = self.clock
+        if clock is None:
+            from twisted.internet import reactor as clock
+        return clock.seconds()
+
+    def allow(self):
+        """Return true if an event is allowed to happen now.
+        """
+        now = self.seconds()
+        if self._last is not None:
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self.tokens < 1:
+            self.suppressed += 1
+            return False
+        self.tokens -= 1
+        return True
@@ -1,25 +1,171 @@
 # integration with twisted.web
 
-from twisted.web import resource, server, iweb
-from twisted.python import log, context
-from xtwisted.gwt import rpc
+from cStringIO import StringIO
+
+from twisted.internet import defer
+from twisted.web import resource, server, http
+from twisted.python import log, context, failure
+from xtwisted.gwt import rpc, error
 
 
 class ServiceServlet(rpc._ServiceServlet, resource.Resource):
     """Service servlet to be used with TwistedWeb.
+
+    @cvar capture: L{capture.TrafficCapture} that a sample of the
+        requests is recorded to, or C{None}.
     """
     isLeaf = True
     encoding = "UTF-8"
+    capture = None
 
     def render(self, request):
-        def finish(content):
-            content = content.encode('utf-8')
-            # FIXME: do we need to set the content-length header?
-            request.setHeader("Content-Type", "text/x-gwt-rpc; charset=utf-8")
-            request.setHeader("Content-length", len(content))
-            request.write(content)
-            request.finish()
-        procDeferred = context.call({iweb.IResource: request}, self.processRequest, request.content.read())
-        procDeferred.addBoth(finish).addErrback(log.err)
+        started = None
+        if self.capture is not None and self.capture.sample():
+            started = self.getClock().seconds()
+        limiter = self.getRequestLimiter()
+        if limiter is None:
+            try:
+                result = self._processNow(request)
+            except:
+                result = failure.Failure()
+            if not isinstance(result, defer.Deferred):
+                # the response is ready; write it without a deferred.
+                if started is not None:
+                    result = self._capture(result, request, started)
+                self._respond(result, request, [])
+                return server.NOT_DONE_YET
+            procDeferred = result
+        else:
+            try:
+                procDeferred = limiter.run(self._processNow, request)
+            except error.Overloaded:
+                request.setResponseCode(http.SERVICE_UNAVAILABLE)
+                return ''
+        finished = request.notifyFinish()
+        # stop working on the request if the client goes away.
+        disconnected = []
+        def connectionLost(reason):
+            disconnected.append(reason)
+            procDeferred.cancel()
+        finished.addErrback(connectionLost)
+        if started is not None:
+            procDeferred.addBoth(self._capture, request, started)
+        procDeferred.addBoth(self._respond, request, disconnected)
         return server.NOT_DONE_YET
 
+    def _process(self, request):
+        return rpc.asDeferred(self._processNow(request))
+
+    def _processNow(self, request):
+        ctx = {resource.IResource: request}
+        parser = getattr(request, 'parser', None)
+        if parser is not None:
+            return context.call(ctx, self.processParsedRequestNow, parser)
+        return context.call(ctx, self.processRequestNow,
+                            request.content.read())
+
+    def _capture(self, result, request, started):
+        """Record the request and the outcome of processing it.
+        """
+        parser = getattr(request, 'parser', None)
+        if parser is not None:
+            body = parser.getBody()
+        else:
+            request.content.seek(0)
+            body = request.content.read()
+        if isinstance(result, failure.Failure):
+            responseSize, status = 0, 'error'
+        else:
+            responseSize = sum(map(len, result))
+            status = result[0][2:4]
+        try:
+            self.capture.record(body, responseSize,
+                                self.getClock().seconds() - started, status)
+        except Exception:
+            log.err(None, "could not capture request")
+        return result
+
+    def _respond(self, result, request, disconnected):
+        """Write the response, or report the failure to produce one.
+        """
+        try:
+            if isinstance(result, failure.Failure):
+                self._ebRender(result, request, disconnected)
+            else:
+                self._cbRender(result, request)
+        except:
+            log.err()
+
+    def _cbRender(self, chunks, request):
+        request.setHeader("Content-Type", "text/x-gwt-rpc; charset=utf-8")
+        request.setHeader("Content-length", sum(map(len, chunks)))
+        for chunk in chunks:
+            request.write(chunk)
+        request.finish()
+
+    def _ebRender(self, reason, request, disconnected):
+        if disconnected:
+            # the connection is gone, there is no one to respond to.
+            return
+        if reason.check(error.LimitExceeded):
+            request.setResponseCode(http.REQUEST_ENTITY_TOO_LARGE)
+        else:
+            log.err(reason)
+            request.setResponseCode(http.INTERNAL_SERVER_ERROR)
+        request.finish()
+
+
+class ServiceRequest(server.Request):
+    """Request that parses GWT RPC bodies while they arrive.
+
+    Use it as the request factory of the site, to let parsing overlap
+    with the transfer of large bodies:
+
+        site = server.Site(ThingServlet())
+        site.requestFactory = ServiceRequest
+
+    Bodies of other content types are buffered as usual.  If the servlet
+    is the resource of the site, its limits on the size, the tokens and
+    the strings of a request are enforced while the body arrives; other
+    servlets check them once it has been parsed.
+
+    @ivar parser: The L{rpc.IncrementalParser} that the body is fed to,
+        or C{None}.
+
+    @cvar maxContentLength: Number of bytes a parsed body may hold, or
+        C{None}.  Larger bodies are discarded as they arrive, and the
+        servlet rejects the request.
+    """
+    parser = None
+    contentType = "text/x-gwt-rpc"
+    maxContentLength = None
+
+    def gotLength(self, length):
+        contentType = self.getHeader("content-type")
+        if contentType is None or not contentType.startswith(self.contentType):
+            return server.Request.gotLength(self, length)
+        servlet = self.getServlet()
+        if servlet is not None:
+            self.parser = servlet.buildParser(self.maxContentLength)
+        else:
+            self.parser = rpc.IncrementalParser(self.maxContentLength)
+        maxSize = self.parser.maxSize
+        if maxSize is not None and length is not None and length > maxSize:
+            self.parser.abort(error.LimitExceeded("body is too large"))
+        # the body is not kept around
+        self.content = StringIO()
+
+    def getServlet(self):
+        """Return the servlet of the site, if it is the resource of the
+        site, or C{None}.
+        """
+        site = getattr(self.channel, 'site', None)
+        servlet = getattr(site, 'resource', None)
+        if isinstance(servlet, rpc._ServiceServlet):
+            return servlet
+        return None
+
+    def handleContentChunk(self, data):
+        if self.parser is None:
+            return server.Request.handleContentChunk(self, data)
+        self.parser.feed(data)